@@ -0,0 +1,565 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""In-memory stand-in for the subset of CouchDB HTTP API used by
+mwscrape and mwresolvec: databases, documents (including conflicting
+leaf revisions and inline attachments), _bulk_docs, _all_docs, _changes,
+_local documents and the views mwscrape installs. View map functions are
+not executed, views are emulated in Python by name.
+"""
+
+import base64
+import collections
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, quote, unquote, urlsplit
+
+
+class Doc:
+    """All leaf revisions of one document"""
+
+    def __init__(self):
+        self.leafs = {}
+
+    def winner(self):
+        live = [rev for rev, body in self.leafs.items() if not body.get("_deleted")]
+        revs = live or list(self.leafs)
+        if not revs:
+            return None
+        return max(revs, key=rev_key)
+
+    def conflicts(self):
+        winner = self.winner()
+        return sorted(
+            (
+                rev
+                for rev, body in self.leafs.items()
+                if rev != winner and not body.get("_deleted")
+            ),
+            key=rev_key,
+            reverse=True,
+        )
+
+
+def rev_key(rev):
+    num, _, digest = rev.partition("-")
+    return int(num), digest
+
+
+def next_rev(rev, body):
+    num = rev_key(rev)[0] if rev else 0
+    digest = hashlib.md5(
+        json.dumps(body, sort_keys=True).encode("utf-8") + uuid.uuid4().bytes
+    ).hexdigest()
+    return "%d-%s" % (num + 1, digest)
+
+
+class Database:
+    def __init__(self, name):
+        self.name = name
+        self.docs = collections.OrderedDict()
+        self.local = {}
+        self.seq = 0
+        self.changes = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+
+    def _record_change(self, doc_id):
+        self.seq += 1
+        self.changes.pop(doc_id, None)
+        self.changes[doc_id] = self.seq
+        self.changed.notify_all()
+
+    def get(self, doc_id, rev=None):
+        with self.lock:
+            doc = self.docs.get(doc_id)
+            if doc is None:
+                return None
+            rev = rev or doc.winner()
+            body = doc.leafs.get(rev)
+            if body is None:
+                return None
+            if body.get("_deleted") and rev == doc.winner():
+                return None
+            result = dict(body)
+            result["_id"] = doc_id
+            result["_rev"] = rev
+            return result
+
+    def put(self, doc_id, body, new_edits=True):
+        with self.lock:
+            doc = self.docs.get(doc_id)
+            if not new_edits:
+                if doc is None:
+                    doc = self.docs[doc_id] = Doc()
+                rev = body["_rev"]
+                doc.leafs[rev] = strip(body)
+                self._record_change(doc_id)
+                return rev
+            rev = body.get("_rev")
+            winner = doc.winner() if doc else None
+            old = {}
+            if doc is None or winner is None:
+                if rev:
+                    raise Conflict()
+                doc = self.docs[doc_id] = Doc()
+            elif rev is None:
+                if not doc.leafs[winner].get("_deleted"):
+                    raise Conflict()
+                rev = winner
+                del doc.leafs[winner]
+            elif rev not in doc.leafs:
+                raise Conflict()
+            else:
+                old = doc.leafs.pop(rev)
+            content = strip(body)
+            if content.get("_attachments"):
+                content["_attachments"] = merge_attachments(
+                    content["_attachments"], old.get("_attachments", {})
+                )
+            new_rev = next_rev(rev, content)
+            doc.leafs[new_rev] = content
+            self._record_change(doc_id)
+            return new_rev
+
+    def delete(self, doc_id, rev):
+        return self.put(doc_id, {"_rev": rev, "_deleted": True})
+
+
+def merge_attachments(attachments, old_attachments):
+    result = {}
+    for name, att in attachments.items():
+        if att.get("stub"):
+            if name in old_attachments:
+                result[name] = old_attachments[name]
+            continue
+        data = base64.b64decode(att["data"])
+        result[name] = {
+            "content_type": att.get("content_type", "application/octet-stream"),
+            "data": att["data"],
+            "length": len(data),
+            "digest": "md5-" + base64.b64encode(hashlib.md5(data).digest()).decode(),
+        }
+    return result
+
+
+class Conflict(Exception):
+    pass
+
+
+def strip(body):
+    return {k: v for k, v in body.items() if k not in ("_id", "_rev")}
+
+
+def attachment_stubs(doc):
+    attachments = doc.get("_attachments")
+    if attachments:
+        doc["_attachments"] = {
+            name: {
+                "content_type": att["content_type"],
+                "length": att["length"],
+                "digest": att["digest"],
+                "stub": True,
+            }
+            for name, att in attachments.items()
+        }
+    return doc
+
+
+def emulated_view(db, ddoc, view_name, params, keys):
+    """Compute rows of a view installed by mwscrape or mwresolvec"""
+    rows = []
+    with db.lock:
+        ids = sorted(i for i in db.docs if not i.startswith("_design/"))
+        for doc_id in ids:
+            doc = db.get(doc_id)
+            if doc is None:
+                continue
+            if view_name == "revid" and "parse" in doc:
+                value = {
+                    "rev": doc["_rev"],
+                    "revid": doc["parse"].get("revid"),
+                    "aliases": doc.get("aliases", []),
+                }
+                for key in ("parse_profile",):
+                    if key in doc:
+                        value["profile"] = doc[key]
+                rows.append({"id": doc_id, "key": doc_id, "value": value})
+            elif view_name == "conflicts":
+                conflicts = db.docs[doc_id].conflicts()
+                if conflicts:
+                    rows.append(
+                        {
+                            "id": doc_id,
+                            "key": doc_id,
+                            "value": [doc["_rev"]] + conflicts,
+                        }
+                    )
+            elif view_name == "noprerender" and "text" in doc.get("parse", {}):
+                rows.append({"id": doc_id, "key": doc_id, "value": None})
+        if params.get("include_docs") == "true":
+            for row in rows:
+                row["doc"] = attachment_stubs(db.get(row["id"]))
+    return rows
+
+
+class FakeCouch:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.dbs = {}
+        self.lock = threading.Lock()
+        self.request_count = collections.Counter()
+
+    def count(self, kind):
+        with self.lock:
+            self.request_count[kind] += 1
+
+
+class Server(ThreadingHTTPServer):
+    # scrapers may open hundreds of connections at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def couch(self):
+        return self.server.couch
+
+    def send_json(self, status, data, headers=()):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_PUT(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def handle_request(self):
+        if self.couch.latency:
+            time.sleep(self.couch.latency)
+        url = urlsplit(self.path)
+        parts = [unquote(p) for p in url.path.split("/")[1:] if p != ""]
+        params = {k: v for k, v in parse_qsl(url.query, keep_blank_values=True)}
+        body = self.read_body()
+        try:
+            self.route(parts, params, body)
+        except Conflict:
+            self.send_json(
+                409, {"error": "conflict", "reason": "Document update conflict."}
+            )
+        except KeyError as ex:
+            self.send_json(404, {"error": "not_found", "reason": str(ex)})
+
+    def route(self, parts, params, body):
+        method = self.command
+        if not parts:
+            return self.send_json(200, {"couchdb": "Welcome", "version": "fake"})
+        if parts == ["_all_dbs"]:
+            return self.send_json(200, sorted(self.couch.dbs))
+        db_name = parts[0]
+        if len(parts) == 1:
+            self.couch.count("db")
+            if method == "PUT":
+                if db_name in self.couch.dbs:
+                    return self.send_json(
+                        412, {"error": "file_exists", "reason": "exists"}
+                    )
+                self.couch.dbs[db_name] = Database(db_name)
+                return self.send_json(201, {"ok": True})
+            db = self.couch.dbs[db_name]
+            if method == "DELETE":
+                del self.couch.dbs[db_name]
+                return self.send_json(200, {"ok": True})
+            return self.send_json(
+                200,
+                {"db_name": db_name, "doc_count": len(db.docs), "update_seq": db.seq},
+            )
+        db = self.couch.dbs[db_name]
+        rest = parts[1:]
+        if rest[0] == "_bulk_docs":
+            self.couch.count("bulk_docs")
+            return self.bulk_docs(db, json.loads(body))
+        if rest[0] == "_all_docs":
+            self.couch.count("view")
+            keys = json.loads(body).get("keys") if body else None
+            return self.all_docs(db, params, keys)
+        if rest[0] == "_changes":
+            self.couch.count("changes")
+            return self.changes(db, params)
+        if rest[0] == "_bulk_get":
+            self.couch.count("bulk_get")
+            return self.bulk_get(db, json.loads(body))
+        if rest[0] == "_local":
+            self.couch.count("local")
+            doc_id = "_local/" + rest[1]
+            if method == "GET":
+                if doc_id not in db.local:
+                    raise KeyError(doc_id)
+                return self.send_json(200, db.local[doc_id])
+            if method == "PUT":
+                doc = json.loads(body)
+                rev = "0-%d" % (
+                    int(db.local.get(doc_id, {}).get("_rev", "0-0")[2:]) + 1
+                )
+                doc["_id"], doc["_rev"] = doc_id, rev
+                db.local[doc_id] = doc
+                return self.send_json(201, {"ok": True, "id": doc_id, "rev": rev})
+            if method == "DELETE":
+                del db.local[doc_id]
+                return self.send_json(200, {"ok": True, "id": doc_id, "rev": "0-0"})
+        if rest[0] == "_design" and len(rest) >= 4 and rest[2] == "_view":
+            self.couch.count("view")
+            keys = json.loads(body).get("keys") if body else None
+            rows = emulated_view(db, rest[1], rest[3], params, keys)
+            return self.send_rows(rows, params, keys)
+        if rest[0] == "_design" and len(rest) >= 4 and rest[2] == "_show":
+            self.couch.count("show")
+            doc = db.get("/".join(rest[4:]))
+            if doc is None:
+                raise KeyError("missing")
+            if "text" not in doc["parse"]:
+                self.send_response(302)
+                # relative to database root, like html show function
+                location = "../" * (len(rest) - 1) + "%s/text.html" % quote(
+                    doc["_id"], safe=""
+                )
+                self.send_header("Location", location)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = doc["parse"]["text"]["*"].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return self.wfile.write(body)
+        if rest[0] == "_design":
+            rest = ["_design/" + rest[1]] + rest[2:]
+        doc_id = rest[0]
+        if len(rest) > 1:
+            if method == "PUT":
+                return self.put_attachment(db, doc_id, "/".join(rest[1:]), params, body)
+            return self.attachment(db, doc_id, "/".join(rest[1:]), params)
+        self.couch.count("doc_" + method.lower())
+        if method in ("GET", "HEAD"):
+            return self.get_doc(db, doc_id, params)
+        if method == "PUT":
+            doc = json.loads(body)
+            if "rev" in params:
+                doc["_rev"] = params["rev"]
+            rev = db.put(doc_id, doc, params.get("new_edits") != "false")
+            return self.send_json(201, {"ok": True, "id": doc_id, "rev": rev})
+        if method == "DELETE":
+            rev = db.delete(doc_id, params.get("rev"))
+            return self.send_json(200, {"ok": True, "id": doc_id, "rev": rev})
+
+    def get_doc(self, db, doc_id, params):
+        open_revs = params.get("open_revs")
+        if open_revs:
+            with db.lock:
+                doc = db.docs.get(doc_id)
+                if doc is None:
+                    raise KeyError(doc_id)
+                revs = list(doc.leafs) if open_revs == "all" else json.loads(open_revs)
+                result = []
+                for rev in revs:
+                    body = db.get(doc_id, rev=rev)
+                    if body is None:
+                        result.append({"missing": rev})
+                    else:
+                        result.append({"ok": attachment_stubs(body)})
+            return self.send_json(200, result)
+        doc = db.get(doc_id, rev=params.get("rev"))
+        if doc is None:
+            raise KeyError(doc_id)
+        if params.get("conflicts") == "true":
+            conflicts = db.docs[doc_id].conflicts()
+            if conflicts:
+                doc["_conflicts"] = conflicts
+        if params.get("attachments") != "true":
+            attachment_stubs(doc)
+        self.send_json(200, doc, headers=[("ETag", '"%s"' % doc["_rev"])])
+
+    def attachment(self, db, doc_id, name, params):
+        self.couch.count("attachment_" + self.command.lower())
+        doc = db.get(doc_id, rev=params.get("rev"))
+        if doc is None or name not in doc.get("_attachments", {}):
+            raise KeyError(name)
+        att = doc["_attachments"][name]
+        data = base64.b64decode(att["data"])
+        self.send_response(200)
+        self.send_header("Content-Type", att["content_type"])
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def put_attachment(self, db, doc_id, name, params, body):
+        self.couch.count("attachment_put")
+        doc = db.get(doc_id) or {}
+        attachments = dict(doc.get("_attachments", {}))
+        attachments[name] = {
+            "content_type": self.headers.get(
+                "Content-Type", "application/octet-stream"
+            ),
+            "data": base64.b64encode(body).decode("ascii"),
+        }
+        doc["_attachments"] = attachments
+        doc["_rev"] = params.get("rev")
+        rev = db.put(doc_id, doc)
+        self.send_json(201, {"ok": True, "id": doc_id, "rev": rev})
+
+    def bulk_docs(self, db, content):
+        new_edits = content.get("new_edits", True)
+        results = []
+        for doc in content["docs"]:
+            doc_id = doc.get("_id") or uuid.uuid4().hex
+            try:
+                rev = db.put(doc_id, doc, new_edits)
+            except Conflict:
+                results.append(
+                    {
+                        "id": doc_id,
+                        "error": "conflict",
+                        "reason": "Document update conflict.",
+                    }
+                )
+            else:
+                results.append({"id": doc_id, "ok": True, "rev": rev})
+        self.send_json(201, results)
+
+    def bulk_get(self, db, content):
+        results = []
+        for item in content["docs"]:
+            doc = db.get(item["id"], rev=item.get("rev"))
+            if doc is None:
+                docs = [{"error": {"id": item["id"], "error": "not_found"}}]
+            else:
+                docs = [{"ok": attachment_stubs(doc)}]
+            results.append({"id": item["id"], "docs": docs})
+        self.send_json(200, {"results": results})
+
+    def all_docs(self, db, params, keys):
+        include_docs = params.get("include_docs") == "true"
+        rows = []
+        with db.lock:
+            ids = keys if keys is not None else sorted(db.docs)
+            for doc_id in ids:
+                doc = db.get(doc_id)
+                if doc is None:
+                    if keys is not None:
+                        rows.append({"key": doc_id, "error": "not_found"})
+                    continue
+                row = {"id": doc_id, "key": doc_id, "value": {"rev": doc["_rev"]}}
+                if include_docs:
+                    row["doc"] = attachment_stubs(doc)
+                rows.append(row)
+        self.send_rows(rows, params, keys)
+
+    def send_rows(self, rows, params, keys):
+        if keys is not None:
+            wanted = {}
+            for row in rows:
+                wanted.setdefault(row["key"], []).append(row)
+            rows = [row for key in keys for row in wanted.get(key, ())]
+        else:
+            if params.get("descending") == "true":
+                rows.reverse()
+            startkey = params.get("startkey")
+            if startkey is not None:
+                startkey = json.loads(startkey)
+                if params.get("descending") == "true":
+                    rows = [row for row in rows if row["key"] <= startkey]
+                else:
+                    rows = [row for row in rows if row["key"] >= startkey]
+            skip = int(params.get("skip", 0))
+            rows = rows[skip:]
+            if "limit" in params:
+                rows = rows[: int(params["limit"])]
+        self.send_json(200, {"total_rows": len(rows), "offset": 0, "rows": rows})
+
+    def changes(self, db, params):
+        since = int(params.get("since", 0) or 0)
+        limit = int(params["limit"]) if "limit" in params else None
+        feed = params.get("feed", "normal")
+        timeout = float(params.get("timeout", 60000)) / 1000
+        with db.lock:
+            if feed in ("longpoll", "continuous") and db.seq <= since:
+                db.changed.wait(timeout)
+            results = []
+            for doc_id, seq in db.changes.items():
+                if seq <= since:
+                    continue
+                doc = db.docs[doc_id]
+                if params.get("style") == "all_docs":
+                    changes = [{"rev": rev} for rev in doc.leafs]
+                else:
+                    changes = [{"rev": doc.winner()}]
+                results.append({"seq": seq, "id": doc_id, "changes": changes})
+                if limit and len(results) >= limit:
+                    break
+            last_seq = results[-1]["seq"] if results else max(since, db.seq)
+        if feed == "continuous":
+            lines = [json.dumps(r) for r in results]
+            lines.append(json.dumps({"last_seq": last_seq}))
+            body = ("\n".join(lines) + "\n").encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return self.wfile.write(body)
+        self.send_json(200, {"results": results, "last_seq": last_seq})
+
+
+def serve(couch, port=0):
+    server = Server(("127.0.0.1", port), Handler)
+    server.couch = couch
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,394 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Stand-in for the MediaWiki API endpoints used by mwscrape:
+siteinfo, allpages generator with prop=info, titles with prop=info,
+redirect resolution, random pages, recentchanges and parse.
+"""
+
+import collections
+import json
+import random
+import threading
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+NAMESPACES = {0: "", 4: "Project", 10: "Template", 14: "Category", 100: "Appendix"}
+
+
+class Page:
+    def __init__(self, ns, title, pageid, revid, redirect=None, fragment=""):
+        self.ns = ns
+        self.title = title
+        self.pageid = pageid
+        self.revid = revid
+        self.redirect = redirect
+        self.fragment = fragment
+        self.touched = "2024-01-01T00:00:00Z"
+
+
+class FakeWiki:
+    def __init__(
+        self,
+        page_count=1000,
+        page_size=20000,
+        redirect_ratio=0.2,
+        latency=0.0,
+        error_ratio=0.0,
+        namespaces=(0,),
+        seed=1,
+    ):
+        self.latency = latency
+        self.page_size = page_size
+        self.error_ratio = error_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = collections.Counter()
+        self.pages = {}
+        self.changes = []
+        pageid = 0
+        for ns in namespaces:
+            prefix = NAMESPACES[ns] + ":" if ns else ""
+            titles = [prefix + "Page %06d" % i for i in range(page_count)]
+            for title in titles:
+                pageid += 1
+                self.pages[title] = Page(ns, title, pageid, 1000 + pageid)
+            articles = list(titles)
+            for title in titles:
+                if self.random.random() < redirect_ratio:
+                    page = self.pages[title]
+                    target = self.random.choice(articles)
+                    if target == title:
+                        continue
+                    page.redirect = target
+                    if self.random.random() < 0.5:
+                        page.fragment = "Section %d" % self.random.randint(1, 3)
+                    articles.remove(title)
+        self.rcid = 0
+
+    def count(self, kind):
+        with self.lock:
+            self.request_count[kind] += 1
+
+    def edit(self, title, timestamp=None):
+        with self.lock:
+            page = self.pages[title]
+            page.revid += 1000000
+            self.rcid += 1
+            self.changes.append(
+                dict(
+                    type="edit",
+                    ns=page.ns,
+                    title=title,
+                    pageid=page.pageid,
+                    revid=page.revid,
+                    old_revid=page.revid - 1000000,
+                    rcid=self.rcid,
+                    timestamp=timestamp
+                    or datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                )
+            )
+
+    def sorted_titles(self, ns, descending=False):
+        titles = [p.title for p in self.pages.values() if p.ns == ns]
+        titles.sort(key=lambda t: t.replace(" ", "_"), reverse=descending)
+        return titles
+
+    def info(self, title):
+        page = self.pages.get(title)
+        if page is None:
+            return {"ns": 0, "title": title, "missing": ""}
+        info = {
+            "pageid": page.pageid,
+            "ns": page.ns,
+            "title": page.title,
+            "touched": page.touched,
+            "lastrevid": page.revid,
+            "length": self.page_size,
+        }
+        if page.redirect:
+            info["redirect"] = ""
+        return info
+
+    def resolve(self, titles):
+        redirects = []
+        resolved = []
+        for title in titles:
+            seen = set()
+            while title in self.pages and self.pages[title].redirect:
+                if title in seen:
+                    break
+                seen.add(title)
+                page = self.pages[title]
+                entry = {"from": title, "to": page.redirect}
+                if page.fragment:
+                    entry["tofragment"] = page.fragment
+                if entry not in redirects:
+                    redirects.append(entry)
+                title = page.redirect
+            resolved.append(title)
+        return redirects, resolved
+
+    def html(self, page):
+        links = []
+        for i in range(20):
+            links.append(
+                '<a href="/wiki/Page_%06d" title="Page %06d">Page %06d</a>' % (i, i, i)
+            )
+        chunk = "<p>" + " ".join(links) + "</p>\n"
+        text = "<div>%s</div>" % page.title
+        while len(text) < self.page_size:
+            text += chunk
+        return text
+
+    def parse(self, title, prop=None):
+        page = self.pages.get(title)
+        if page is None:
+            return {
+                "error": {"code": "missingtitle", "info": "The page doesn't exist."}
+            }
+        parse = {
+            "title": page.title,
+            "pageid": page.pageid,
+            "revid": page.revid,
+            "text": {"*": self.html(page)},
+            "langlinks": [],
+            "categories": [{"sortkey": "", "*": "Category_%d" % (page.pageid % 7)}],
+            "links": [
+                {"ns": 0, "exists": "", "*": "Page %06d" % i} for i in range(200)
+            ],
+            "templates": [
+                {"ns": 10, "exists": "", "*": "Template:T%d" % i} for i in range(100)
+            ],
+            "images": [],
+            "externallinks": [],
+            "sections": [],
+            "displaytitle": page.title,
+            "iwlinks": [],
+            "properties": [],
+        }
+        if prop is not None:
+            props = set(prop.split("|"))
+            keep = {"title", "pageid", "revid"}
+            if "text" in props:
+                keep.add("text")
+            for name in list(parse):
+                if name not in keep and name not in props:
+                    del parse[name]
+        return {"parse": parse}
+
+    def query(self, params):
+        query = {}
+        result = {"batchcomplete": ""}
+        if "siteinfo" in params.get("meta", ""):
+            query["general"] = {
+                "mainpage": "Main Page",
+                "sitename": "Fake",
+                "server": "//fake.wiki",
+                "generator": "MediaWiki 1.39.0",
+            }
+            query["namespaces"] = {
+                str(ns): {"id": ns, "*": name} for ns, name in NAMESPACES.items()
+            }
+            query["interwikimap"] = []
+            query["rightsinfo"] = {}
+            query["statistics"] = {"pages": len(self.pages)}
+        if "userinfo" in params.get("meta", ""):
+            query["userinfo"] = {"id": 0, "name": "127.0.0.1", "anon": ""}
+        titles = None
+        if params.get("generator") == "allpages":
+            self.count("query_allpages")
+            titles, cont = self.allpages(params, "gap")
+            if cont:
+                result["continue"] = {"gapcontinue": cont, "continue": "gapcontinue||"}
+        elif params.get("list") == "allpages":
+            self.count("query_allpages")
+            titles, cont = self.allpages(params, "ap")
+            query["allpages"] = [
+                {"pageid": self.pages[t].pageid, "ns": self.pages[t].ns, "title": t}
+                for t in titles
+            ]
+            titles = None
+            if cont:
+                result["continue"] = {"apcontinue": cont, "continue": "-||"}
+        elif "titles" in params:
+            self.count("query_titles")
+            titles = params["titles"].split("|")
+        if params.get("list") == "random":
+            self.count("query_random")
+            query["random"] = self.random_pages(params)
+        if params.get("list") == "recentchanges":
+            self.count("query_recentchanges")
+            query["recentchanges"], cont = self.recentchanges(params)
+            if cont:
+                result["continue"] = {"rccontinue": cont, "continue": "-||"}
+        if titles is not None:
+            if "redirects" in params:
+                self.count("query_redirects")
+                redirects, titles = self.resolve(titles)
+                if redirects:
+                    query["redirects"] = redirects
+            pages = {}
+            for i, title in enumerate(titles):
+                info = self.info(title)
+                pages[str(info.get("pageid", -1 - i))] = info
+            query["pages"] = pages
+        result["query"] = query
+        return result
+
+    def allpages(self, params, prefix):
+        ns = int(params.get(prefix + "namespace", 0))
+        descending = params.get(prefix + "dir") == "descending"
+        titles = self.sorted_titles(ns, descending)
+        filterredir = params.get(prefix + "filterredir", "all")
+        if filterredir == "redirects":
+            titles = [t for t in titles if self.pages[t].redirect]
+        elif filterredir == "nonredirects":
+            titles = [t for t in titles if not self.pages[t].redirect]
+        start = params.get(prefix + "continue") or params.get(prefix + "from")
+        end = params.get(prefix + "to")
+        ns_prefix = NAMESPACES[ns] + ":" if ns else ""
+
+        def key(t):
+            # like MediaWiki, compare db keys without namespace prefix
+            if ns_prefix and t.startswith(ns_prefix):
+                t = t[len(ns_prefix) :]
+            return t.replace(" ", "_")
+
+        if start:
+            start = start.replace(" ", "_")
+            if descending:
+                titles = [t for t in titles if key(t) <= start]
+            else:
+                titles = [t for t in titles if key(t) >= start]
+        if end:
+            end = end.replace(" ", "_")
+            if descending:
+                titles = [t for t in titles if key(t) >= end]
+            else:
+                titles = [t for t in titles if key(t) <= end]
+        limit = params.get(prefix + "limit", "10")
+        limit = 500 if limit == "max" else int(limit)
+        cont = key(titles[limit]) if len(titles) > limit else None
+        return titles[:limit], cont
+
+    def random_pages(self, params):
+        ns = int(params.get("rnnamespace", 0))
+        titles = self.sorted_titles(ns)
+        filterredir = params.get("rnfilterredir", "nonredirects")
+        if filterredir == "redirects":
+            titles = [t for t in titles if self.pages[t].redirect]
+        elif filterredir == "nonredirects":
+            titles = [t for t in titles if not self.pages[t].redirect]
+        limit = params.get("rnlimit", "1")
+        limit = 500 if limit == "max" else int(limit)
+        with self.lock:
+            titles = self.random.sample(titles, min(limit, len(titles)))
+        return [
+            {"id": self.pages[t].pageid, "ns": self.pages[t].ns, "title": t}
+            for t in titles
+        ]
+
+    def recentchanges(self, params):
+        changes = list(self.changes)
+        namespaces = params.get("rcnamespace")
+        if namespaces:
+            namespaces = {int(ns) for ns in namespaces.split("|")}
+            changes = [c for c in changes if c["ns"] in namespaces]
+        if params.get("rcdir") == "newer":
+            start = params.get("rcstart")
+            if start:
+                start = normalize_timestamp(start)
+                changes = [c for c in changes if c["timestamp"] >= start]
+        else:
+            changes.reverse()
+        cont = params.get("rccontinue")
+        if cont:
+            rcid = int(cont.split("|")[1])
+            if params.get("rcdir") == "newer":
+                changes = [c for c in changes if c["rcid"] >= rcid]
+            else:
+                changes = [c for c in changes if c["rcid"] <= rcid]
+        if params.get("rctoponly"):
+            latest = {}
+            for change in changes:
+                latest[change["title"]] = change
+            changes = [c for c in changes if latest[c["title"]] is c]
+        limit = params.get("rclimit", "10")
+        limit = 500 if limit == "max" else int(limit)
+        cont = None
+        if len(changes) > limit:
+            nxt = changes[limit]
+            cont = "%s|%d" % (nxt["timestamp"], nxt["rcid"])
+        return changes[:limit], cont
+
+
+def normalize_timestamp(timestamp):
+    """Convert yyyymmddhhmmss or ISO timestamp to ISO"""
+    if "T" in timestamp:
+        return timestamp
+    return datetime.strptime(timestamp, "%Y%m%d%H%M%S").strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Server(ThreadingHTTPServer):
+    # scrapers may open hundreds of connections at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_api(urlsplit(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.handle_api(self.rfile.read(length).decode("utf-8"))
+
+    def handle_api(self, query_string):
+        wiki = self.server.wiki
+        if wiki.latency:
+            time.sleep(wiki.latency)
+        params = dict(parse_qsl(query_string, keep_blank_values=True))
+        if wiki.error_ratio and wiki.random.random() < wiki.error_ratio:
+            wiki.count("throttled")
+            body = b"Too many requests"
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        action = params.get("action")
+        if action == "parse":
+            wiki.count("parse")
+            result = wiki.parse(params.get("page"), params.get("prop"))
+        elif action == "query":
+            result = wiki.query(params)
+        else:
+            result = {"error": {"code": "unknown_action", "info": action}}
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(wiki, port=0):
+    server = Server(("127.0.0.1", port), Handler)
+    server.wiki = wiki
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
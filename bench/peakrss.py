@@ -0,0 +1,44 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Run Python module like python -m does and write its peak resident
+set size in kilobytes to a file on exit:
+
+    python bench/peakrss.py OUTPUT MODULE [ARG ...]
+
+Peak RSS reported by getrusage() of a child process includes memory
+of the parent it was forked from, /proc/self/status has
+the peak of the running program only.
+"""
+
+import atexit
+import resource
+import runpy
+import sys
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def write_peak_rss(path):
+    with open(path, "w") as f:
+        f.write(str(peak_rss()))
+
+
+if __name__ == "__main__":
+    output, module = sys.argv[1:3]
+    sys.argv = [module] + sys.argv[3:]
+    del sys.path[0]
+    atexit.register(write_peak_rss, output)
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
@@ -0,0 +1,244 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Offline benchmark. Starts fake MediaWiki API and CouchDB servers
+in this process, runs mwscrape or mwresolvec against them in a child
+process and reports throughput, requests per page, CPU time
+and peak memory of the child. For example:
+
+    python bench/run.py --pages 5000 --wiki-latency 0.05 -- --speed 3
+    python bench/run.py -s rescrape -- --recent
+    python bench/run.py -s resolveconflicts -- --bulk
+
+Arguments after -- are passed on to mwscrape (or mwresolvec).
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakecouch
+import fakewiki
+
+DB_NAME = "bench"
+
+SCENARIOS = ("scrape", "rescrape", "resolveconflicts")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PEAKRSS = os.path.join(ROOT, "bench", "peakrss.py")
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=SCENARIOS,
+        help=(
+            "Scenario to run, may be given more than once. "
+            "scrape: scrape all pages into empty database, "
+            "rescrape: scrape all pages into database that has them, "
+            "some up to date (see --up-to-date-ratio), "
+            "resolveconflicts: run mwresolvec on database where "
+            "some documents have conflicts (see --conflict-ratio). "
+            "Default: all"
+        ),
+    )
+    argparser.add_argument(
+        "--pages",
+        type=int,
+        default=2000,
+        help="Number of pages, including redirects. Default: %(default)s",
+    )
+    argparser.add_argument(
+        "--page-size",
+        type=int,
+        default=20000,
+        help="Size of article HTML in characters. Default: %(default)s",
+    )
+    argparser.add_argument(
+        "--redirect-ratio",
+        type=float,
+        default=0.2,
+        help="Fraction of pages that are redirects. Default: %(default)s",
+    )
+    argparser.add_argument(
+        "--up-to-date-ratio",
+        type=float,
+        default=0.9,
+        help=(
+            "Fraction of articles that are up to date in database "
+            "for rescrape scenario, the rest are edited in wiki "
+            "(and are in its recent changes). "
+            "Default: %(default)s"
+        ),
+    )
+    argparser.add_argument(
+        "--conflict-ratio",
+        type=float,
+        default=0.2,
+        help=(
+            "Fraction of articles with conflicting revisions "
+            "for resolveconflicts scenario. Default: %(default)s"
+        ),
+    )
+    argparser.add_argument(
+        "--wiki-latency",
+        type=float,
+        default=0,
+        help="Seconds fake wiki waits before each response. Default: %(default)s",
+    )
+    argparser.add_argument(
+        "--couch-latency",
+        type=float,
+        default=0,
+        help="Seconds fake CouchDB waits before each response. Default: %(default)s",
+    )
+    argparser.add_argument(
+        "--json",
+        help="Also write results to this file as JSON",
+    )
+    argparser.add_argument(
+        "args", nargs="*", help="Arguments for mwscrape or mwresolvec"
+    )
+    return argparser.parse_args()
+
+
+def populate(couch, wiki, up_to_date_ratio):
+    """Store all articles of wiki, then edit all but up_to_date_ratio
+    of them in wiki (so they also show up in recent changes)
+    """
+    db = couch.dbs.setdefault(DB_NAME, fakecouch.Database(DB_NAME))
+    rnd = random.Random(1)
+    for title, page in wiki.pages.items():
+        if page.redirect:
+            continue
+        db.put(title, wiki.parse(title))
+        if rnd.random() >= up_to_date_ratio:
+            wiki.edit(title)
+
+
+def add_conflicts(couch, wiki, conflict_ratio):
+    """Store all articles of wiki, conflict_ratio of them
+    with two more conflicting revisions
+    """
+    db = couch.dbs.setdefault(DB_NAME, fakecouch.Database(DB_NAME))
+    rnd = random.Random(1)
+    for title, page in wiki.pages.items():
+        if page.redirect:
+            continue
+        doc = wiki.parse(title)
+        if rnd.random() < conflict_ratio:
+            for i, revid in enumerate((page.revid - 1, page.revid, page.revid - 2)):
+                conflict = dict(doc, _rev="1-%032x" % (page.pageid * 10 + i))
+                conflict["parse"] = dict(doc["parse"], revid=revid)
+                conflict["aliases"] = ["Alias %d of %s" % (i, title)]
+                db.put(title, conflict, new_edits=False)
+        else:
+            db.put(title, doc)
+
+
+def run(module, args):
+    """Run Python module with args in child process, return its
+    wall clock time, CPU time and peak RSS in kilobytes
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (ROOT, env.get("PYTHONPATH")) if path
+    )
+    with tempfile.NamedTemporaryFile("r", prefix="mwscrape-bench-") as rss_file:
+        argv = [sys.executable, PEAKRSS, rss_file.name, module] + args
+        t0 = time.time()
+        process = subprocess.Popen(argv, env=env, stdout=subprocess.DEVNULL)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.time() - t0
+        returncode = os.waitstatus_to_exitcode(status)
+        if returncode:
+            raise SystemExit("%s failed with exit code %d" % (module, returncode))
+        peak_rss = int(rss_file.read() or 0)
+    return elapsed, rusage.ru_utime + rusage.ru_stime, peak_rss
+
+
+def scenario(args, name):
+    wiki = fakewiki.FakeWiki(
+        page_count=args.pages,
+        page_size=args.page_size,
+        redirect_ratio=args.redirect_ratio,
+        latency=args.wiki_latency,
+    )
+    couch = fakecouch.FakeCouch(latency=args.couch_latency)
+    couch_url = "http://127.0.0.1:%d" % fakecouch.serve(couch).server_port
+    if name == "resolveconflicts":
+        add_conflicts(couch, wiki, args.conflict_ratio)
+        module = "mwscrape.resolveconflicts"
+        argv = ["%s/%s" % (couch_url, DB_NAME)] + args.args
+    else:
+        if name == "rescrape":
+            populate(couch, wiki, args.up_to_date_ratio)
+        wiki_url = "http://127.0.0.1:%d" % fakewiki.serve(wiki).server_port
+        module = "mwscrape.scrape"
+        argv = [wiki_url, "--couch", couch_url, "--db", DB_NAME] + args.args
+    elapsed, cpu_time, peak_rss = run(module, argv)
+    pages = len(wiki.pages)
+    return {
+        "scenario": name,
+        "pages": pages,
+        "seconds": round(elapsed, 2),
+        "pages_per_second": round(pages / elapsed, 1),
+        "wiki_requests_per_page": {
+            kind: round(count / pages, 3)
+            for kind, count in sorted(wiki.request_count.items())
+        },
+        "couch_requests_per_page": {
+            kind: round(count / pages, 3)
+            for kind, count in sorted(couch.request_count.items())
+        },
+        "cpu_seconds": round(cpu_time, 2),
+        "peak_rss_mb": round(peak_rss / 1024, 1),
+    }
+
+
+def report(result):
+    print(
+        "%(scenario)s: %(pages)d pages in %(seconds)ss, "
+        "%(pages_per_second)s pages/s, CPU %(cpu_seconds)ss, "
+        "peak RSS %(peak_rss_mb)s MB" % result
+    )
+    for server in ("wiki", "couch"):
+        counts = result[server + "_requests_per_page"]
+        print(
+            "  %s requests per page: %.3f (%s)"
+            % (
+                server,
+                sum(counts.values()),
+                ", ".join("%s %s" % item for item in counts.items()),
+            )
+        )
+
+
+def main():
+    args = parse_args()
+    results = []
+    for name in args.scenario or SCENARIOS:
+        result = scenario(args, name)
+        report(result)
+        results.append(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
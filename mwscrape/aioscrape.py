@@ -0,0 +1,632 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""asyncio scraping engine. MediaWiki API and CouchDB requests go
+through aiohttp keep-alive connection pools, so that many requests
+can be in flight without a thread per request. Page processing follows
+the same rules as the thread pool engine in mwscrape.scrape, using
+the same functions to decide what to do with each page, this module
+only does the I/O. Page lists (one request per API limit titles)
+are still read with mwclient, in a thread.
+"""
+
+import asyncio
+import contextlib
+import functools
+import json
+import traceback
+
+from urllib.parse import quote
+
+import aiohttp
+import couchdb
+import mwclient.errors
+import pylru
+
+from .compress import stored_doc
+from .metrics import metrics
+from .ratecontrol import retry_after
+from .rawdoc import encode_doc, raw_doc
+from .scrape import (
+    ADD_ALIASES,
+    PARSE,
+    PARSE_PROFILES,
+    REVID_BATCH_SIZE,
+    TITLES_PER_QUERY,
+    add_aliases,
+    article_doc,
+    batches,
+    merge_into_current,
+    page_info,
+    redirect_hops,
+    redirect_targets,
+    redirect_titles,
+    revision_change,
+    saved_callback,
+    scrape_action,
+    target_aliases,
+)
+from .writer import bulk_docs_body, bulk_docs_results, index_entry
+
+# dropped connections and timeouts, unlike error responses,
+# are retried, as mwclient does in thread pool engine
+TRANSPORT_ERRORS = (
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+)
+
+MAX_BACKOFF = 60
+
+
+def backoff(retry):
+    """Seconds to wait before retrying request after retry failures
+
+    >>> [backoff(retry) for retry in (0, 1, 2, 10)]
+    [1, 2, 4, 60]
+
+    """
+    return min(2**retry, MAX_BACKOFF)
+
+
+async def retrying(request, max_retries=10, wait=asyncio.sleep):
+    """Await request(), retrying with backoff up to max_retries times
+    if connection fails or times out
+    """
+    retry = 0
+    while True:
+        try:
+            return await request()
+        except TRANSPORT_ERRORS as ex:
+            if retry >= max_retries:
+                raise
+            wait_time = backoff(retry)
+            print("%r, retrying in %ss" % (ex, wait_time))
+            retry += 1
+            await wait(wait_time)
+
+
+class AsyncSite:
+    """Minimal asyncio MediaWiki API client"""
+
+    def __init__(
+        self,
+        http,
+        scheme,
+        host,
+        path,
+        ext,
+        max_retries=10,
+        controller=None,
+        maxlag=None,
+    ):
+        self.http = http
+        self.url = "%s://%s%sapi%s" % (scheme, host, path, ext)
+        self.max_retries = max_retries
+        self.controller = controller
+        self.maxlag = maxlag
+
+    async def raw_api(self, action, **params):
+        """Make API request, return undecoded response body.
+        Errors reported in response body are not checked
+        """
+        params["action"] = action
+        params["format"] = "json"
+        if self.maxlag is not None:
+            params["maxlag"] = self.maxlag
+        for retry in range(self.max_retries + 1):
+            response, body = await retrying(
+                lambda: self.post(params), self.max_retries, self.throttle
+            )
+            if body is not None:
+                return body
+            if retry < self.max_retries:
+                await self.throttle(retry_after(response.headers))
+                continue
+            response.raise_for_status()
+            raise mwclient.errors.MaximumRetriesExceeded()
+
+    async def post(self, params):
+        """Make one API request, return response and its body,
+        or None instead of body if request was throttled
+        """
+        if self.controller:
+            slot = self.controller.async_slot()
+        else:
+            slot = contextlib.nullcontext()
+        async with slot:
+            async with self.http.post(self.url, data=params) as response:
+                if response.status in (429, 503) or response.headers.get(
+                    "x-database-lag"
+                ):
+                    return response, None
+                response.raise_for_status()
+                return response, await response.read()
+
+    async def api(self, action, **params):
+        for retry in range(self.max_retries + 1):
+            info = json.loads(await self.raw_api(action, **params))
+            if self.should_retry(info, params, retry):
+                await self.throttle(5)
+                continue
+            return info
+
+    def should_retry(self, info, params, retry=0):
+        """Check decoded API response for errors. Returns True
+        if request should be retried because of database lag,
+        raises APIError if response reports another error
+        """
+        if "error" not in info:
+            return False
+        if info["error"].get("code") == "maxlag" and retry < self.max_retries:
+            return True
+        raise mwclient.errors.APIError(
+            info["error"].get("code"), info["error"].get("info"), params
+        )
+
+    async def raw_parse(self, title, **params):
+        """Same as mwscrape.scrape.raw_parse, for this site"""
+        body = await self.raw_api("parse", page=title, **params)
+        doc = raw_doc(body)
+        if doc is None:
+            # most likely an error, decode it from body we already have
+            doc = json.loads(body)
+            if self.should_retry(doc, params):
+                await self.throttle(5)
+                doc = await self.api("parse", page=title, **params)
+        return doc
+
+    async def query_info(self, stage="info", **kwargs):
+        """Same as mwscrape.scrape.query_info, for this site"""
+        kwargs["prop"] = "info"
+        while True:
+            with metrics.timer(stage):
+                result = await self.api("query", **kwargs)
+            yield result.get("query", {})
+            if not result.get("continue"):
+                break
+            kwargs.update(result["continue"])
+
+    async def throttle(self, wait_time):
+        if self.controller:
+            # controller holds back all requests for wait_time
+            self.controller.throttle(wait_time)
+        else:
+            await asyncio.sleep(wait_time)
+
+
+class AsyncDatabase:
+    """Minimal asyncio CouchDB database client"""
+
+    def __init__(self, http, url, max_retries=10):
+        self.http = http
+        self.url = url.rstrip("/")
+        self.max_retries = max_retries
+
+    def doc_url(self, doc_id):
+        if doc_id.startswith("_design/"):
+            return self.url + "/_design/" + quote(doc_id[8:], safe="")
+        return self.url + "/" + quote(doc_id, safe="")
+
+    async def get(self, doc_id):
+        async def request():
+            async with self.http.get(self.doc_url(doc_id)) as response:
+                if response.status == 404:
+                    return None
+                response.raise_for_status()
+                return await response.json()
+
+        return await retrying(request, self.max_retries)
+
+    async def delete(self, doc_id):
+        doc = await self.get(doc_id)
+        if doc is None:
+            raise couchdb.ResourceNotFound(("not_found", doc_id))
+
+        async def request():
+            async with self.http.delete(
+                self.doc_url(doc_id), params={"rev": doc["_rev"]}
+            ) as response:
+                if response.status == 409:
+                    raise couchdb.ResourceConflict(("conflict", doc_id))
+                response.raise_for_status()
+
+        await retrying(request, self.max_retries)
+
+    async def revid_index(self, titles):
+        if not titles:
+            return {}
+
+        async def request():
+            async with self.http.post(
+                self.url + "/_design/w/_view/revid", json={"keys": list(titles)}
+            ) as response:
+                response.raise_for_status()
+                return await response.json()
+
+        with metrics.timer("couch_get"):
+            data = await retrying(request, self.max_retries)
+        return {row["key"]: row["value"] for row in data["rows"]}
+
+    async def bulk_docs(self, encoded_docs):
+        # if saved documents are sent again after connection
+        # is lost, they conflict and get merged
+        async def request():
+            async with self.http.post(
+                self.url + "/_bulk_docs",
+                data=bulk_docs_body(encoded_docs),
+                headers={"Content-Type": "application/json"},
+            ) as response:
+                response.raise_for_status()
+                return bulk_docs_results(await response.json())
+
+        return await retrying(request, self.max_retries)
+
+
+class AsyncBulkWriter:
+    """asyncio counterpart of mwscrape.writer.BulkWriter.
+    Up to max_flushes batches may be saved concurrently,
+    on_conflict is a coroutine function.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_docs=100,
+        max_bytes=16 * 1024 * 1024,
+        max_delay=5.0,
+        max_flushes=4,
+        saved_cache_size=10000,
+        on_conflict=None,
+    ):
+        self.db = db
+        self.on_conflict = on_conflict
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.flush_slots = asyncio.Semaphore(max_flushes)
+        self.saved = pylru.lrucache(saved_cache_size)
+        self.buffer = []
+        self.pending = {}
+        self.flushing = {}
+        self.buffer_bytes = 0
+        self.timer = None
+        self.tasks = set()
+
+    async def save(self, doc, callback=None):
+        encoded = encode_doc(doc)
+        item = [doc["_id"], doc, encoded, callback]
+        self.buffer.append(item)
+        self.pending[doc["_id"]] = item
+        self.buffer_bytes += len(encoded)
+        if len(self.buffer) >= self.max_docs or self.buffer_bytes >= self.max_bytes:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.max_delay, self.start_flush
+            )
+
+    def update_pending(self, doc_id, func):
+        item = self.pending.get(doc_id)
+        if item is None:
+            return False
+        func(item[1])
+        encoded = encode_doc(item[1])
+        self.buffer_bytes += len(encoded) - len(item[2])
+        item[2] = encoded
+        return True
+
+    async def saved_entry(self, doc_id):
+        while doc_id in self.flushing:
+            await self.flushing[doc_id]
+        return self.saved.get(doc_id)
+
+    def start_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffer:
+            return
+        batch = self.buffer
+        self.buffer = []
+        self.pending = {}
+        self.buffer_bytes = 0
+        done = asyncio.get_running_loop().create_future()
+        for doc_id, _, _, _ in batch:
+            self.flushing[doc_id] = done
+        # waiting for a slot here slows down scraper tasks saving documents
+        async with self.flush_slots:
+            try:
+                with metrics.timer("couch_put"):
+                    results = await self.db.bulk_docs([item[2] for item in batch])
+            except Exception as ex:
+                print("Failed to save %d document(s)" % len(batch))
+                traceback.print_exc()
+                results = [ex] * len(batch)
+        retried = set()
+        if self.on_conflict:
+            for i, ((_, doc, _, callback), result) in enumerate(zip(batch, results)):
+                if isinstance(result, couchdb.ResourceConflict):
+                    try:
+                        retry_doc = await self.on_conflict(doc)
+                    except Exception:
+                        traceback.print_exc()
+                        continue
+                    if retry_doc is not None:
+                        retried.add(i)
+                        if callback:
+                            callback = functools.partial(callback, merged=True)
+                        await self.save(retry_doc, callback)
+        for (doc_id, doc, _, _), result in zip(batch, results):
+            if not isinstance(result, Exception):
+                self.saved[doc_id] = index_entry(doc, result)
+            if self.flushing.get(doc_id) is done:
+                del self.flushing[doc_id]
+        done.set_result(None)
+        for i, ((doc_id, _, _, callback), result) in enumerate(zip(batch, results)):
+            if callback and i not in retried:
+                try:
+                    callback(doc_id, result)
+                except Exception:
+                    traceback.print_exc()
+
+    async def close(self):
+        # flushes may resubmit conflicting documents
+        while self.buffer or self.tasks:
+            await self.flush()
+            if self.tasks:
+                await asyncio.gather(*self.tasks)
+
+
+async def resolve_redirects(site, titles, batch_size=TITLES_PER_QUERY):
+    """Same as mwscrape.scrape.resolve_redirects, for AsyncSite"""
+    redirects = {}
+    targets = {}
+    for batch in batches(titles, batch_size):
+        async for query in site.query_info(
+            stage="redirects", titles="|".join(batch), redirects=""
+        ):
+            redirects.update(redirect_hops(query))
+            for info in query.get("pages", {}).values():
+                targets[info.get("title")] = page_info(info)
+    return redirects, targets
+
+
+async def next_batch(iterator, size):
+    """Get next batch of items from a blocking iterator
+    without blocking event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: next(batches(iterator, size), None))
+
+
+async def scrape(
+    args,
+    pages,
+    session,
+    site_url,
+    couch_url,
+    credentials,
+    db_name,
+    controller=None,
+    compressor=None,
+    parse_cache=None,
+    parse_profile="full",
+    redirects=None,
+):
+    """Scrape pages with up to args.connections concurrent requests.
+    site_url is (scheme, host, path, ext) tuple, pages is an iterator
+    of pages, possibly blocking. Redirects are resolved as
+    mwscrape.scrape.with_redirect_targets does, with redirects map
+    of the whole namespace if given
+    """
+    headers = {}
+    if args.user_agent:
+        headers["User-Agent"] = args.user_agent
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=args.connections, keepalive_timeout=60)
+    auth = aiohttp.BasicAuth(*credentials) if credentials else None
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout, headers=headers, auth=auth
+    ) as http:
+        site = AsyncSite(
+            http,
+            *site_url,
+            controller=controller,
+            maxlag=args.maxlag if controller else None,
+        )
+        db = AsyncDatabase(http, couch_url.rstrip("/") + "/" + quote(db_name, safe=""))
+
+        async def on_conflict(doc):
+            return merge_into_current(doc, await db.get(doc["_id"]))
+
+        writer = AsyncBulkWriter(
+            db,
+            max_docs=args.bulk_docs,
+            max_bytes=int(args.bulk_mb * 1024 * 1024),
+            max_delay=args.bulk_delay,
+            on_conflict=on_conflict,
+        )
+        inc_count = session.inc
+        # for blocking parse cache calls
+        loop = asyncio.get_running_loop()
+        host = site_url[1]
+        metrics.gauge("writer_buffer_docs", lambda: len(writer.buffer), site=host)
+        metrics.gauge("queue_size", lambda: queue.qsize(), site=host)
+
+        async def process_page(page, entry, token, target, aliases):
+            title = page.name
+            if not page.exists:
+                print("Not found: %s" % title)
+                inc_count("not_found")
+                if args.delete_not_found:
+                    try:
+                        await db.delete(title)
+                    except couchdb.ResourceNotFound:
+                        print("%s was not in the database" % title)
+                    except couchdb.ResourceConflict:
+                        print("Conflict while deleting %s" % title)
+                    except Exception:
+                        traceback.print_exc()
+                    else:
+                        print("%s removed from the database" % title)
+                return
+            if target is None:
+                print("Failed to resolve redirect %s" % title)
+                inc_count("failed_redirect")
+                return False
+            if target is not page:
+                print("%s ==> %s" % (title, target.name))
+                title = target.name
+            # with many concurrent tasks a redirect target is often
+            # being scraped by another task, wait for it to avoid conflicts
+            while title in scraping:
+                await asyncio.shield(scraping[title])
+            scraping[title] = asyncio.get_running_loop().create_future()
+            try:
+                return await scrape_title(target, aliases, entry, token)
+            finally:
+                scraping.pop(title).set_result(None)
+
+        async def scrape_title(page, aliases, entry, token):
+            title = page.name
+            try:
+                if writer.update_pending(title, lambda doc: add_aliases(doc, aliases)):
+                    print("%s is up to date (just scraped), skipping" % title)
+                    inc_count("up_to_date")
+                    return
+
+                saved_entry = await writer.saved_entry(title)
+                if saved_entry:
+                    entry = saved_entry
+
+                action, entry = scrape_action(page, aliases, entry, parse_profile)
+                if action != PARSE:
+                    print(
+                        "%s is up to date (rev. %s), skipping" % (title, entry["revid"])
+                    )
+                    inc_count("up_to_date")
+                    if action == ADD_ALIASES:
+                        with metrics.timer("couch_get"):
+                            doc = await db.get(title)
+                        # entry may be older than the document
+                        if not add_aliases(doc, aliases):
+                            return
+                        await writer.save(doc, saved_callback(session, token))
+                        return True
+                    return
+                if entry:
+                    print(revision_change(page, entry, parse_profile))
+                if args.delay:
+                    await asyncio.sleep(args.delay)
+                doc = None
+                if parse_cache:
+                    with metrics.timer("parse_cache"):
+                        doc = await loop.run_in_executor(
+                            None,
+                            parse_cache.get_doc,
+                            title,
+                            page.revision,
+                            compressor,
+                            args.prerender,
+                        )
+                if doc is None:
+                    with metrics.timer("parse"):
+                        parse_params = PARSE_PROFILES[parse_profile]
+                        if compressor or args.prerender:
+                            doc = await site.api("parse", page=title, **parse_params)
+                        else:
+                            doc = await site.raw_parse(title, **parse_params)
+                    if parse_cache:
+                        with metrics.timer("parse_cache_put"):
+                            await loop.run_in_executor(
+                                None, parse_cache.put_doc, title, doc
+                            )
+                    if compressor or args.prerender:
+                        with metrics.timer("compress" if compressor else "prerender"):
+                            doc = stored_doc(doc, compressor, args.prerender)
+                doc = article_doc(doc, title, aliases, entry, parse_profile)
+                await writer.save(
+                    doc, saved_callback(session, token, "updated" if entry else "new")
+                )
+                return True
+            except Exception:
+                print("Failed to process %s:" % title)
+                traceback.print_exc()
+                inc_count("error")
+                return False
+
+        scraping = {}
+
+        async def process(item):
+            token, page, entry, target, aliases = item
+            # True if handed to the writer, False if failed
+            result = False
+            try:
+                result = await process_page(page, entry, token, target, aliases)
+            finally:
+                if not result:
+                    session.done(token, ok=result is None)
+
+        queue = asyncio.Queue(maxsize=args.connections * 2)
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                try:
+                    if item is None:
+                        return
+                    await process(item)
+                finally:
+                    queue.task_done()
+
+        known = redirects or {}
+        aliases_by_target = target_aliases(known)
+        workers = [asyncio.ensure_future(worker()) for _ in range(args.connections)]
+        try:
+            while True:
+                batch = await next_batch(pages, REVID_BATCH_SIZE)
+                if not batch:
+                    break
+                try:
+                    hops, infos = await resolve_redirects(
+                        site, redirect_titles(batch, known)
+                    )
+                    targets = list(
+                        redirect_targets(batch, hops, infos, known, aliases_by_target)
+                    )
+                    index = await db.revid_index(
+                        [
+                            target.name
+                            for _, target, _ in targets
+                            if target and target.exists
+                        ]
+                    )
+                except Exception:
+                    # same as failing each page of the batch
+                    print("Failed to process %d page(s):" % len(batch))
+                    traceback.print_exc()
+                    for page in batch:
+                        token = session.start(page.name, page.namespace)
+                        inc_count("error")
+                        session.done(token, ok=False)
+                    continue
+                for page, target, aliases in targets:
+                    entry = index.get(target.name) if target else None
+                    token = session.start(page.name, page.namespace)
+                    await queue.put((token, page, entry, target, aliases))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await writer.close()
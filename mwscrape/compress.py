@@ -0,0 +1,210 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Compressed article documents.
+
+Compressed document keeps only small parse fields inline (enough for
+revid checks and conflict resolution), article HTML is stored
+in text.html attachment, with links rewritten to point to html show
+function, and the rest of parse fields are stored in compressed JSON
+attachment (parse.json.gz or parse.json.zst). CouchDB compresses
+text.html itself (it's of compressible type).
+
+Prerendered document has only article HTML moved to text.html
+attachment, with links pointing to text.html of other articles, so that
+it's served as is, without running html show function on each read.
+"""
+
+import base64
+import gzip
+import json
+import re
+
+from urllib.parse import quote, unquote
+
+INLINE_PARSE_FIELDS = ("title", "pageid", "revid", "displaytitle")
+
+TEXT_ATTACHMENT = "text.html"
+
+PARSE_ATTACHMENTS = {"gzip": "parse.json.gz", "zstd": "parse.json.zst"}
+
+CONTENT_TYPES = {"gzip": "application/gzip", "zstd": "application/zstd"}
+
+# design document attachment with zstd dictionary of given id
+ZSTD_DICT_ATTACHMENT = "zstd-%d.dict"
+
+LINK_RE = re.compile(r'href="/wiki/(.*?)"', re.IGNORECASE)
+
+# rewritten links, relative to article's text.html attachment
+SHOW_LINK = "../_design/w/_show/html/%s"
+TEXT_LINK = "../%s/" + TEXT_ATTACHMENT
+
+
+def link_target(href, link=SHOW_LINK):
+    """Rewritten link for wiki link href: link template filled with
+    title href points to, quoted as one path segment, and link's fragment
+
+    >>> link_target('Caf%C3%A9_au_lait#Name'), link_target('and/or', TEXT_LINK)
+    ('../_design/w/_show/html/Caf%C3%A9%20au%20lait#Name', '../and%2For/text.html')
+
+    """
+    title, hash_sign, fragment = href.partition("#")
+    title = quote(unquote(title).replace("_", " "), safe="")
+    return link % title + hash_sign + fragment
+
+
+def rewrite_links(html, link=SHOW_LINK):
+    """Rewrite wiki links to point to html show function (like show
+    function itself does) or, with TEXT_LINK, to text.html attachments,
+    relative to article's text.html attachment
+
+    >>> rewrite_links('<a href="/wiki/A_b">A b</a>')
+    '<a href="../_design/w/_show/html/A%20b">A b</a>'
+    >>> rewrite_links('<a href="/wiki/A_b#c">A b</a>', TEXT_LINK)
+    '<a href="../A%20b/text.html#c">A b</a>'
+
+    """
+    return LINK_RE.sub(lambda m: 'href="%s"' % link_target(m.group(1), link), html)
+
+
+class Compressor:
+    def __init__(self, codec, level=None, dictionary=None):
+        self.codec = codec
+        self.attachment = PARSE_ATTACHMENTS[codec]
+        self.content_type = CONTENT_TYPES[codec]
+        if codec == "zstd":
+            import zstandard
+
+            self.dictionary = dictionary
+            self.zstd = zstandard.ZstdCompressor(
+                level=level or 9, dict_data=dictionary, write_content_size=True
+            )
+        else:
+            self.level = level or 6
+
+    def compress(self, data):
+        if self.codec == "zstd":
+            return self.zstd.compress(data)
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+
+def compress_doc(doc, compressor):
+    """Move article HTML and large parse fields of doc to attachments"""
+    parse = doc["parse"]
+    rest = {
+        name: value for name, value in parse.items() if name not in INLINE_PARSE_FIELDS
+    }
+    text = rest.pop("text", {}).get("*", "")
+    doc["parse"] = {name: parse[name] for name in INLINE_PARSE_FIELDS if name in parse}
+    data = compressor.compress(json.dumps(rest).encode("utf-8"))
+    doc["_attachments"] = {
+        TEXT_ATTACHMENT: text_attachment(text),
+        compressor.attachment: {
+            "content_type": compressor.content_type,
+            "data": base64.b64encode(data).decode("ascii"),
+        },
+    }
+    return doc
+
+
+def text_attachment(text, link=SHOW_LINK):
+    return {
+        "content_type": "text/html;charset=utf-8",
+        "data": base64.b64encode(rewrite_links(text, link).encode("utf-8")).decode(
+            "ascii"
+        ),
+    }
+
+
+def prerender_doc(doc):
+    """Move article HTML of doc to text.html attachment, with links
+    rewritten to text.html of other articles, keep other parse fields inline
+
+    >>> doc = prerender_doc({'parse': {'title': 'A', 'text': {'*': '<p>A</p>'}}})
+    >>> doc['parse'], list(doc['_attachments']), is_compressed(doc)
+    ({'title': 'A'}, ['text.html'], True)
+
+    """
+    text = doc["parse"].pop("text", {}).get("*", "")
+    doc.setdefault("_attachments", {})[TEXT_ATTACHMENT] = text_attachment(
+        text, TEXT_LINK
+    )
+    return doc
+
+
+def stored_doc(doc, compressor=None, prerender=False):
+    """Parse result doc in the form it is saved in: compressed with
+    compressor if given, else prerendered if prerender is True, else as is
+    """
+    if compressor:
+        return compress_doc(doc, compressor)
+    if prerender:
+        return prerender_doc(doc)
+    return doc
+
+
+def is_compressed(doc):
+    return "text" not in doc.get("parse", {}) and TEXT_ATTACHMENT in doc.get(
+        "_attachments", {}
+    )
+
+
+def load_parse(db, doc):
+    """Return full parse result for document doc, which may be compressed.
+    Article HTML of compressed document has links rewritten
+    (see rewrite_links)
+    """
+    if not is_compressed(doc):
+        return doc["parse"]
+    parse = dict(doc["parse"])
+    attachments = doc["_attachments"]
+    for codec, name in PARSE_ATTACHMENTS.items():
+        if name in attachments:
+            data = db.get_attachment(doc, name).read()
+            if codec == "zstd":
+                data = zstd_decompress(db, data)
+            else:
+                data = gzip.decompress(data)
+            parse.update(json.loads(data))
+    text = db.get_attachment(doc, TEXT_ATTACHMENT).read().decode("utf-8")
+    parse["text"] = {"*": text}
+    return parse
+
+
+_zstd_dicts = {}
+
+
+def zstd_decompress(db, data):
+    import zstandard
+
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    dictionary = None
+    if dict_id:
+        key = (db.name, dict_id)
+        if key not in _zstd_dicts:
+            dict_data = db.get_attachment("_design/w", ZSTD_DICT_ATTACHMENT % dict_id)
+            _zstd_dicts[key] = zstandard.ZstdCompressionDict(dict_data.read())
+        dictionary = _zstd_dicts[key]
+    return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data)
+
+
+def load_zstd_dict(path):
+    import zstandard
+
+    with open(path, "rb") as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+
+def save_zstd_dict(db, dictionary):
+    """Store dictionary in design document so that
+    documents compressed with it can be read
+    """
+    name = ZSTD_DICT_ATTACHMENT % dictionary.dict_id()
+    design_doc = db.get("_design/w", {})
+    if name not in design_doc.get("_attachments", {}):
+        db.put_attachment(
+            design_doc, dictionary.as_bytes(), name, "application/octet-stream"
+        )
@@ -0,0 +1,124 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+
+
+class BloomFilter:
+    """Fixed size set of strings that may report false positives.
+    Size is chosen so that false positive rate stays at error_rate
+    until capacity strings are added.
+
+    >>> bloom = BloomFilter(capacity=100)
+    >>> bloom.add('A')
+    >>> 'A' in bloom, 'B' in bloom
+    (True, False)
+
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key)
+        )
+
+
+class SeenTitles:
+    """Titles seen during scrape session. Membership is checked
+    with a Bloom filter first, so memory use doesn't grow with
+    the number of titles; titles are also kept in an SQLite database
+    on disk to tell true positives from false ones.
+
+    If path is given, database is kept after close and titles
+    marked as done are loaded again when it's reopened, so that
+    resumed session skips them. Titles that were seen but not done
+    (e.g. because scrape was interrupted) are forgotten.
+    Otherwise titles are kept in a temporary file removed on close.
+
+    >>> seen = SeenTitles()
+    >>> seen.add('A'), seen.add('B'), seen.add('A')
+    (False, False, True)
+    >>> seen.close()
+
+    """
+
+    def __init__(
+        self, path=None, capacity=1000000, error_rate=0.001, commit_every=1000
+    ):
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.temporary = path is None
+        if self.temporary:
+            fd, path = tempfile.mkstemp(prefix="mwscrape-seen-", suffix=".sqlite")
+            os.close(fd)
+        self.path = path
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+        # titles are added by page source and marked done by scraper threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen "
+            "(title TEXT PRIMARY KEY, done INTEGER NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute("DELETE FROM seen WHERE done = 0")
+        self.conn.commit()
+        for (title,) in self.conn.execute("SELECT title FROM seen"):
+            self.bloom.add(title)
+
+    def add(self, title):
+        """Add title, return True if it was already seen"""
+        with self.lock:
+            if title in self.bloom:
+                found = self.conn.execute(
+                    "SELECT 1 FROM seen WHERE title = ?", (title,)
+                ).fetchone()
+                if found:
+                    return True
+            self.bloom.add(title)
+            self.conn.execute("INSERT INTO seen (title) VALUES (?)", (title,))
+            self.changed()
+            return False
+
+    def done(self, title):
+        """Mark title as handled, so it stays seen in resumed session"""
+        if self.temporary:
+            return
+        with self.lock:
+            self.conn.execute("UPDATE seen SET done = 1 WHERE title = ?", (title,))
+            self.changed()
+
+    def changed(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+            if self.temporary:
+                os.remove(self.path)
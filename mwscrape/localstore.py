@@ -0,0 +1,302 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Local SQLite database file that stands in for CouchDB server,
+implementing the subset of couchdb.Server and couchdb.Database
+interface used by the scraper and raising the same exceptions.
+Documents have single revision, saving document with stale revision
+fails with couchdb.ResourceConflict. Like in CouchDB, attachments
+of compressible types are stored compressed.
+"""
+
+import base64
+import io
+import json
+import sqlite3
+import threading
+import uuid
+import zlib
+
+from contextlib import contextmanager
+
+import couchdb
+import couchdb.client
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dbs (name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS docs (
+  db TEXT NOT NULL,
+  id TEXT NOT NULL,
+  rev TEXT NOT NULL,
+  body TEXT NOT NULL,
+  parsed INTEGER NOT NULL,
+  revid INTEGER,
+  aliases TEXT,
+  profile TEXT,
+  PRIMARY KEY (db, id)
+);
+CREATE TABLE IF NOT EXISTS attachments (
+  db TEXT NOT NULL,
+  id TEXT NOT NULL,
+  name TEXT NOT NULL,
+  deflated INTEGER NOT NULL,
+  data BLOB NOT NULL,
+  PRIMARY KEY (db, id, name)
+);
+"""
+
+
+def is_compressible(content_type):
+    # same as CouchDB's default attachments.compressible_types
+    return content_type.startswith("text/") or content_type in (
+        "application/javascript",
+        "application/json",
+        "application/xml",
+    )
+
+
+def new_rev(rev):
+    """
+    >>> new_rev(None)[:2], new_rev('1-abc')[:2]
+    ('1-', '2-')
+
+    """
+    generation = int(rev.split("-", 1)[0]) if rev else 0
+    return "%d-%s" % (generation + 1, uuid.uuid4().hex)
+
+
+class LocalServer:
+    def __init__(self, path):
+        self.path = path
+        # partition workers may write to the same file
+        self.conn = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(docs)")]
+        if "profile" not in columns:
+            # file made before parse profiles
+            try:
+                self.conn.execute("ALTER TABLE docs ADD COLUMN profile TEXT")
+            except sqlite3.OperationalError:
+                # added by another process meanwhile
+                pass
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return "<%s %r>" % (type(self).__name__, self.path)
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction, holds database write lock from the start
+        so that revisions read in it can't be changed by other processes
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def __contains__(self, name):
+        with self.lock:
+            found = self.conn.execute(
+                "SELECT 1 FROM dbs WHERE name = ?", (name,)
+            ).fetchone()
+        return found is not None
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise couchdb.ResourceNotFound(("not_found", "Database does not exist."))
+        return LocalDatabase(self, name)
+
+    def create(self, name):
+        with self.transaction() as conn:
+            try:
+                conn.execute("INSERT INTO dbs (name) VALUES (?)", (name,))
+            except sqlite3.IntegrityError:
+                raise couchdb.PreconditionFailed(
+                    ("file_exists", "The database could not be created.")
+                )
+        return LocalDatabase(self, name)
+
+
+class LocalDatabase:
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+
+    def __repr__(self):
+        return "<%s %r>" % (type(self).__name__, self.name)
+
+    def __contains__(self, doc_id):
+        return self.get(doc_id) is not None
+
+    def __getitem__(self, doc_id):
+        doc = self.get(doc_id)
+        if doc is None:
+            raise couchdb.ResourceNotFound(("not_found", "missing"))
+        return doc
+
+    def get(self, doc_id, default=None):
+        with self.server.lock:
+            row = self.server.conn.execute(
+                "SELECT rev, body FROM docs WHERE db = ? AND id = ?",
+                (self.name, doc_id),
+            ).fetchone()
+        if row is None:
+            return default
+        doc = json.loads(row[1])
+        doc["_id"] = doc_id
+        doc["_rev"] = row[0]
+        return couchdb.client.Document(doc)
+
+    def __setitem__(self, doc_id, doc):
+        doc["_id"] = doc_id
+        doc["_rev"] = self.bulk_docs(
+            [json.dumps(doc).encode("utf-8")], raise_error=True
+        )[0]
+
+    def __delitem__(self, doc_id):
+        with self.server.transaction() as conn:
+            deleted = conn.execute(
+                "DELETE FROM docs WHERE db = ? AND id = ?", (self.name, doc_id)
+            ).rowcount
+            conn.execute(
+                "DELETE FROM attachments WHERE db = ? AND id = ?", (self.name, doc_id)
+            )
+        if not deleted:
+            raise couchdb.ResourceNotFound(("not_found", "missing"))
+
+    def bulk_docs(self, encoded_docs, raise_error=False):
+        """Save JSON encoded documents in one transaction.
+        Returns list of new revisions or exceptions, one per document
+        """
+        results = []
+        with self.server.transaction() as conn:
+            for encoded in encoded_docs:
+                doc = json.loads(encoded)
+                doc_id = doc["_id"]
+                row = conn.execute(
+                    "SELECT rev FROM docs WHERE db = ? AND id = ?", (self.name, doc_id)
+                ).fetchone()
+                current_rev = row[0] if row else None
+                if doc.get("_rev") != current_rev:
+                    error = couchdb.ResourceConflict(
+                        ("conflict", "Document update conflict.")
+                    )
+                    if raise_error:
+                        raise error
+                    results.append(error)
+                    continue
+                rev = new_rev(current_rev)
+                if "_attachments" in doc or row:
+                    encoded = self.save_attachments(conn, doc_id, doc, encoded)
+                parse = doc.get("parse")
+                conn.execute(
+                    "INSERT OR REPLACE INTO docs "
+                    "(db, id, rev, body, parsed, revid, aliases, profile) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        self.name,
+                        doc_id,
+                        rev,
+                        # _id and _rev in stored body are ignored
+                        encoded.decode("utf-8"),
+                        parse is not None,
+                        parse.get("revid") if parse else None,
+                        json.dumps(doc.get("aliases", [])),
+                        doc.get("parse_profile"),
+                    ),
+                )
+                results.append(rev)
+        return results
+
+    def save_attachments(self, conn, doc_id, doc, encoded):
+        """Store attachments with data, keep stubs, delete attachments
+        not listed in the document. Returns encoded document
+        with attachment stubs only
+        """
+        attachments = doc.get("_attachments", {})
+        names = list(attachments)
+        conn.execute(
+            "DELETE FROM attachments WHERE db = ? AND id = ? AND name NOT IN (%s)"
+            % ",".join("?" * len(names)),
+            [self.name, doc_id] + names,
+        )
+        if not any("data" in att for att in attachments.values()):
+            return encoded
+        for name, att in attachments.items():
+            if "data" not in att:
+                continue
+            data = base64.b64decode(att.pop("data"))
+            att["length"] = len(data)
+            att["stub"] = True
+            deflated = is_compressible(att["content_type"])
+            if deflated:
+                data = zlib.compress(data)
+            conn.execute(
+                "INSERT OR REPLACE INTO attachments (db, id, name, deflated, data) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self.name, doc_id, name, deflated, data),
+            )
+        return json.dumps(doc).encode("utf-8")
+
+    def get_attachment(self, id_or_doc, filename, default=None):
+        doc_id = id_or_doc if isinstance(id_or_doc, str) else id_or_doc["_id"]
+        with self.server.lock:
+            row = self.server.conn.execute(
+                "SELECT deflated, data FROM attachments "
+                "WHERE db = ? AND id = ? AND name = ?",
+                (self.name, doc_id, filename),
+            ).fetchone()
+        if row is None:
+            return default
+        deflated, data = row
+        return io.BytesIO(zlib.decompress(data) if deflated else data)
+
+    def put_attachment(self, doc, content, filename, content_type):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        elif hasattr(content, "read"):
+            content = content.read()
+        attachments = doc.setdefault("_attachments", {})
+        attachments[filename] = {
+            "content_type": content_type,
+            "data": base64.b64encode(content).decode("ascii"),
+        }
+        self[doc["_id"]] = doc
+        attachments[filename] = {
+            "content_type": content_type,
+            "length": len(content),
+            "stub": True,
+        }
+
+    def view(self, name, keys=None):
+        """Only revid view (see mwscrape.scrape.REVID_MAP_FUNC)
+        is available, and only with keys
+        """
+        if name != "w/revid" or keys is None:
+            raise couchdb.ResourceNotFound(("not_found", "missing_named_view"))
+        rows = []
+        with self.server.lock:
+            for key in keys:
+                row = self.server.conn.execute(
+                    "SELECT rev, revid, aliases, profile FROM docs "
+                    "WHERE db = ? AND id = ? AND parsed",
+                    (self.name, key),
+                ).fetchone()
+                if row is None:
+                    continue
+                value = {"rev": row[0], "revid": row[1], "aliases": json.loads(row[2])}
+                if row[3] is not None:
+                    value["profile"] = row[3]
+                rows.append(couchdb.client.Row(id=key, key=key, value=value))
+        return rows
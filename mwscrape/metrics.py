@@ -0,0 +1,286 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Scraper instrumentation: page counts by outcome, latency histograms
+and in-flight requests by stage (e.g. parse, couch_put) and gauges
+such as queue depth. Metrics can be served in Prometheus text format
+and printed as a periodic summary line.
+"""
+
+import bisect
+import collections
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """
+    >>> h = Histogram()
+    >>> for seconds in (0.02, 0.03, 0.2, 4):
+    ...     h.observe(seconds)
+    >>> h.count, h.quantile(0.5), h.quantile(0.95)
+    (4, 0.05, 5)
+
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket with q-th quantile"""
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.pages = collections.Counter()
+        self.stages = collections.OrderedDict()
+        self.errors = collections.Counter()
+        self.in_flight = collections.Counter()
+        self.gauges = collections.OrderedDict()
+
+    def inc(self, outcome, site=None):
+        """Count page processed with given outcome,
+        labeled with site if given
+        """
+        with self.lock:
+            self.pages[(outcome, site)] += 1
+
+    def observe(self, stage, seconds, error=False):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+            if error:
+                self.errors[stage] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        """Measure time of stage in with block,
+        count it as in flight meanwhile
+        """
+        with self.lock:
+            self.in_flight[stage] += 1
+        t0 = time.time()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            with self.lock:
+                self.in_flight[stage] -= 1
+            self.observe(stage, time.time() - t0, error)
+
+    def gauge(self, name, func, site=None):
+        """Report value returned by func as gauge name,
+        labeled with site if given (sites scraped in one process
+        each have their own writer, session etc.)
+        """
+        with self.lock:
+            self.gauges[(name, site)] = func
+
+    def remove_gauges(self, site):
+        """Stop reporting gauges of site"""
+        with self.lock:
+            for key in [key for key in self.gauges if key[1] == site]:
+                del self.gauges[key]
+
+    def gauge_values(self):
+        """List of (name, site, value) for each gauge
+
+        >>> m = Metrics()
+        >>> m.gauge('queue_size', lambda: 1)
+        >>> m.gauge('queue_size', lambda: 2, site='a.org')
+        >>> m.gauge('queue_size', lambda: 3, site='b.org')
+        >>> m.remove_gauges('b.org')
+        >>> m.gauge_values()
+        [('queue_size', None, 1), ('queue_size', 'a.org', 2)]
+
+        """
+        with self.lock:
+            gauges = list(self.gauges.items())
+        values = []
+        for (name, site), func in gauges:
+            try:
+                values.append((name, site, func()))
+            except Exception:
+                continue
+        return values
+
+    def render(self):
+        """Metrics in Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            lines.append("# TYPE mwscrape_pages_total counter")
+            for (outcome, site), count in sorted(
+                self.pages.items(), key=lambda item: (item[0][0], item[0][1] or "")
+            ):
+                if site is None:
+                    labels = 'outcome="%s"' % outcome
+                else:
+                    labels = 'outcome="%s",site="%s"' % (outcome, site)
+                lines.append("mwscrape_pages_total{%s} %d" % (labels, count))
+            lines.append("# TYPE mwscrape_stage_seconds histogram")
+            for stage, histogram in self.stages.items():
+                cumulative = 0
+                bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        'mwscrape_stage_seconds_bucket{stage="%s",le="%s"} %d'
+                        % (stage, bound, cumulative)
+                    )
+                lines.append(
+                    'mwscrape_stage_seconds_sum{stage="%s"} %f' % (stage, histogram.sum)
+                )
+                lines.append(
+                    'mwscrape_stage_seconds_count{stage="%s"} %d'
+                    % (stage, histogram.count)
+                )
+            lines.append("# TYPE mwscrape_stage_errors_total counter")
+            for stage in self.stages:
+                lines.append(
+                    'mwscrape_stage_errors_total{stage="%s"} %d'
+                    % (stage, self.errors[stage])
+                )
+            lines.append("# TYPE mwscrape_in_flight gauge")
+            for stage in self.stages:
+                lines.append(
+                    'mwscrape_in_flight{stage="%s"} %d' % (stage, self.in_flight[stage])
+                )
+        by_name = collections.OrderedDict()
+        for name, site, value in self.gauge_values():
+            by_name.setdefault(name, []).append((site, value))
+        for name, values in by_name.items():
+            lines.append("# TYPE mwscrape_%s gauge" % name)
+            for site, value in values:
+                if site is None:
+                    lines.append("mwscrape_%s %s" % (name, value))
+                else:
+                    lines.append('mwscrape_%s{site="%s"} %s' % (name, site, value))
+        return "\n".join(lines) + "\n"
+
+    def page_counts(self, site=None):
+        """Page counts by outcome, of given site or of all sites
+
+        >>> m = Metrics()
+        >>> m.inc('new', site='a.org')
+        >>> m.inc('new', site='b.org')
+        >>> m.inc('error', site='b.org')
+        >>> sorted(m.page_counts().items())
+        [('error', 1), ('new', 2)]
+        >>> sorted(m.page_counts('a.org').items())
+        [('new', 1)]
+
+        """
+        counts = collections.Counter()
+        with self.lock:
+            for (outcome, page_site), count in self.pages.items():
+                if site is None or page_site == site:
+                    counts[outcome] += count
+        return counts
+
+    def summary(self, since=None, pages_before=0, site=None):
+        """One line summary. Page rate is computed
+        from pages_before pages done at since time.
+        If site is given, pages and gauges are only those of site
+        """
+        now = time.time()
+        counts = self.page_counts(site)
+        total = sum(counts.values())
+        elapsed = now - (since or self.started)
+        parts = [
+            "%.1f pages/s" % ((total - pages_before) / elapsed if elapsed else 0),
+            ", ".join(
+                "%s %d" % (outcome.replace("_", " "), count)
+                for outcome, count in sorted(counts.items())
+            )
+            or "no pages",
+        ]
+        with self.lock:
+            for stage, histogram in self.stages.items():
+                parts.append(
+                    "%s %d (%d in flight, avg %.3fs, p95 %ss, %d errors)"
+                    % (
+                        stage,
+                        histogram.count,
+                        self.in_flight[stage],
+                        histogram.sum / histogram.count if histogram.count else 0,
+                        histogram.quantile(0.95),
+                        self.errors[stage],
+                    )
+                )
+        for name, gauge_site, value in self.gauge_values():
+            if site is not None and gauge_site != site:
+                continue
+            if gauge_site is None:
+                parts.append("%s %s" % (name.replace("_", " "), value))
+            else:
+                parts.append("%s [%s] %s" % (name.replace("_", " "), gauge_site, value))
+        return "; ".join(parts), now, total
+
+    def report_every(self, interval):
+        """Print summary every interval seconds in daemon thread"""
+
+        def run():
+            since, pages_before = None, 0
+            while True:
+                time.sleep(interval)
+                line, since, pages_before = self.summary(since, pages_before)
+                print("[metrics] %s" % line)
+
+        threading.Thread(target=run, name="metrics-report", daemon=True).start()
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve metrics over HTTP in daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(
+            target=server.serve_forever, name="metrics-server", daemon=True
+        ).start()
+        return server
+
+
+# scraper code reports to this instance
+metrics = Metrics()
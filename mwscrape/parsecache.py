@@ -0,0 +1,187 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+
+from .compress import compress_doc, prerender_doc
+from .rawdoc import RawDoc, raw_doc
+
+
+class ParseCache:
+    """Parse API responses kept on disk, keyed by title and revision,
+    so that scraping the same wiki again (e.g. into a new database)
+    doesn't request pages whose revision didn't change from the wiki.
+    Responses are stored zlib compressed in SQLite database at path,
+    which several scraper processes may share. Only the latest revision
+    of each title is kept, and when total size of stored responses
+    exceeds max_bytes, least recently used ones are removed. Responses
+    are only used for the same parse profile they were requested with.
+
+    >>> cache = ParseCache(':memory:')
+    >>> cache.put('A', 1, b'{"parse": {}}')
+    >>> cache.get('A', 1), cache.get('A', 2), cache.hits, cache.misses
+    (b'{"parse": {}}', None, 1, 1)
+    >>> cache.close()
+
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024**3, profile="full", max_pending=1000):
+        self.max_bytes = max_bytes
+        self.profile = profile
+        self.max_pending = max_pending
+        self.hits = 0
+        self.misses = 0
+        # last use time of responses read since last write,
+        # saved with the next write so that reads don't take write lock
+        self.used = {}
+        self.lock = threading.Lock()
+        # used by scraper threads, and possibly by other scraper processes,
+        # each write is a transaction of its own
+        self.conn = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction():
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS parse "
+                "(title TEXT, revid INTEGER, data BLOB, size INTEGER, used INTEGER, "
+                "profile TEXT NOT NULL DEFAULT 'full', PRIMARY KEY (title, revid))"
+            )
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(parse)")]
+            if "profile" not in columns:
+                # cache made before parse profiles has full responses only
+                self.conn.execute(
+                    "ALTER TABLE parse ADD COLUMN profile TEXT NOT NULL DEFAULT 'full'"
+                )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS parse_used ON parse (used)")
+            # total size of stored responses
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO stats (name, value) "
+                "SELECT 'size', COALESCE(SUM(size), 0) FROM parse"
+            )
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction, holds database write lock from the start"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def get(self, title, revid):
+        """Return response body for given revision of title, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM parse WHERE title = ? AND revid = ? AND profile = ?",
+                (title, revid, self.profile),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.used[(title, revid)] = time.time()
+            if len(self.used) >= self.max_pending:
+                with self.transaction():
+                    self.save_used()
+        return zlib.decompress(row[0])
+
+    def put(self, title, revid, body):
+        data = zlib.compress(body)
+        with self.lock, self.transaction():
+            self.save_used()
+            (old_size,) = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM parse WHERE title = ?", (title,)
+            ).fetchone()
+            # older revisions won't be needed again
+            self.conn.execute("DELETE FROM parse WHERE title = ?", (title,))
+            self.conn.execute(
+                "INSERT INTO parse (title, revid, data, size, used, profile) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (title, revid, data, len(data), time.time(), self.profile),
+            )
+            if self.add_size(len(data) - old_size) > self.max_bytes:
+                self.evict()
+
+    def save_used(self):
+        self.conn.executemany(
+            "UPDATE parse SET used = ? WHERE title = ? AND revid = ?",
+            [(used, title, revid) for (title, revid), used in self.used.items()],
+        )
+        self.used = {}
+
+    def add_size(self, delta):
+        """Add delta to total size, return new total"""
+        self.conn.execute(
+            "UPDATE stats SET value = value + ? WHERE name = 'size'", (delta,)
+        )
+        (size,) = self.conn.execute(
+            "SELECT value FROM stats WHERE name = 'size'"
+        ).fetchone()
+        return size
+
+    def evict(self):
+        """Remove least recently used responses until
+        total size is 10% below the limit
+        """
+        (size,) = self.conn.execute(
+            "SELECT value FROM stats WHERE name = 'size'"
+        ).fetchone()
+        target = self.max_bytes * 0.9
+        evicted = []
+        removed = 0
+        for title, revid, row_size in self.conn.execute(
+            "SELECT title, revid, size FROM parse ORDER BY used"
+        ):
+            if size - removed <= target:
+                break
+            evicted.append((title, revid))
+            removed += row_size
+        self.conn.executemany(
+            "DELETE FROM parse WHERE title = ? AND revid = ?", evicted
+        )
+        self.add_size(-removed)
+
+    def get_doc(self, title, revid, compressor=None, prerender=False):
+        """Return article document for given revision of title
+        made of cached response, compressed if compressor is given
+        or prerendered if prerender is True, or None if it's not cached
+        """
+        body = self.get(title, revid)
+        if body is None:
+            return None
+        if compressor:
+            return compress_doc(json.loads(body), compressor)
+        if prerender:
+            return prerender_doc(json.loads(body))
+        return raw_doc(body)
+
+    def put_doc(self, title, doc):
+        """Cache parse response doc (RawDoc or decoded response)"""
+        if isinstance(doc, RawDoc):
+            body = doc.body
+        else:
+            body = json.dumps(doc).encode("utf-8")
+        self.put(title, doc["parse"]["revid"], body)
+
+    def close(self):
+        with self.lock:
+            if self.used:
+                with self.transaction():
+                    self.save_used()
+            self.conn.close()
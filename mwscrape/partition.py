@@ -0,0 +1,300 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import subprocess
+import sys
+import time
+
+from datetime import datetime
+
+import couchdb
+
+# scrape options passed on to worker processes
+WORKER_OPTIONS = (
+    "site_path",
+    "site_ext",
+    "timeout",
+    "namespace",
+    "delete_not_found",
+    "speed",
+    "engine",
+    "connections",
+    "delay",
+    "max_rps",
+    "adaptive",
+    "max_concurrency",
+    "maxlag",
+    "redirect_map",
+    "seen_dir",
+    "parse_cache",
+    "parse_cache_mb",
+    "parse_profile",
+    "prerender",
+    "compress",
+    "compress_level",
+    "zstd_dict",
+    "user_agent",
+    "metrics_interval",
+    "session_flush_interval",
+    "bulk_docs",
+    "bulk_mb",
+    "bulk_delay",
+)
+
+# options whose value is given to each worker with partition
+# number appended, so that workers don't overwrite each other's files
+PER_WORKER_OPTIONS = ("profile",)
+
+COUNT_NAMES = (
+    "new",
+    "updated",
+    "merged",
+    "up_to_date",
+    "not_found",
+    "failed_redirect",
+    "error",
+)
+
+
+# random title sample requests made to estimate partition bounds
+SAMPLE_REQUESTS = 10
+
+# fewer sampled titles per partition than this don't tell bounds
+# well enough (e.g. range is narrow, or site is small)
+MIN_SAMPLES_PER_PARTITION = 20
+
+
+def partition_bounds(site, count, namespace=0, start=None, end=None, prefix=""):
+    """Split titles in namespace from start to end into up to count ranges
+    with about the same number of pages. Returns list of range bounds,
+    one more than number of ranges, with start first and end last
+    (None means range is open). Bounds are estimated from a random
+    sample of titles, so pages don't have to be listed. If range has
+    too few sampled titles, titles are listed, up to API limit
+    per request, and only first title of each response is kept.
+    Titles returned by API start with namespace prefix, bounds
+    don't, like start and end, since allpages from and to expect
+    titles without it
+    """
+    titles = sample_titles(site, namespace, start, end, prefix)
+    if len(titles) < count * MIN_SAMPLES_PER_PARTITION:
+        titles = batch_starts(site, namespace, start, end, prefix)
+    return quantile_bounds(titles, count, start, end)
+
+
+def title_key(title):
+    # MediaWiki sorts titles with underscores for spaces
+    return title.replace(" ", "_")
+
+
+def sample_titles(site, namespace, start=None, end=None, prefix=""):
+    """Sorted random sample of titles in namespace from start to end,
+    without namespace prefix
+    """
+    titles = set()
+    for _ in range(SAMPLE_REQUESTS):
+        result = site.get(
+            "query",
+            list="random",
+            rnnamespace=namespace,
+            rnfilterredir="all",
+            rnlimit="max",
+        )
+        titles.update(
+            item["title"][len(prefix) :] for item in result["query"]["random"]
+        )
+    return sorted(
+        (
+            title
+            for title in titles
+            if (not start or title_key(title) >= title_key(start))
+            and (not end or title_key(title) < title_key(end))
+        ),
+        key=title_key,
+    )
+
+
+def batch_starts(site, namespace, start=None, end=None, prefix=""):
+    """First title of each API limit titles in namespace from start to end,
+    without namespace prefix
+    """
+    kwargs = dict(list="allpages", apnamespace=namespace, aplimit="max")
+    if start:
+        kwargs["apfrom"] = start
+    if end:
+        kwargs["apto"] = end
+    starts = []
+    while True:
+        result = site.get("query", **kwargs)
+        titles = [item["title"] for item in result["query"]["allpages"]]
+        if titles:
+            starts.append(titles[0][len(prefix) :])
+        if not result.get("continue"):
+            break
+        kwargs.update(result["continue"])
+    return starts
+
+
+def quantile_bounds(titles, count, start=None, end=None):
+    """Bounds of up to count ranges from start to end with about
+    the same number of sorted titles in each
+
+    >>> quantile_bounds(['A', 'B', 'C', 'D', 'E', 'F'], 3)
+    [None, 'C', 'E', None]
+    >>> quantile_bounds(['A', 'A', 'B'], 3, end='C')
+    [None, 'A', 'B', 'C']
+    >>> quantile_bounds([], 3, 'A')
+    ['A', None]
+
+    """
+    bounds = [start]
+    for i in range(1, count):
+        if not titles:
+            break
+        bound = titles[i * len(titles) // count]
+        if bound != bounds[-1]:
+            bounds.append(bound)
+    bounds.append(end)
+    return bounds
+
+
+def create_partitions(sessions_db, session_id, session_doc, bounds):
+    """Create worker session for each range between bounds,
+    record them in coordinator session_doc
+    """
+    partitions = []
+    for i, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        worker_id = "%s-%d" % (session_id, i)
+        sessions_db[worker_id] = {
+            "created_at": datetime.utcnow().isoformat(),
+            "site": session_doc["site"],
+            "db_name": session_doc["db_name"],
+            "descending": False,
+            "namespaces": session_doc.get("namespaces", [0]),
+            "parse_profile": session_doc.get("parse_profile", "full"),
+            "parent": session_id,
+            "partition": i,
+            "start": start,
+            "end": end,
+            "last_page_name": start,
+        }
+        partitions.append({"session_id": worker_id, "start": start, "end": end})
+    session_doc["partitions"] = partitions
+    sessions_db[session_id] = session_doc
+
+
+def worker_argv(args, worker_id, partition):
+    argv = [
+        sys.executable,
+        "-m",
+        "mwscrape.scrape",
+        "--couch",
+        args.couch,
+        "--sessions-db-name",
+        args.sessions_db_name,
+        "--resume",
+        worker_id,
+    ]
+    for name in WORKER_OPTIONS:
+        value = getattr(args, name)
+        option = "--" + name.replace("_", "-")
+        if value is True:
+            argv.append(option)
+        elif isinstance(value, list):
+            argv.extend((option, ",".join(str(item) for item in value)))
+        elif value is not None and value is not False:
+            argv.extend((option, str(value)))
+    for name in PER_WORKER_OPTIONS:
+        value = getattr(args, name)
+        if value:
+            option = "--" + name.replace("_", "-")
+            argv.extend((option, "%s-%d" % (value, partition)))
+    return argv
+
+
+def progress(sessions_db, session_id, partitions):
+    """Sum up counts of worker sessions and save them
+    in coordinator session, return totals
+    """
+    totals = dict.fromkeys(COUNT_NAMES, 0)
+    totals["completed"] = 0
+    for partition in partitions:
+        worker_doc = sessions_db.get(partition["session_id"], {})
+        for count_name in COUNT_NAMES:
+            totals[count_name] += worker_doc.get(count_name, 0)
+        if worker_doc.get("completed_at"):
+            totals["completed"] += 1
+    while True:
+        session_doc = sessions_db[session_id]
+        session_doc.update(totals)
+        session_doc["updated_at"] = datetime.utcnow().isoformat()
+        try:
+            sessions_db[session_id] = session_doc
+        except couchdb.ResourceConflict:
+            continue
+        return totals
+
+
+def coordinate(args, sessions_db, session_id, partitions, selected=None):
+    """Run a worker process for each selected partition
+    that is not completed yet, report progress until they exit
+    """
+    workers = {}
+    for i, partition in enumerate(partitions):
+        if selected is not None and i not in selected:
+            continue
+        worker_id = partition["session_id"]
+        if sessions_db[worker_id].get("completed_at"):
+            print("Partition %d (%s) is already completed" % (i, worker_id))
+            continue
+        print(
+            "Starting partition %d (%s): %s - %s"
+            % (i, worker_id, partition["start"] or "", partition["end"] or "")
+        )
+        workers[i] = subprocess.Popen(worker_argv(args, worker_id, i))
+
+    failed = []
+    last_report = time.time()
+    try:
+        while workers:
+            time.sleep(1)
+            exited = False
+            for i, process in list(workers.items()):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                exited = True
+                del workers[i]
+                if returncode != 0:
+                    print("Partition %d failed with exit code %s" % (i, returncode))
+                    failed.append(i)
+            if exited or time.time() - last_report >= args.session_flush_interval:
+                report(progress(sessions_db, session_id, partitions), len(partitions))
+                last_report = time.time()
+    except KeyboardInterrupt:
+        # workers got it too, let them save what they have
+        for process in workers.values():
+            process.wait()
+        raise
+    if failed:
+        raise SystemExit(1)
+
+
+def report(totals, partition_count):
+    print(
+        "Partitions completed %d/%d, new %d, updated %d, merged %d, "
+        "up to date %d, not found %d, errors %d"
+        % (
+            totals["completed"],
+            partition_count,
+            totals["new"],
+            totals["updated"],
+            totals["merged"],
+            totals["up_to_date"],
+            totals["not_found"],
+            totals["error"],
+        )
+    )
@@ -0,0 +1,118 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Prerender articles of a database scraped without --prerender:
+move article HTML of each document, with links rewritten,
+to text.html attachment (see mwscrape.compress.prerender_doc).
+Documents are found with a view that only has those not prerendered
+yet, so interrupted run simply continues where it stopped.
+"""
+
+import argparse
+import collections
+import time
+
+from datetime import timedelta
+
+from .compress import prerender_doc
+from .profiling import profile_to
+from .resolveconflicts import mkclient
+from .scrape import batches, set_show_func
+
+# own design document, so that adding the view doesn't rebuild
+# indexes of views in _design/w
+DESIGN_DOC_ID = "_design/mwprerender"
+
+NOPRERENDER_MAP_FUNC = r"""
+function(doc)
+{
+  if (doc.parse && doc.parse.text) {
+    emit(doc._id, null);
+  }
+}
+"""
+
+
+def parse_args():
+    argparser = argparse.ArgumentParser(description=__doc__)
+    argparser.add_argument("couch_url")
+    argparser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=100,
+        help=(
+            "Number of documents to read and save in one request. "
+            "Default: %(default)s"
+        ),
+    )
+    argparser.add_argument("-v", "--verbose", action="store_true")
+    argparser.add_argument(
+        "-p",
+        "--profile",
+        metavar="PREFIX",
+        help=(
+            "Sample stacks of all threads, write profile summary "
+            "to PREFIX.json and collapsed stacks to PREFIX.collapsed"
+        ),
+    )
+    return argparser.parse_args()
+
+
+def set_noprerender_view(db):
+    design_doc = db.get(DESIGN_DOC_ID, {})
+    views = design_doc.get("views", {})
+    if not views.get("noprerender"):
+        views["noprerender"] = {"map": NOPRERENDER_MAP_FUNC}
+        design_doc["views"] = views
+        db[DESIGN_DOC_ID] = design_doc
+
+
+def prerender_batch(db, docs, verbose=False):
+    """Prerender and save docs in one request, return counts
+    of prerendered and failed documents
+    """
+    counts = collections.Counter()
+    for doc in docs:
+        prerender_doc(doc)
+    for success, doc_id, rev_or_exc in db.update(docs):
+        if success:
+            counts["prerendered"] += 1
+            if verbose:
+                print("%s prerendered" % doc_id)
+        else:
+            # most likely updated by scraper meanwhile
+            print("Failed to save %s: %s" % (doc_id, rev_or_exc))
+            counts["failed"] += 1
+    return counts
+
+
+def main():
+    args = parse_args()
+    if args.profile:
+        profile_to(args.profile)
+    db = mkclient(args.couch_url)
+    # show function of older versions can't display prerendered articles
+    set_show_func(db, force=True)
+    set_noprerender_view(db)
+    t0 = time.time()
+    counts = collections.Counter()
+    rows = db.iterview("mwprerender/noprerender", args.batch_size, include_docs=True)
+    for batch in batches(rows, args.batch_size):
+        counts.update(prerender_batch(db, [row.doc for row in batch], args.verbose))
+        print(
+            "Prerendered %d document(s), up to %s"
+            % (counts["prerendered"], batch[-1].id)
+        )
+    print(
+        "Prerendered %d, failed %d document(s)"
+        % (counts["prerendered"], counts["failed"])
+    )
+    print("Done in %s" % timedelta(seconds=int(time.time() - t0)))
+
+
+if __name__ == "__main__":
+    main()
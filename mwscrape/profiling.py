@@ -0,0 +1,217 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Sampling profiler for all threads of the process. Unlike cProfile,
+which only sees the thread it runs in, this sees scraper worker
+threads too. Stack of each thread is sampled at regular intervals,
+samples where thread's CPU clock advanced count as CPU time, others
+as waiting (network I/O, locks, sleep).
+"""
+
+import atexit
+import collections
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+ALIAS_FUNCTIONS = {
+    "merge_aliases",
+    "alias_sort_key",
+    "merge_into_current",
+    "follow_redirects",
+    "target_aliases",
+}
+
+# functions blocking threads are called from, to tell waiting
+# from running when thread CPU clocks are not available
+WAIT_FUNCTIONS = {
+    "wait",
+    "acquire",
+    "sleep",
+    "select",
+    "poll",
+    "readinto",
+    "recv_into",
+    "accept",
+    "join",
+}
+
+
+def code_name(code):
+    return "%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+def thread_group(name):
+    """Name for threads of the same kind
+
+    >>> thread_group('Thread-12 (worker)'), thread_group('ThreadPoolExecutor-0_3')
+    ('Thread (worker)', 'ThreadPoolExecutor')
+
+    """
+    return re.sub(r"-[\d_]+", "", name)
+
+
+def thread_cpu_time(ident):
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+def is_json_code(code):
+    directory, name = os.path.split(code.co_filename)
+    return os.path.basename(directory) == "json" or name == "rawdoc.py"
+
+
+def category(stack, on_cpu):
+    """Categorize sample by what the thread was doing"""
+    if not on_cpu:
+        return "waiting"
+    for code in stack:
+        if code.co_name in ALIAS_FUNCTIONS:
+            return "aliases"
+        if is_json_code(code):
+            return "json"
+    return "cpu"
+
+
+class Sampler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        # wall time and CPU time by (thread group, category, stack)
+        self.wall_time = collections.Counter()
+        self.states = collections.Counter()
+        self.cpu_time = collections.Counter()
+        self.sample_count = 0
+        self.cpu_clocks = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.started = time.time()
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        last_sample = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            # sampling may be delayed by threads holding GIL
+            elapsed, last_sample = now - last_sample, now
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                cpu = thread_cpu_time(ident)
+                last = self.cpu_clocks.get(ident)
+                self.cpu_clocks[ident] = cpu
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                if cpu is None or last is None:
+                    on_cpu = bool(stack) and stack[-1].co_name not in WAIT_FUNCTIONS
+                    cpu_delta = 0
+                else:
+                    cpu_delta = cpu - last
+                    # thread ran at least a quarter of the interval
+                    on_cpu = cpu_delta >= elapsed / 4
+                thread = thread_group(names.get(ident, "Thread"))
+                state = category(stack, on_cpu)
+                key = (thread, state, tuple(stack))
+                self.wall_time[key] += elapsed
+                self.cpu_time[key] += cpu_delta
+                self.states[state] += elapsed
+            self.sample_count += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        """Stacks in collapsed format for flame graph tools,
+        with thread group as root and sample category as leaf,
+        wall time in milliseconds
+        """
+        lines = []
+        for (thread, state, stack), seconds in self.wall_time.items():
+            frames = [thread] + [code_name(code) for code in stack] + [state]
+            stack_line = ";".join(frame.replace(";", ":") for frame in frames)
+            lines.append("%s %d" % (stack_line, round(seconds * 1000)))
+        lines.sort()
+        return lines
+
+    def summary(self, top=50):
+        """Time by sample category and by function, across all threads"""
+        self_wall = collections.Counter()
+        total_wall = collections.Counter()
+        self_cpu = collections.Counter()
+        total_cpu = collections.Counter()
+        for key, wall in self.wall_time.items():
+            _, _, stack = key
+            if not stack:
+                continue
+            cpu = self.cpu_time[key]
+            self_wall[stack[-1]] += wall
+            self_cpu[stack[-1]] += cpu
+            for code in set(stack):
+                total_wall[code] += wall
+                total_cpu[code] += cpu
+        functions = [
+            {
+                "function": code_name(code),
+                "self_seconds": round(self_wall[code], 3),
+                "self_cpu_seconds": round(self_cpu[code], 3),
+                "total_seconds": round(total_wall[code], 3),
+                "total_cpu_seconds": round(total_cpu[code], 3),
+            }
+            for code, _ in total_wall.most_common(top)
+        ]
+        return {
+            "duration": round(time.time() - self.started, 3),
+            "interval": self.interval,
+            "samples": self.sample_count,
+            "thread_seconds": {
+                state: round(seconds, 3) for state, seconds in self.states.most_common()
+            },
+            "threads": sorted({thread for thread, _, _ in self.wall_time}),
+            "functions": functions,
+        }
+
+    def write(self, prefix):
+        with open(prefix + ".json", "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(prefix + ".collapsed", "w") as f:
+            for line in self.collapsed():
+                f.write(line + "\n")
+
+
+def profile_to(prefix, interval=0.01):
+    """Sample all threads until exit, then write summary
+    to prefix.json and collapsed stacks to prefix.collapsed
+    """
+    sampler = Sampler(interval)
+    sampler.start()
+
+    def write():
+        sampler.stop()
+        sampler.write(prefix)
+        thread_seconds = sampler.summary()["thread_seconds"]
+        print(
+            "Profile saved to %s.json and %s.collapsed (thread seconds: %s)"
+            % (
+                prefix,
+                prefix,
+                ", ".join("%s %s" % item for item in thread_seconds.items()),
+            )
+        )
+
+    atexit.register(write)
+    return sampler
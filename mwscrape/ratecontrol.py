@@ -0,0 +1,223 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import threading
+import time
+
+from contextlib import asynccontextmanager, contextmanager
+
+import mwclient
+import requests
+
+
+class RateController:
+    """Limits number of concurrent requests to a site and,
+    optionally, request rate.
+
+    When adaptive, concurrency limit grows by one after each window
+    of requests completed with healthy latency and error rate, and is cut
+    when latency degrades or requests fail. Throttling responses
+    (HTTP 429/503, Retry-After, maxlag) halve the limit and pause
+    all requests for retry-after seconds. Latency is considered degraded
+    when window's average is more than twice the best average seen.
+
+    >>> controller = RateController(
+    ...     adaptive=True, initial_concurrency=2, verbose=False
+    ... )
+    >>> for _ in range(10):
+    ...     assert controller.try_acquire()
+    ...     controller.release(0.1)
+    >>> controller.limit
+    3
+    >>> controller.throttle()
+    >>> controller.limit
+    1
+
+    """
+
+    def __init__(
+        self,
+        max_rate=None,
+        adaptive=False,
+        initial_concurrency=2,
+        min_concurrency=1,
+        max_concurrency=20,
+        max_error_rate=0.05,
+        window=10,
+        verbose=True,
+    ):
+        self.max_rate = max_rate
+        self.adaptive = adaptive
+        self.limit = initial_concurrency if adaptive else max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.verbose = verbose
+        self.active = 0
+        self.tokens = 1.0
+        self.tokens_updated = time.monotonic()
+        self.paused_until = 0
+        self.best_latency = None
+        self.reset_window()
+        self.lock = threading.Condition()
+
+    def reset_window(self):
+        self.window_count = 0
+        self.window_errors = 0
+        self.window_latency = 0.0
+
+    def delay(self):
+        """Seconds to wait before next request may start"""
+        now = time.monotonic()
+        delay = max(0, self.paused_until - now)
+        if self.max_rate:
+            self.tokens = min(
+                max(1.0, self.max_rate),
+                self.tokens + (now - self.tokens_updated) * self.max_rate,
+            )
+            self.tokens_updated = now
+            if self.tokens < 1:
+                delay = max(delay, (1 - self.tokens) / self.max_rate)
+        return delay
+
+    def try_acquire(self):
+        """Start a request if concurrency limit and request rate allow"""
+        with self.lock:
+            if self.active >= self.limit or self.delay() > 0:
+                return False
+            self.active += 1
+            if self.max_rate:
+                self.tokens -= 1
+            return True
+
+    def release(self, latency, error=False):
+        with self.lock:
+            self.active -= 1
+            if self.adaptive:
+                self.window_count += 1
+                self.window_latency += latency
+                if error:
+                    self.window_errors += 1
+                if self.window_count >= max(self.window, self.limit):
+                    self.adapt()
+            self.lock.notify_all()
+
+    def adapt(self):
+        latency = self.window_latency / self.window_count
+        error_rate = self.window_errors / self.window_count
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if error_rate > self.max_error_rate or latency > 2 * self.best_latency:
+            self.set_limit(int(self.limit * 0.75), latency, error_rate)
+        else:
+            self.set_limit(self.limit + 1, latency, error_rate)
+        self.reset_window()
+
+    def set_limit(self, limit, latency=None, error_rate=None):
+        limit = max(self.min_concurrency, min(self.max_concurrency, limit))
+        if limit != self.limit and self.verbose:
+            details = ""
+            if latency is not None:
+                details = " (latency %.2fs, errors %d%%)" % (latency, 100 * error_rate)
+            print("Concurrency %d => %d%s" % (self.limit, limit, details))
+        self.limit = limit
+
+    def throttle(self, retry_after=None):
+        """Site asked to slow down"""
+        with self.lock:
+            if self.adaptive:
+                self.set_limit(self.limit // 2)
+                self.reset_window()
+            if retry_after:
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + retry_after
+                )
+            self.lock.notify_all()
+
+    @contextmanager
+    def slot(self):
+        with self.lock:
+            while not self.try_acquire():
+                self.lock.wait(self.delay() or None)
+        t0 = time.monotonic()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.release(time.monotonic() - t0, error)
+
+    @asynccontextmanager
+    async def async_slot(self):
+        while not self.try_acquire():
+            # controller is shared with threads, so poll
+            # instead of waiting on a threading condition
+            with self.lock:
+                delay = self.delay()
+            await asyncio.sleep(delay or 0.01)
+        t0 = time.monotonic()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.release(time.monotonic() - t0, error)
+
+
+def retry_after(headers, default=5):
+    try:
+        return float(headers.get("retry-after", default))
+    except ValueError:
+        return default
+
+
+class ThrottledSite(mwclient.Site):
+    """mwclient.Site that makes all its HTTP requests
+    through a RateController
+    """
+
+    def __init__(self, *args, controller=None, maxlag=None, max_retries=10, **kwargs):
+        self.controller = controller
+        self.maxlag = maxlag
+        self.throttle_retries = max_retries
+        kwargs["wait_callback"] = self.on_retry
+        super().__init__(*args, **kwargs)
+
+    def on_retry(self, *args):
+        # mwclient is about to sleep and retry because of
+        # 5xx response, database lag or connection error
+        self.controller.throttle()
+
+    def raw_call(
+        self, script, data, files=None, retry_on_error=True, http_method="POST"
+    ):
+        if self.maxlag is not None and script == "api":
+            data["maxlag"] = self.maxlag
+        retries = 0
+        while True:
+            try:
+                with self.controller.slot():
+                    return super().raw_call(
+                        script,
+                        data,
+                        files=files,
+                        retry_on_error=retry_on_error,
+                        http_method=http_method,
+                    )
+            except requests.HTTPError as ex:
+                response = ex.response
+                if (
+                    response is None
+                    or response.status_code != 429
+                    or retries >= self.throttle_retries
+                ):
+                    raise
+                retries += 1
+                wait_time = retry_after(response.headers)
+                print("Throttled, retrying in %ss" % wait_time)
+                self.controller.throttle(wait_time)
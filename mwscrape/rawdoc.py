@@ -0,0 +1,129 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Article documents made of raw parse API response.
+
+Parse result of a big article may take many megabytes to decode into
+Python objects, only to be encoded back to JSON when saved. Instead,
+response body is kept as is and only the fields scraper needs
+(title, pageid and revid, which MediaWiki puts first) are extracted
+from its beginning, after warnings if there are any.
+"""
+
+import json
+import re
+
+PARSE_HEAD = (
+    rb'\s*"parse"\s*:\s*\{\s*"title"\s*:\s*("(?:[^"\\]|\\.)*")\s*,'
+    rb'\s*"pageid"\s*:\s*(\d+)\s*,\s*"revid"\s*:\s*(\d+)\s*[,}]'
+)
+
+PARSE_HEAD_RE = re.compile(rb"\s*\{" + PARSE_HEAD)
+
+# MediaWiki puts warnings (e.g. about unrecognized parameters) first
+WARNINGS_RE = re.compile(rb'\s*\{\s*"warnings"\s*:\s*(?=\{)')
+
+PARSE_AFTER_WARNINGS_RE = re.compile(rb"\s*," + PARSE_HEAD)
+
+
+class RawDoc(dict):
+    """Document whose parse result is JSON encoded body
+    of parse API response. Only parse result header is decoded
+    and available as doc["parse"], other fields can be set as usual.
+
+    >>> doc = RawDoc(b'{"parse": {"title": "A", "pageid": 1, "revid": 2, "text": {}}}',
+    ...              {"title": "A", "pageid": 1, "revid": 2})
+    >>> doc["_id"] = "A"
+    >>> doc.encode()
+    b'{"_id": "A", "parse": {"title": "A", "pageid": 1, "revid": 2, "text": {}}}'
+    >>> json.loads(doc.copy().encode()) == json.loads(doc.encode())
+    True
+
+    """
+
+    def __init__(self, body, parse, **fields):
+        super().__init__(fields, parse=parse)
+        self.body = body
+
+    def copy(self):
+        fields = {name: value for name, value in self.items() if name != "parse"}
+        return RawDoc(self.body, self["parse"], **fields)
+
+    def encode(self):
+        fields = {name: value for name, value in self.items() if name != "parse"}
+        if not fields:
+            return self.body
+        head = json.dumps(fields).encode("utf-8")
+        return head[:-1] + b", " + self.body.lstrip()[1:]
+
+
+def raw_doc(body):
+    """Return RawDoc for parse API response body,
+    or None if it doesn't look like parse result (e.g. it's an error)
+
+    >>> raw_doc(b'{"parse":{"title":"A \\\\"B\\\\"","pageid":1,"revid":2,"text":{}}}')
+    {'parse': {'title': 'A "B"', 'pageid': 1, 'revid': 2}}
+    >>> raw_doc(b'{"error":{"code":"missingtitle"}}')
+    >>> raw_doc(b'{"warnings":{"main":{"*":"}"}},"parse":{"title":"A","pageid":1,'
+    ...         b'"revid":2}}')
+    {'parse': {'title': 'A', 'pageid': 1, 'revid': 2}}
+
+    """
+    m = WARNINGS_RE.match(body)
+    if m:
+        end = object_end(body, m.end())
+        m = end and PARSE_AFTER_WARNINGS_RE.match(body, end)
+    else:
+        m = PARSE_HEAD_RE.match(body)
+    if m is None:
+        return None
+    parse = {
+        "title": json.loads(m.group(1)),
+        "pageid": int(m.group(2)),
+        "revid": int(m.group(3)),
+    }
+    return RawDoc(body, parse)
+
+
+def object_end(body, pos):
+    """Index just past JSON object that starts at pos in body,
+    None if body ends before it does
+
+    >>> body = b'{"a": {"b": "}\\\\"{"}, "c": 1}'
+    >>> object_end(body, 6), object_end(body, 0), object_end(body[:-1], 0)
+    (19, 28, None)
+
+    """
+    depth = 0
+    in_string = escaped = False
+    for i in range(pos, len(body)):
+        c = body[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == BACKSLASH:
+                escaped = True
+            elif c == QUOTE:
+                in_string = False
+        elif c == QUOTE:
+            in_string = True
+        elif c in OPENING:
+            depth += 1
+        elif c in CLOSING:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+QUOTE, BACKSLASH = ord('"'), ord("\\")
+OPENING, CLOSING = b"{[", b"}]"
+
+
+def encode_doc(doc):
+    if isinstance(doc, RawDoc):
+        return doc.encode()
+    return json.dumps(doc).encode("utf-8")
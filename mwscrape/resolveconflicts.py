@@ -5,13 +5,27 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import collections
 import couchdb
+import json
+import threading
 import time
+import traceback
 
 from datetime import timedelta
 from urllib.parse import urlparse
 from concurrent import futures
 
+from .profiling import profile_to
+from .scrape import batches, merge_aliases
+from .session import Frontier
+
+# resume point of interrupted run
+CHECKPOINT_ID = "_local/mwresolvec"
+
+# changes feed sequence followed up to
+FOLLOW_CHECKPOINT_ID = "_local/mwresolvec-follow"
+
 
 def parse_args():
     argparser = argparse.ArgumentParser()
@@ -19,7 +33,67 @@ def parse_args():
     argparser.add_argument("-s", "--start")
     argparser.add_argument("-b", "--batch-size", type=int, default=500)
     argparser.add_argument("-w", "--workers", type=int, default=50)
+    argparser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=1000,
+        help=(
+            "Maximum number of documents being resolved "
+            "or waiting for a worker. Default: %(default)s"
+        ),
+    )
+    argparser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=10,
+        help=(
+            "Save id of the last processed document every this many seconds, "
+            "interrupted run resumes from there. Default: %(default)s"
+        ),
+    )
+    argparser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore saved checkpoint and start from the beginning (or --start)",
+    )
+    argparser.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        help=(
+            "Instead of checking all documents, follow database changes "
+            "and resolve conflicts in changed documents that have them, "
+            "indefinitely. Sequence processed up to is saved so that "
+            "next run continues from there"
+        ),
+    )
+    argparser.add_argument(
+        "--since",
+        help=(
+            "Sequence to start following changes from, "
+            "now to only process new changes. "
+            "Default: saved sequence or 0 (all changes)"
+        ),
+    )
     argparser.add_argument("-v", "--verbose", action="store_true")
+    argparser.add_argument(
+        "--bulk",
+        action="store_true",
+        help=(
+            "Find conflicted documents with conflicts view instead of "
+            "checking every document, fetch all their revisions and save "
+            "resolved documents in one request per batch"
+        ),
+    )
+    argparser.add_argument(
+        "-p",
+        "--profile",
+        metavar="PREFIX",
+        help=(
+            "Sample stacks of all threads, write profile summary "
+            "to PREFIX.json and collapsed stacks to PREFIX.collapsed"
+        ),
+    )
     return argparser.parse_args()
 
 
@@ -44,67 +118,300 @@ def mkclient(couch_url):
     return server[couch_db]
 
 
-def resolve(db, doc_id, verbose=False):
-    doc = db.get(doc_id, conflicts=True)
-    conflicts = doc.get("_conflicts")
+# own design document, so that adding the view doesn't rebuild
+# indexes of views in _design/w
+DESIGN_DOC_ID = "_design/mwresolvec"
+
+# same as conflicts view row: doc id, current rev followed by conflicting revs
+ConflictsRow = collections.namedtuple("ConflictsRow", "id value")
+
+CONFLICTS_MAP_FUNC = r"""
+function(doc)
+{
+  if (doc._conflicts) {
+    emit(doc._id, [doc._rev].concat(doc._conflicts));
+  }
+}
+"""
+
+
+def set_conflicts_view(db):
+    design_doc = db.get(DESIGN_DOC_ID, {})
+    views = design_doc.get("views", {})
+    if not views.get("conflicts"):
+        views["conflicts"] = {"map": CONFLICTS_MAP_FUNC}
+        design_doc["views"] = views
+        db[DESIGN_DOC_ID] = design_doc
+
+
+def open_revs(db, revs):
+    """Fetch given revisions of documents (doc id -> list of revs)
+    with one _bulk_get request, or with one open_revs request per document
+    if server doesn't support _bulk_get. Returns dictionary
+    mapping doc ids to lists of found revisions
+    """
+    body = {
+        "docs": [{"id": doc_id, "rev": rev} for doc_id in revs for rev in revs[doc_id]]
+    }
+    docs = {doc_id: [] for doc_id in revs}
+    try:
+        _, _, data = db.resource.post_json("_bulk_get", body=body)
+    except (couchdb.http.ResourceNotFound, couchdb.http.ServerError):
+        for doc_id, doc_revs in revs.items():
+            _, _, data = db.resource(doc_id).get_json(open_revs=json.dumps(doc_revs))
+            docs[doc_id] = [item["ok"] for item in data if "ok" in item]
+        return docs
+    for result in data["results"]:
+        for item in result["docs"]:
+            if "ok" in item:
+                docs[result["id"]].append(item["ok"])
+    return docs
+
+
+def alias_set(doc):
+    return {
+        tuple(alias) if isinstance(alias, list) else alias
+        for alias in doc.get("aliases", ())
+    }
+
+
+def resolve_batch(db, rows, verbose=False):
+    """Resolve conflicts of documents in conflicts view rows: keep
+    revision with latest article revision, with aliases of all revisions,
+    delete the others. Returns number of resolved documents
+    """
+    revs = {row.id: row.value for row in rows}
+    updates = []
     messages = []
-    if conflicts:
-        best_mw_revid = doc["parse"]["revid"]
-        docs = [doc]
-        best_doc = doc
-        all_aliases = set(doc.get("aliases", ()))
-        aliase_count = len(all_aliases)
-        article_revisions = set([best_mw_revid])
-        for conflict_rev in conflicts:
-            conflict_doc = db.get(doc_id, rev=conflict_rev)
-            docs.append(conflict_doc)
-            conflict_mw_revid = conflict_doc["parse"]["revid"]
-            article_revisions.add(conflict_mw_revid)
-            if conflict_mw_revid > best_mw_revid:
-                best_mw_revid = conflict_mw_revid
-                best_doc = conflict_doc
-            aliases = set(doc.get("aliases", ()))
-            all_aliases.update(aliases)
-        new_aliases_count = len(all_aliases) - aliase_count
-        article_rev_count = len(article_revisions) - 1
+    for doc_id, docs in open_revs(db, revs).items():
+        if len(docs) < 2:
+            continue
+        best_doc = max(docs, key=lambda doc: doc.get("parse", {}).get("revid", 0))
+        current_aliases = set()
+        for doc in docs:
+            # first rev in view row is current winning revision
+            if doc["_rev"] == revs[doc_id][0]:
+                current_aliases = alias_set(doc)
+        all_aliases = set()
+        for doc in docs:
+            all_aliases.update(alias_set(doc))
+        merged = merge_aliases(best_doc.get("aliases", ()), all_aliases)
+        new_aliases_count = len(all_aliases) - len(current_aliases)
+        article_rev_count = len({doc.get("parse", {}).get("revid") for doc in docs}) - 1
         if verbose:
             messages.append("------")
         messages.append(
             "%s [%d conflict(s): +%dr, +%da]"
-            % (doc_id, len(conflicts), article_rev_count, new_aliases_count)
+            % (doc_id, len(docs) - 1, article_rev_count, new_aliases_count)
         )
         for doc in docs:
-            if doc.rev == best_doc.rev:
+            if doc["_rev"] == best_doc["_rev"]:
                 if verbose:
-                    messages.append("Keeping %s" % doc.rev)
-                doc["aliases"] = list(all_aliases)
-                db.save(doc)
+                    messages.append("Keeping %s" % doc["_rev"])
+                if merged is not None:
+                    doc["aliases"] = merged
+                updates.append(doc)
             else:
                 if verbose:
-                    messages.append("Discarding %s" % doc.rev)
-                db.delete(doc)
-        result = True
-    else:
-        if verbose:
-            messages.append("[no conflicts] %s" % doc_id)
-        result = False
+                    messages.append("Discarding %s" % doc["_rev"])
+                updates.append({"_id": doc_id, "_rev": doc["_rev"], "_deleted": True})
+    counts = collections.Counter(unchanged=len(rows))
+    if not updates:
+        return counts
+    resolved = set()
+    failed = set()
+    for success, doc_id, rev_or_exc in db.update(updates):
+        if success:
+            resolved.add(doc_id)
+        else:
+            failed.add(doc_id)
+            messages.append("Failed to update %s: %s" % (doc_id, rev_or_exc))
     if messages:
         print("\n".join(messages))
-    return result
+    counts["resolved"] = len(resolved - failed)
+    counts["failed"] = len(failed)
+    counts["unchanged"] -= counts["resolved"] + counts["failed"]
+    return counts
+
+
+def resolve_ids(db, doc_ids, verbose=False):
+    """Resolve conflicts of documents with given ids the same way
+    resolve_batch does for conflicts view rows. Returns counts
+    """
+    rows = []
+    counts = collections.Counter()
+    for doc_id in doc_ids:
+        doc = db.get(doc_id, conflicts=True)
+        if doc and doc.get("_conflicts"):
+            rows.append(ConflictsRow(doc_id, [doc.rev] + doc["_conflicts"]))
+        else:
+            if verbose:
+                print("[no conflicts] %s" % doc_id)
+            counts["unchanged"] += 1
+    if rows:
+        counts.update(resolve_batch(db, rows, verbose))
+    return counts
+
+
+def load_checkpoint(db, doc_id, name):
+    doc = db.get(doc_id)
+    return doc[name] if doc else None
+
+
+def save_checkpoint(db, doc_id, name, value):
+    doc = db.get(doc_id, {})
+    doc[name] = value
+    db[doc_id] = doc
+
+
+def follow_changes(db, since, batch_size, timeout=60):
+    """Generate (sequence, resolve function, doc ids) tasks
+    for documents with multiple leaf revisions in changes feed,
+    and a task with no doc ids after each batch of changes
+    so that sequence of changes without conflicts is checkpointed too
+    """
+    while True:
+        try:
+            changes = db.changes(
+                feed="longpoll",
+                style="all_docs",
+                since=since,
+                limit=batch_size,
+                timeout=timeout * 1000,
+            )
+        except (OSError, couchdb.http.ServerError) as ex:
+            print("Failed to get changes since %s (%s), retrying" % (since, ex))
+            time.sleep(timeout / 6)
+            continue
+        for change in changes["results"]:
+            doc_id = change["id"]
+            if change.get("deleted") or doc_id.startswith("_design/"):
+                continue
+            # deleted leafs of resolved conflicts are listed too,
+            # resolve_ids() only looks at conflicts that are still there
+            if len(change["changes"]) > 1:
+                yield change["seq"], resolve_ids, [doc_id]
+        since = changes["last_seq"]
+        yield since, resolve_ids, []
+
+
+def run_pipeline(db, tasks, args, save):
+    """Run (checkpoint, resolve function, rows) tasks in worker threads,
+    with at most args.max_in_flight documents in submitted tasks
+    that are not done yet. Periodically call save with checkpoint
+    of the last task such that it and all tasks before it are done
+    (last doc id or changes sequence). Returns counts of
+    resolved, unchanged and failed documents
+    """
+    counts = collections.Counter()
+    frontier = Frontier()
+    done = threading.Condition()
+    in_flight = 0
+
+    def run(token, func, rows):
+        nonlocal in_flight
+        try:
+            result = func(db, rows, verbose=args.verbose)
+        except Exception:
+            traceback.print_exc()
+            result = collections.Counter(failed=len(rows))
+        with done:
+            counts.update(result)
+            frontier.done(token)
+            in_flight -= len(rows)
+            done.notify()
+
+    saved_at = time.time()
+    saved_id = None
+    try:
+        with futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+            for last_id, func, rows in tasks:
+                with done:
+                    # batch bigger than the limit runs alone
+                    done.wait_for(
+                        lambda: not in_flight
+                        or in_flight + len(rows) <= args.max_in_flight
+                    )
+                    in_flight += len(rows)
+                    token = frontier.start(last_id)
+                    checkpoint = frontier.last
+                executor.submit(run, token, func, rows)
+                if (
+                    checkpoint != saved_id
+                    and time.time() - saved_at >= args.checkpoint_interval
+                ):
+                    save(checkpoint)
+                    saved_at, saved_id = time.time(), checkpoint
+    finally:
+        if frontier.last is not None and frontier.last != saved_id:
+            save(frontier.last)
+    return counts
+
+
+def follow(db, args):
+    since = args.since
+    if since is None and not args.restart:
+        since = load_checkpoint(db, FOLLOW_CHECKPOINT_ID, "since")
+    if since is None:
+        since = 0
+    print("Following changes since %s" % since)
+
+    def save(since):
+        save_checkpoint(db, FOLLOW_CHECKPOINT_ID, "since", since)
+
+    tasks = follow_changes(db, since, args.batch_size)
+    try:
+        run_pipeline(db, tasks, args, save)
+    except KeyboardInterrupt:
+        print("Stopped following changes")
 
 
 def main():
     args = parse_args()
+    if args.profile:
+        profile_to(args.profile)
     db = mkclient(args.couch_url)
+    if args.follow:
+        follow(db, args)
+        return
+    start = args.start
+    if not start and not args.restart:
+        start = load_checkpoint(db, CHECKPOINT_ID, "last_id")
+        if start:
+            print("Resuming after %s" % start)
     viewoptions = {}
-    if args.start:
-        viewoptions["startkey"] = args.start
-        viewoptions["startkey_docid"] = args.start
+    if start:
+        viewoptions["startkey"] = start
+        viewoptions["startkey_docid"] = start
+
+    def save(last_id):
+        save_checkpoint(db, CHECKPOINT_ID, "last_id", last_id)
 
     t0 = time.time()
-    with futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
-        for row in db.iterview("_all_docs", args.batch_size, **viewoptions):
-            executor.submit(resolve, db, row.id, verbose=args.verbose)
+    if args.bulk:
+        set_conflicts_view(db)
+        rows = db.iterview("mwresolvec/conflicts", args.batch_size, **viewoptions)
+    else:
+        rows = db.iterview("_all_docs", args.batch_size, **viewoptions)
+    if start and not args.start:
+        # checkpoint is the last processed document
+        rows = (row for row in rows if row.id != start)
+    if args.bulk:
+        tasks = (
+            (batch[-1].id, resolve_batch, batch)
+            for batch in batches(rows, args.batch_size)
+        )
+    else:
+        tasks = ((row.id, resolve_ids, [row.id]) for row in rows)
+    counts = run_pipeline(db, tasks, args, save)
+    # next run starts from the beginning
+    checkpoint_doc = db.get(CHECKPOINT_ID)
+    if checkpoint_doc:
+        db.delete(checkpoint_doc)
+    print(
+        "Resolved %d, unchanged %d, failed %d document(s)"
+        % (counts["resolved"], counts["unchanged"], counts["failed"])
+    )
     print("Done in %s" % timedelta(seconds=int(time.time() - t0)))
 
 
@@ -5,12 +5,18 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import asyncio
+import collections
+import copy
 import fcntl
 import hashlib
+import json
 import os
 import random
+import shlex
 import socket
 import tempfile
+import threading
 import time
 import traceback
 
@@ -20,18 +26,29 @@ from urllib.parse import urlparse
 from urllib.parse import urlunparse
 from collections import namedtuple
 from datetime import datetime, timedelta
-from multiprocessing import RLock
 from multiprocessing.pool import ThreadPool
 from contextlib import contextmanager
 
 import couchdb
 import mwclient
-import mwclient.page
 import mwclient.client
-import pylru
+import mwclient.util
+import requests
 
 import _thread
 
+from .compress import Compressor, load_zstd_dict, save_zstd_dict, stored_doc
+from .dedup import SeenTitles
+from .localstore import LocalServer
+from .metrics import metrics
+from .parsecache import ParseCache
+from .partition import coordinate, create_partitions, partition_bounds
+from .profiling import profile_to
+from .ratecontrol import RateController, ThrottledSite
+from .rawdoc import raw_doc
+from .session import Session
+from .writer import BulkWriter
+
 
 def fix_server_url(general_siteinfo):
     """
@@ -91,7 +108,23 @@ def update_siteinfo(site, couch_server, db_name):
     siteinfo_db[db_name] = siteinfo_doc
 
 
-def parse_args():
+def site_page_count(site):
+    """Number of pages in all namespaces of site, from siteinfo statistics"""
+    siteinfo = site.api("query", meta="siteinfo", siprop="statistics")["query"]
+    return siteinfo["statistics"]["pages"]
+
+
+def namespace_ids(value):
+    """Parse comma separated namespace IDs
+
+    >>> namespace_ids('0,100, 14')
+    [0, 100, 14]
+
+    """
+    return [int(item) for item in value.split(",")]
+
+
+def parse_args(argv=None, namespace=None):
     argparser = argparse.ArgumentParser()
     argparser.add_argument(
         "site",
@@ -101,17 +134,21 @@ def parse_args():
     argparser.add_argument(
         "--site-path",
         default="/w/",
-        help=("MediaWiki site API path" "Default: %(default)s"),
+        help=("MediaWiki site API path. " "Default: %(default)s"),
     )
     argparser.add_argument(
         "--site-ext",
         default=".php",
-        help=("MediaWiki site API script extension" "Default: %(default)s"),
+        help=("MediaWiki site API script extension. " "Default: %(default)s"),
     )
     argparser.add_argument(
         "-c",
         "--couch",
-        help=("CouchDB server URL. " "Default: %(default)s"),
+        help=(
+            "CouchDB server URL, or sqlite:PATH to keep articles, "
+            "siteinfo and sessions in a local SQLite database file instead. "
+            "Default: %(default)s"
+        ),
         default="http://localhost:5984",
     )
     argparser.add_argument(
@@ -137,6 +174,48 @@ def parse_args():
     argparser.add_argument(
         "--start", help=("Download all article pages " "beginning with this name")
     )
+    argparser.add_argument("--end", help=("Stop before article page with this name"))
+    argparser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help=(
+            "Split pages into this many ranges of about the same size "
+            "(estimated from a random sample of titles) "
+            "and scrape each range in a separate worker process, "
+            "with its own session"
+        ),
+    )
+    argparser.add_argument(
+        "--sites",
+        metavar="FILE",
+        help=(
+            "Scrape sites listed in this file in one process, one site "
+            "per line, given as site name followed by options for it, "
+            "e.g. en.wiktionary.org --speed 3. Options not given "
+            "for a site are those given on command line. Each site is "
+            "scraped in its own session, unfinished sessions are resumed"
+        ),
+    )
+    argparser.add_argument(
+        "--max-sites",
+        type=int,
+        default=0,
+        help=(
+            "Scrape up to this many sites from --sites file at a time. " "Default: all"
+        ),
+    )
+    argparser.add_argument(
+        "--partitions",
+        type=lambda value: [int(i) for i in value.split(",")],
+        default=None,
+        help=(
+            "Comma separated list of partitions to run when starting "
+            "or resuming session with --workers, so that partitions "
+            "can be distributed among multiple hosts. "
+            "Default: all partitions"
+        ),
+    )
     argparser.add_argument(
         "--changes-since",
         help=(
@@ -158,6 +237,26 @@ def parse_args():
         action="store_true",
         help=("Download recently changed articles only"),
     )
+    argparser.add_argument(
+        "--follow",
+        action="store_true",
+        help=(
+            "Keep polling recent changes and download changed articles, "
+            "indefinitely. Last change processed is saved in session, "
+            "resumed session continues after it. Starts with changes "
+            "since --changes-since or --recent-days with --recent, "
+            "otherwise with new changes"
+        ),
+    )
+    argparser.add_argument(
+        "--follow-interval",
+        type=float,
+        default=60,
+        help=(
+            "Poll recent changes every this many seconds when following them. "
+            "Default: %(default)s"
+        ),
+    )
     argparser.add_argument(
         "--timeout",
         default=30.0,
@@ -203,24 +302,202 @@ def parse_args():
         "--speed", type=int, choices=range(0, 6), default=0, help=("Scrape speed")
     )
 
+    argparser.add_argument(
+        "--engine",
+        choices=("threads", "async"),
+        default="threads",
+        help=(
+            "Scraping engine. threads: pool of --speed * 2 threads, "
+            "async: asyncio with up to --connections concurrent requests "
+            "(requires aiohttp). Default: %(default)s"
+        ),
+    )
+
+    argparser.add_argument(
+        "--connections",
+        type=int,
+        default=100,
+        help=(
+            "Maximum number of concurrent requests "
+            "for async engine. Default: %(default)s"
+        ),
+    )
+
     argparser.add_argument(
         "--delay",
         type=float,
         default=0,
         help=(
             "Pause before requesting rendered article "
-            "for this many seconds. Default: %(default)s."
+            "for this many seconds. Default: %(default)s. "
             "Some sites limit request rate so that even "
-            "single-threaded, request-at-a-time scrapes are too fast"
+            "single-threaded, request-at-a-time scrapes are too fast "
             "and additional delay needs to be introduced"
         ),
     )
 
+    argparser.add_argument(
+        "--max-rps",
+        type=float,
+        default=None,
+        help=(
+            "Make at most this many requests per second to the site, "
+            "instead of pausing a fixed --delay before each article"
+        ),
+    )
+
+    argparser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help=(
+            "Adjust number of concurrent requests to the site: "
+            "start low and increase while response time and error rate "
+            "stay low, back off when they degrade or when the site "
+            "asks to slow down (HTTP 429/503, Retry-After, maxlag)"
+        ),
+    )
+
+    argparser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=20,
+        help=(
+            "Maximum number of concurrent requests with --adaptive "
+            "and threads engine (async engine uses --connections). "
+            "Default: %(default)s"
+        ),
+    )
+
+    argparser.add_argument(
+        "--maxlag",
+        type=int,
+        default=5,
+        help=(
+            "Ask site to reject requests when its database replication "
+            "lag exceeds this many seconds, used with --adaptive "
+            "or --max-rps. Default: %(default)s"
+        ),
+    )
+
     argparser.add_argument(
         "--namespace",
+        type=namespace_ids,
+        help=(
+            "ID of MediaWiki namespace to scrape, or comma separated "
+            "list of IDs to scrape several namespaces in one session, "
+            "e.g. 0,100,14. Default: 0"
+        ),
+    )
+
+    argparser.add_argument(
+        "--redirect-map",
+        action="store_true",
+        help=(
+            "Load all redirects in the namespace before scraping "
+            "so that articles get aliases from all their redirects "
+            "when they are first saved"
+        ),
+    )
+
+    argparser.add_argument(
+        "--seen-dir",
+        default=None,
+        help=(
+            "Keep titles seen in this session in a file in this directory, "
+            "so that when session is resumed titles already scraped "
+            "are skipped. By default seen titles are kept "
+            "in a temporary file for the duration of the run"
+        ),
+    )
+
+    argparser.add_argument(
+        "--seen-capacity",
         type=int,
-        default=0,
-        help=("ID of MediaWiki namespace to " "scrape. Default: %(default)s"),
+        default=None,
+        help=(
+            "Number of titles seen titles filter is sized for, "
+            "past it more lookups go to disk. "
+            "Default: number of pages in site statistics "
+            "(divided among partitions of --workers)"
+        ),
+    )
+
+    argparser.add_argument(
+        "--parse-cache",
+        metavar="PATH",
+        default=None,
+        help=(
+            "Keep parse API responses in SQLite database at this path "
+            "and use them instead of requesting pages again when their "
+            "revision didn't change, e.g. when scraping into a new database"
+        ),
+    )
+
+    argparser.add_argument(
+        "--parse-cache-mb",
+        type=float,
+        default=10240,
+        help=(
+            "Maximum size of parse cache in megabytes, least recently "
+            "used responses are removed when it's exceeded. Default: %(default)s"
+        ),
+    )
+
+    argparser.add_argument(
+        "--compress",
+        choices=("gzip", "zstd"),
+        default=None,
+        help=(
+            "Store article HTML and other large parse fields "
+            "as attachments, compressing all but HTML "
+            "(zstd requires zstandard). Only small metadata stays "
+            "in article documents. Default: store uncompressed"
+        ),
+    )
+
+    argparser.add_argument(
+        "--parse-profile",
+        choices=list(PARSE_PROFILES),
+        help=(
+            "Parse result properties to request and store: "
+            "full - all that API returns by default, "
+            "compact - article HTML without edit section links, "
+            "display title, language links, categories, sections "
+            "and page properties, "
+            "text - article HTML and display title only. "
+            "Profile is recorded in article document, articles scraped "
+            "with a different profile are scraped again even if their "
+            "revision didn't change. Default: full, or profile of "
+            "resumed session"
+        ),
+    )
+
+    argparser.add_argument(
+        "--prerender",
+        action="store_true",
+        help=(
+            "Store article HTML with links rewritten as attachment, "
+            "so that it is served as is instead of by html show "
+            "function on each read (compressed articles always are). "
+            "See also mwprerender"
+        ),
+    )
+
+    argparser.add_argument(
+        "--compress-level",
+        type=int,
+        default=None,
+        help=("Compression level. Default: 6 for gzip, 9 for zstd"),
+    )
+
+    argparser.add_argument(
+        "--zstd-dict",
+        default=None,
+        help=(
+            "Compress with this zstd dictionary (trained on parse "
+            "results of the same wiki, e.g. with zstd --train). "
+            "Dictionary is stored in the database design document"
+        ),
     )
 
     argparser.add_argument(
@@ -230,7 +507,79 @@ def parse_args():
         help=("HTTP user agent string. Default: %s" % mwclient.client.USER_AGENT),
     )
 
-    return argparser.parse_args()
+    argparser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help=(
+            "Serve scrape metrics (page counts, latency of page info, "
+            "redirects, parse, CouchDB get and put requests, "
+            "queue depth) in Prometheus format on this local port"
+        ),
+    )
+
+    argparser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help=(
+            "Print metrics summary every this many seconds, "
+            "0 to disable. Default: %(default)s"
+        ),
+    )
+
+    argparser.add_argument(
+        "--profile",
+        default=None,
+        metavar="PREFIX",
+        help=(
+            "Sample stacks of all threads while scraping, "
+            "write profile summary to PREFIX.json and collapsed "
+            "stacks for flame graph tools to PREFIX.collapsed on exit"
+        ),
+    )
+
+    argparser.add_argument(
+        "--session-flush-interval",
+        type=float,
+        default=10,
+        help=(
+            "Save session stats to sessions database "
+            "every this many seconds. Default: %(default)s"
+        ),
+    )
+
+    argparser.add_argument(
+        "--bulk-docs",
+        type=int,
+        default=100,
+        help=(
+            "Save scraped articles in batches of up to "
+            "this many documents. Default: %(default)s"
+        ),
+    )
+
+    argparser.add_argument(
+        "--bulk-mb",
+        type=float,
+        default=16,
+        help=(
+            "Save batch of scraped articles when it's size "
+            "reaches this many megabytes. Default: %(default)s"
+        ),
+    )
+
+    argparser.add_argument(
+        "--bulk-delay",
+        type=float,
+        default=5,
+        help=(
+            "Save batch of scraped articles when it's oldest "
+            "article waited this many seconds. Default: %(default)s"
+        ),
+    )
+
+    return argparser.parse_args(argv, namespace)
 
 
 SHOW_FUNC = r"""
@@ -238,8 +587,24 @@ function(doc, req)
 {
   var r = /href="\/wiki\/(.*?)"/gi;
   var replace = function(match, p1, offset, string) {
-    return 'href="' + p1.replace(/_/g, ' ') + '"';
+    // same as mwscrape.compress.link_target
+    var hash = p1.indexOf('#');
+    var title = hash < 0 ? p1 : p1.substring(0, hash);
+    var fragment = hash < 0 ? '' : p1.substring(hash);
+    try {
+      title = decodeURIComponent(title);
+    } catch (e) {
+      // not percent-encoded
+    }
+    return 'href="' + encodeURIComponent(title.replace(/_/g, ' ')) + fragment + '"';
   };
+  if (!doc.parse.text) {
+    // compressed, links in text.html are already rewritten;
+    // go up from request path to database root
+    var root = new Array(req.path.length - 1).join('../');
+    var location = root + encodeURIComponent(doc._id) + '/text.html';
+    return {code: 302, headers: {Location: location}};
+  }
   return doc.parse.text['*'].replace(r, replace);
 }
 """
@@ -248,29 +613,674 @@ function(doc, req)
 def set_show_func(db, show_func=SHOW_FUNC, force=False):
     design_doc = db.get("_design/w", {})
     shows = design_doc.get("shows", {})
+    if shows.get("html") == show_func:
+        return
     if force or not shows.get("html"):
         shows["html"] = show_func
         design_doc["shows"] = shows
         db["_design/w"] = design_doc
 
 
-Redirect = namedtuple("Redirect", "page fragment")
+REVID_MAP_FUNC = r"""
+function(doc)
+{
+  if (doc.parse) {
+    emit(doc._id, {rev: doc._rev, revid: doc.parse.revid, aliases: doc.aliases || [],
+                   profile: doc.parse_profile});
+  }
+}
+"""
+
+
+def set_revid_view(db, map_func=REVID_MAP_FUNC, force=False):
+    """Add or update revid view, return True if it was changed"""
+    design_doc = db.get("_design/w", {})
+    views = design_doc.get("views", {})
+    if views.get("revid", {}).get("map") == map_func:
+        return False
+    if force or not views.get("revid"):
+        views["revid"] = {"map": map_func}
+        design_doc["views"] = views
+        db["_design/w"] = design_doc
+        return True
+    return False
 
 
-def redirects_to(site, from_title):
-    """Same as mwclient.page.Page.redirects_to except it returns page and fragment
-    in a named tuple instead of just target page
+def update_revid_index(db):
+    """Have CouchDB bring revid view index up to date. After
+    the view is added, building its index on a big database takes
+    much longer than network timeout, so it's done up front
+    with a request that has no timeout (couchdb sessions don't
+    have one) instead of in first revid_index() call
     """
-    info = site.api("query", prop="pageprops", titles=from_title, redirects="")["query"]
-    if "redirects" in info:
-        for page in info["redirects"]:
-            if page["from"] == from_title:
-                return Redirect(
-                    page=mwclient.page.Page(site, page["to"]),
-                    fragment=page.get("tofragment", ""),
-                )
+    list(db.view("w/revid", keys=[]))
+
+
+def revid_index(db, titles):
+    """Look up revid index entries for given titles in one request.
+    Returns dictionary mapping titles to entries (with "rev", "revid",
+    "aliases" and, if not full, parse "profile" keys) of titles found
+    in the database
+    """
+    if not titles:
+        return {}
+    with metrics.timer("couch_get"):
+        rows = db.view("w/revid", keys=list(titles))
+        return {row.key: row.value for row in rows}
+
+
+REVID_BATCH_SIZE = 100
+
+# smallest seen titles filter, for small sites and followed changes
+MIN_SEEN_CAPACITY = 10000
+
+
+def batches(iterable, size):
+    """Split iterable into lists of up to size items
+
+    >>> list(batches(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def merge_aliases(current, new):
+    """Merge new aliases into current aliases (as stored in a document,
+    with (title, fragment) aliases as lists). Returns merged alias list,
+    or None if current aliases already include all new ones.
+
+    >>> merge_aliases([['B', 'x']], {'C'})
+    [['B', 'x'], 'C']
+    >>> merge_aliases(['B', 'C'], {('B', 'x')})
+    [['B', 'x'], 'C']
+    >>> merge_aliases(['B'], {'B'}) is None
+    True
+
+    """
+    current_aliases = set()
+    for alias in current:
+        if isinstance(alias, list):
+            alias = tuple(alias)
+        current_aliases.add(alias)
+    if set(new).issubset(current_aliases):
+        return None
+    merged_aliases = set(new) | current_aliases
+    # remove aliases without fragment if one with fragment is present
+    # this is mostly to cleanup aliases in old scrapes
+    to_remove = set()
+    for alias in merged_aliases:
+        if isinstance(alias, tuple):
+            to_remove.add(alias[0])
+    merged_aliases = merged_aliases - to_remove
+    return [
+        list(alias) if isinstance(alias, tuple) else alias
+        for alias in sorted(merged_aliases, key=alias_sort_key)
+    ]
+
+
+def merge_into_current(doc, current):
+    """Document doc failed to save because another scraper process
+    saved current revision in the meantime. Returns document to save
+    instead: doc on top of current revision if doc has newer parse,
+    otherwise current revision with doc's aliases added,
+    or None if there's nothing to add.
+
+    >>> merge_into_current({'aliases': ['B']}, {'_rev': '2-x', 'aliases': ['C']})
+    {'_rev': '2-x', 'aliases': ['B', 'C']}
+    >>> merge_into_current({'aliases': [['B', 'x']]}, {'aliases': [['B', 'x']]})
+    >>> merge_into_current(
+    ...     {'_rev': '1-x', 'parse': {'revid': 2}},
+    ...     {'_rev': '2-x', 'parse': {'revid': 1}, 'aliases': ['C']},
+    ... )
+    {'_rev': '2-x', 'parse': {'revid': 2}, 'aliases': ['C']}
+
+    """
+    if current is None:
         return None
-    return None
+    aliases = {
+        tuple(alias) if isinstance(alias, list) else alias
+        for alias in doc.get("aliases", ())
+    }
+    merged = merge_aliases(current.get("aliases", ()), aliases)
+    if doc.get("parse", {}).get("revid", 0) > current.get("parse", {}).get("revid", 0):
+        newer = doc.copy()
+        newer["_rev"] = current["_rev"]
+        if merged is not None:
+            newer["aliases"] = merged
+        elif current.get("aliases"):
+            newer["aliases"] = current["aliases"]
+        return newer
+    if merged is None:
+        return None
+    current["aliases"] = merged
+    return current
+
+
+def add_aliases(doc, aliases):
+    """Merge aliases into aliases of doc. Returns True if doc changed
+
+    >>> doc = {'aliases': ['B']}
+    >>> add_aliases(doc, {'C'}), add_aliases(doc, {'C'}), doc
+    (True, False, {'aliases': ['B', 'C']})
+
+    """
+    merged = merge_aliases(doc.get("aliases", ()), aliases)
+    if merged is None:
+        return False
+    doc["aliases"] = merged
+    return True
+
+
+# what scraper does with a page, see scrape_action
+UP_TO_DATE = "up_to_date"
+ADD_ALIASES = "add_aliases"
+PARSE = "parse"
+
+
+def is_current(entry, revision, parse_profile):
+    """True if document of revid index entry has revision
+    parsed with parse_profile
+
+    >>> is_current({'revid': 5}, 5, 'full')
+    True
+    >>> is_current({'revid': 5, 'profile': 'text'}, 5, 'full')
+    False
+
+    """
+    profile = entry.get("profile") or "full"
+    return revision == entry["revid"] and profile == parse_profile
+
+
+def scrape_action(page, aliases, entry, parse_profile):
+    """Decide what to do with page (redirect target) that should
+    have aliases, given revid index entry of its document (None
+    if there is no document yet). Returns action and entry:
+    UP_TO_DATE if document has page's revision parsed with parse_profile
+    and all the aliases, ADD_ALIASES if it only misses some aliases,
+    PARSE otherwise, with aliases merged into entry
+
+    >>> page = PageInfo('A', True, False, 5, None, 1, 0)
+    >>> entry = {'rev': '1-a', 'revid': 5, 'aliases': ['B']}
+    >>> scrape_action(page, {'B'}, entry, 'full')[0]
+    'up_to_date'
+    >>> scrape_action(page, {'C'}, entry, 'full')[0]
+    'add_aliases'
+    >>> scrape_action(page, {'C'}, entry, 'text')
+    ('parse', {'rev': '1-a', 'revid': 5, 'aliases': ['B', 'C']})
+    >>> scrape_action(page, {'C'}, None, 'full')
+    ('parse', None)
+
+    """
+    if not entry:
+        return PARSE, None
+    merged_aliases = merge_aliases(entry["aliases"], aliases)
+    if is_current(entry, page.revision, parse_profile):
+        return (UP_TO_DATE if merged_aliases is None else ADD_ALIASES), entry
+    if merged_aliases is not None:
+        entry = dict(entry, aliases=merged_aliases)
+    return PARSE, entry
+
+
+def revision_change(page, entry, parse_profile):
+    """Describe update of page's document with revid index entry
+
+    >>> page = PageInfo('A', True, False, 6, None, 1, 0)
+    >>> revision_change(page, {'revid': 5}, 'text')
+    '[?] rev. 5 => 6 A (full)'
+
+    """
+    profile = entry.get("profile") or "full"
+    return "[%s] rev. %s => %s %s%s" % (
+        time.strftime("%x %X", page.touched) if page.touched else "?",
+        entry["revid"],
+        page.revision,
+        page.name,
+        "" if profile == parse_profile else " (%s)" % profile,
+    )
+
+
+def article_doc(doc, title, aliases, entry, parse_profile):
+    """Make parse result doc an article document with given title:
+    new one or, if revid index entry is given, next revision of
+    the existing one, with aliases of the entry (see scrape_action)
+
+    >>> article_doc({}, 'A', {'B'}, None, 'full')
+    {'_id': 'A', 'aliases': ['B']}
+    >>> article_doc({}, 'A', {'B'}, {'rev': '1-a', 'aliases': ['C']}, 'text')
+    {'_id': 'A', 'parse_profile': 'text', '_rev': '1-a', 'aliases': ['C']}
+
+    """
+    doc["_id"] = title
+    if parse_profile != "full":
+        doc["parse_profile"] = parse_profile
+    if entry:
+        doc["_rev"] = entry["rev"]
+        doc["aliases"] = entry["aliases"]
+    elif aliases:
+        doc["aliases"] = merge_aliases((), aliases)
+    return doc
+
+
+def check_saved(title, result):
+    """Report document of title that failed to save, result is
+    new revision or exception as reported by bulk writer.
+    Returns True if document was saved
+    """
+    if isinstance(result, couchdb.ResourceConflict):
+        print("Update conflict, skipping: %s" % title)
+        return False
+    if isinstance(result, Exception):
+        print("Error handling title %r: %s" % (title, result))
+        return False
+    return True
+
+
+def saved_callback(session, token, count_name=None):
+    """Bulk writer callback that increments count_name of session
+    if document is saved and marks page of token as done
+    (successfully if document is saved). Documents merged into
+    revision saved by another scraper after a conflict are counted
+    as merged instead
+    """
+
+    def callback(title, result, merged=False):
+        saved = False
+        try:
+            saved = check_saved(title, result)
+            if saved and count_name:
+                session.inc("merged" if merged else count_name)
+        finally:
+            session.done(token, ok=saved)
+
+    return callback
+
+
+def alias_sort_key(alias):
+    if isinstance(alias, tuple):
+        return alias
+    return (alias, "")
+
+
+# redirect target title and fragment
+Redirect = namedtuple("Redirect", "page fragment")
+
+
+PageInfo = namedtuple(
+    "PageInfo", "name exists redirect revision touched pageid namespace"
+)
+
+
+def page_info(info):
+    """Make PageInfo from a page entry of prop=info query result.
+    PageInfo has the same attributes as mwclient.page.Page
+    that are used by the scraper, but doesn't load anything lazily
+
+    >>> page_info({'title': 'A', 'pageid': 1, 'lastrevid': 5, 'redirect': ''})
+    PageInfo(name='A', exists=True, redirect=True, revision=5, touched=None, \
+pageid=1, namespace=0)
+    >>> page_info({'title': 'B', 'missing': ''}).exists
+    False
+
+    """
+    return PageInfo(
+        name=info.get("title", ""),
+        exists="missing" not in info,
+        redirect="redirect" in info,
+        revision=info.get("lastrevid", 0),
+        touched=(
+            mwclient.util.parse_timestamp(info["touched"])
+            if "touched" in info
+            else None
+        ),
+        pageid=info.get("pageid"),
+        namespace=info.get("ns", 0),
+    )
+
+
+def title_sort_key(title):
+    """MediaWiki sorts page lists by title's db key,
+    which has spaces replaced with underscores
+
+    >>> sorted(['A B', 'A_C', 'AB'], key=title_sort_key)
+    ['AB', 'A B', 'A_C']
+
+    """
+    return title.replace(" ", "_")
+
+
+def namespace_prefix(site, namespace):
+    """Prefix of titles in namespace, empty for main namespace"""
+    name = site.namespaces.get(namespace, "")
+    return name + ":" if name else ""
+
+
+def strip_namespace(title, prefix):
+    """Title without namespace prefix, as allpages from and to
+    parameters expect it
+
+    >>> strip_namespace('Category:Apple', 'Category:')
+    'Apple'
+    >>> strip_namespace('Category_talk:Apple', 'Category talk:')
+    'Apple'
+    >>> strip_namespace('Apple', 'Category:')
+    'Apple'
+    >>> strip_namespace(None, 'Category:') is None
+    True
+
+    """
+    if title and prefix and title_sort_key(title).startswith(title_sort_key(prefix)):
+        return title[len(prefix) :]
+    return title
+
+
+def query_info(site, stage="info", **kwargs):
+    """Run prop=info query, following continuations,
+    and yield "query" part of each API response.
+    Requests are timed as given metrics stage
+    """
+    kwargs["prop"] = "info"
+    while True:
+        with metrics.timer(stage):
+            result = site.get("query", **kwargs)
+        yield result.get("query", {})
+        if not result.get("continue"):
+            break
+        kwargs.update(result["continue"])
+
+
+def allpages_info(site, start=None, namespace=0, descending=False, end=None):
+    """Same as site.allpages() except it yields PageInfo
+    for up to API limit pages per request, in title order.
+    If end is given, pages stop before it. Start and end may be
+    given with or without namespace prefix
+    """
+    prefix = namespace_prefix(site, namespace)
+    start = strip_namespace(start, prefix)
+    end = strip_namespace(end, prefix)
+    kwargs = dict(
+        generator="allpages",
+        gapnamespace=namespace,
+        gapdir="descending" if descending else "ascending",
+        gaplimit="max",
+    )
+    if start:
+        kwargs["gapfrom"] = start
+    if end:
+        kwargs["gapto"] = end
+        end_key = title_sort_key(end)
+    for query in query_info(site, **kwargs):
+        batch = list(query.get("pages", {}).values())
+        batch.sort(key=lambda info: title_sort_key(info["title"]), reverse=descending)
+        for info in batch:
+            if (
+                end
+                and title_sort_key(strip_namespace(info["title"], prefix)) == end_key
+            ):
+                # gapto is inclusive
+                return
+            yield page_info(info)
+
+
+def interleave(iterables):
+    """Take items from iterables in turn until all are exhausted
+
+    >>> list(interleave([iter('ab'), iter('cde'), iter('')]))
+    ['a', 'c', 'b', 'd', 'e']
+
+    """
+    iterators = collections.deque(iter(iterable) for iterable in iterables)
+    while iterators:
+        iterator = iterators.popleft()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            continue
+        yield item
+        iterators.append(iterator)
+
+
+TITLES_PER_QUERY = 50
+
+
+def titles_info(site, titles, batch_size=TITLES_PER_QUERY):
+    """Yield PageInfo for each of the given titles,
+    querying info for batch_size titles per request. Pages
+    are yielded in the same order as titles
+    """
+    batch = []
+    for title in titles:
+        batch.append(title)
+        if len(batch) >= batch_size:
+            yield from _titles_info(site, batch)
+            batch = []
+    if batch:
+        yield from _titles_info(site, batch)
+
+
+def _titles_info(site, titles):
+    by_title = {}
+    normalized = {}
+    for query in query_info(site, titles="|".join(titles)):
+        for item in query.get("normalized", ()):
+            normalized[item["from"]] = item["to"]
+        for info in query.get("pages", {}).values():
+            by_title[info.get("title")] = info
+    for title in titles:
+        info = by_title.get(normalized.get(title, title))
+        if info is None or "invalid" in info:
+            print("Invalid title: %s" % title)
+            continue
+        yield page_info(info)
+
+
+MAX_REDIRECTS = 10
+
+
+def redirect_hops(query):
+    """Map each redirect listed in query result to Redirect
+    with target title and fragment
+    """
+    return {
+        item["from"]: Redirect(page=item["to"], fragment=item.get("tofragment", ""))
+        for item in query.get("redirects", ())
+    }
+
+
+def follow_redirects(redirects, title, max_hops=MAX_REDIRECTS):
+    """Follow title through redirects map. Returns final target title
+    (or None if it can't be reached in max_hops) and aliases
+    the target gets from redirect pages on the way.
+
+    >>> redirects = {'A': Redirect('B', ''), 'B': Redirect('C', 'x')}
+    >>> target, aliases = follow_redirects(redirects, 'A')
+    >>> target, sorted(aliases, key=alias_sort_key)
+    ('C', ['A', ('B', 'x')])
+    >>> follow_redirects({'A': Redirect('A', '')}, 'A')[0] is None
+    True
+
+    """
+    aliases = set()
+    for _ in range(max_hops):
+        redirect = redirects.get(title)
+        if redirect is None:
+            return title, aliases
+        aliases.add((title, redirect.fragment) if redirect.fragment else title)
+        title = redirect.page
+    return None, aliases
+
+
+def resolve_redirects(site, titles, batch_size=TITLES_PER_QUERY):
+    """Query info for titles with redirects resolved, batch_size
+    titles per request. Returns redirects map and PageInfo
+    of each page the titles resolved to, by title
+    """
+    redirects = {}
+    targets = {}
+    for batch in batches(titles, batch_size):
+        for query in query_info(
+            site, stage="redirects", titles="|".join(batch), redirects=""
+        ):
+            redirects.update(redirect_hops(query))
+            for info in query.get("pages", {}).values():
+                targets[info.get("title")] = page_info(info)
+    return redirects, targets
+
+
+# parse API parameters of each parse profile
+PARSE_PROFILES = {
+    "full": {},
+    "compact": {
+        "prop": "text|displaytitle|langlinks|categories|sections|properties",
+        "disableeditsection": "",
+        "disablelimitreport": "",
+    },
+    "text": {
+        "prop": "text|displaytitle",
+        "disableeditsection": "",
+        "disablelimitreport": "",
+    },
+}
+
+
+class RawBodyResponse(requests.Response):
+    """Response whose text is its body as is, see raw_call"""
+
+    @property
+    def text(self):
+        return self.content
+
+
+# set in threads that want undecoded response body from raw_call
+raw_body = threading.local()
+
+
+def raw_body_hook(response, **kwargs):
+    if getattr(raw_body, "wanted", False):
+        response.__class__ = RawBodyResponse
+
+
+def raw_call(site, script, data):
+    """Same as site.raw_call, with its retries and throttling,
+    but returns response body as bytes instead of decoding it
+    into text, which for a big parse result takes about as long
+    as reading it
+    """
+    hooks = site.connection.hooks["response"]
+    if raw_body_hook not in hooks:
+        hooks.append(raw_body_hook)
+    raw_body.wanted = True
+    try:
+        return site.raw_call(script, data)
+    finally:
+        raw_body.wanted = False
+
+
+def raw_parse(site, title, **params):
+    """Parse page with given title. Returns article document
+    with parse result as it came from the API (see mwscrape.rawdoc)
+    """
+    params = dict(params, action="parse", page=title, format="json")
+    body = raw_call(site, "api", params)
+    doc = raw_doc(body)
+    if doc is None:
+        # most likely an error, let mwclient report it
+        doc = json.loads(body)
+        if not site.handle_api_result(doc, kwargs=params):
+            # temporary database error, retry
+            doc = site.api("parse", page=title, **params)
+    return doc
+
+
+def all_redirects(site, namespace=0):
+    """Load redirects map for all redirect pages in namespace,
+    up to API limit redirects per request
+    """
+    redirects = {}
+    for query in query_info(
+        site,
+        stage="redirects",
+        generator="allpages",
+        gapnamespace=namespace,
+        gapfilterredir="redirects",
+        gaplimit="max",
+        redirects="",
+    ):
+        redirects.update(redirect_hops(query))
+    return redirects
+
+
+def target_aliases(redirects):
+    """Map each redirect target title to all its aliases"""
+    aliases = {}
+    for title in redirects:
+        target, target_aliases = follow_redirects(redirects, title)
+        if target is not None:
+            aliases.setdefault(target, set()).update(target_aliases)
+    return aliases
+
+
+def with_redirect_targets(site, pages, redirects=None, batch_size=TITLES_PER_QUERY):
+    """For each page yield page, PageInfo of the page it redirects to
+    (page itself if it's not a redirect, None if redirect can't be resolved)
+    and set of the target's aliases. Redirects are resolved for batch_size
+    pages per request. If redirects map of the whole namespace is given,
+    aliases include those from all redirects to the target,
+    not just from the page
+    """
+    known = redirects or {}
+    aliases_by_target = target_aliases(known)
+    for batch in batches(pages, batch_size):
+        hops, infos = resolve_redirects(site, redirect_titles(batch, known))
+        yield from redirect_targets(batch, hops, infos, known, aliases_by_target)
+
+
+def redirect_titles(pages, known):
+    """Titles to query with redirects resolved to find targets
+    of redirect pages, given known redirects map
+
+    >>> pages = [PageInfo('A', True, True, 1, None, 1, 0),
+    ...          PageInfo('B', True, False, 1, None, 2, 0)]
+    >>> redirect_titles(pages, {}), redirect_titles(pages, {'A': Redirect('C', '')})
+    (['A'], ['C'])
+
+    """
+    # known redirects tell us the targets, but not their current info;
+    # redirects created since map was loaded are resolved by the query too
+    titles = set()
+    for page in pages:
+        if page.exists and page.redirect:
+            titles.add(follow_redirects(known, page.name)[0] or page.name)
+    return sorted(titles)
+
+
+def redirect_targets(pages, hops, infos, known, aliases_by_target):
+    """For each page yield page, its target and target's aliases (see
+    with_redirect_targets) from redirects map hops and PageInfo of
+    targets by title, as returned by resolve_redirects for redirect_titles
+    """
+    hops = collections.ChainMap(hops, known)
+    for page in pages:
+        if not (page.exists and page.redirect):
+            yield page, page, set(aliases_by_target.get(page.name, ()))
+            continue
+        title, aliases = follow_redirects(hops, page.name)
+        target = infos.get(title)
+        if target is None or not target.exists or target.redirect:
+            yield page, None, aliases
+            continue
+        aliases.update(aliases_by_target.get(title, ()))
+        yield page, target, aliases
+
+
+LOCAL_STORE_PREFIX = "sqlite:"
 
 
 def scheme_and_host(site_host):
@@ -281,6 +1291,12 @@ def scheme_and_host(site_host):
 
 
 def mkcouch(url):
+    if url.startswith(LOCAL_STORE_PREFIX):
+        path = url[len(LOCAL_STORE_PREFIX) :]
+        if path.startswith("//"):
+            path = path[2:]
+        print("Using local database %s" % path)
+        return LocalServer(os.path.expanduser(path))
     parsed = urlparse(url)
     server_url = parsed.scheme + "://" + parsed.netloc
     server = couchdb.Server(server_url)
@@ -313,18 +1329,291 @@ def fmt_mw_tms(dt):
     return datetime.strftime(dt, "%Y%m%d%H%M%S")
 
 
+# format of MediaWiki API timestamps
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def recent_changes(site, start, namespaces=(0,)):
+    """Article edits and creations in namespaces
+    since start timestamp, oldest first
+    """
+    return site.recentchanges(
+        start=start,
+        namespace="|".join(str(namespace) for namespace in namespaces),
+        toponly=1,
+        type="edit|new",
+        dir="newer",
+        show="!minor|!redirect|!anon|!bot",
+    )
+
+
+def changes_after(changes, watermark):
+    """Changes after watermark, (timestamp, rcid) of the last change
+    processed, with only the latest change of each title, ordered
+    by latest changes. Returns changes and new watermark
+
+    >>> changes, watermark = changes_after([
+    ...     {'title': 'A', 'timestamp': '2020-01-01T00:00:00Z', 'rcid': 1},
+    ...     {'title': 'B', 'timestamp': '2020-01-01T00:00:00Z', 'rcid': 2},
+    ...     {'title': 'A', 'timestamp': '2020-01-02T00:00:00Z', 'rcid': 3},
+    ... ], ('2020-01-01T00:00:00Z', 1))
+    >>> [change['title'] for change in changes], watermark
+    (['B', 'A'], ('2020-01-02T00:00:00Z', 3))
+
+    """
+    watermark = tuple(watermark)
+    latest = collections.OrderedDict()
+    last = watermark
+    for change in changes:
+        timestamp = change["timestamp"]
+        if isinstance(timestamp, time.struct_time):
+            # as parsed by mwclient
+            timestamp = time.strftime(TIMESTAMP_FORMAT, timestamp)
+        mark = (timestamp, change["rcid"])
+        if mark <= watermark:
+            continue
+        last = max(last, mark)
+        if change.get("title"):
+            latest.pop(change["title"], None)
+            latest[change["title"]] = change
+    return list(latest.values()), last
+
+
+def scrape_async(
+    args,
+    pages,
+    session,
+    site,
+    couch_server,
+    db_name,
+    controller=None,
+    compressor=None,
+    parse_cache=None,
+    parse_profile="full",
+    redirects=None,
+):
+    from . import aioscrape
+
+    asyncio.run(
+        aioscrape.scrape(
+            args,
+            pages,
+            session,
+            site_url=(site.scheme, site.host, site.path, site.ext),
+            couch_url=couch_server.resource.url,
+            credentials=couch_server.resource.credentials,
+            db_name=db_name,
+            controller=controller,
+            compressor=compressor,
+            parse_cache=parse_cache,
+            parse_profile=parse_profile,
+            redirects=redirects,
+        )
+    )
+
+
+def mark_completed(sessions_db, session_id):
+    while True:
+        session_doc = sessions_db[session_id]
+        session_doc["completed_at"] = datetime.utcnow().isoformat()
+        try:
+            sessions_db[session_id] = session_doc
+        except couchdb.ResourceConflict:
+            continue
+        break
+
+
+def new_session(
+    sessions_db,
+    site_host,
+    db_name,
+    descending=False,
+    end=None,
+    follow=False,
+    namespaces=(0,),
+    parse_profile="full",
+):
+    session_id = "-".join(
+        (db_name, str(int(time.time())), str(int(1000 * random.random())))
+    )
+    session_doc = {
+        "created_at": datetime.utcnow().isoformat(),
+        "site": site_host,
+        "db_name": db_name,
+        "descending": descending,
+        "end": end,
+        "follow": follow,
+        "namespaces": list(namespaces),
+        "parse_profile": parse_profile,
+    }
+    sessions_db[session_id] = session_doc
+    return session_id, session_doc
+
+
+def get_sessions_db(couch_server, name):
+    try:
+        return couch_server.create(name)
+    except couchdb.PreconditionFailed:
+        return couch_server[name]
+
+
+def serve_metrics(args):
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+        print("Serving metrics at http://127.0.0.1:%d/metrics" % args.metrics_port)
+    if args.metrics_interval:
+        metrics.report_every(args.metrics_interval)
+
+
+def site_argvs(lines):
+    """Arguments for each site in lines of sites file,
+    blank lines and comments are skipped
+
+    >>> site_argvs(['en.wiktionary.org --speed 2', '', '# comment',
+    ...             "de.wikipedia.org --db 'de wp'  # wikipedia"])
+    [['en.wiktionary.org', '--speed', '2'], ['de.wikipedia.org', '--db', 'de wp']]
+
+    """
+    argvs = (shlex.split(line, comments=True) for line in lines)
+    return [argv for argv in argvs if argv]
+
+
+def scrape_sites(args):
+    """Scrape sites listed in args.sites file in threads of this process,
+    up to args.max_sites at a time, sharing CouchDB connections.
+    Sites on the same host are scraped one after another.
+    Each site gets its own session recorded in $sites document
+    of sessions database, so that next time unfinished sessions are resumed.
+    When interrupted, sites being scraped are stopped, saving
+    what they have scraped so far
+    """
+    with open(os.path.expanduser(args.sites)) as f:
+        argvs = site_argvs(f)
+    couch_server = mkcouch(args.couch)
+    sessions_db = get_sessions_db(couch_server, args.sessions_db_name)
+    sites_doc = sessions_db.get("$sites", {})
+    sessions = sites_doc.setdefault("sessions", {})
+    by_host = collections.OrderedDict()
+    for argv in argvs:
+        site_args = copy.copy(args)
+        # options given for the site override those given on command line
+        site_args.site = site_args.db = site_args.sites = None
+        parse_args(argv, namespace=site_args)
+        if not site_args.site:
+            print("Site is not specified: %s" % " ".join(argv))
+            raise SystemExit(1)
+        _, host = scheme_and_host(site_args.site)
+        db_name = site_args.db or host.replace(".", "-")
+        session_id = sessions.get(db_name)
+        session_doc = sessions_db.get(session_id) if session_id else None
+        if session_doc is None or session_doc.get("completed_at"):
+            session_id, _ = new_session(
+                sessions_db,
+                site_args.site,
+                db_name,
+                site_args.desc,
+                site_args.end,
+                site_args.follow,
+                site_args.namespace or [0],
+                site_args.parse_profile or "full",
+            )
+            sessions[db_name] = session_id
+        site_args.resume = session_id
+        # metrics are shared by all sites
+        site_args.metrics_port = None
+        site_args.metrics_interval = 0
+        by_host.setdefault(host, []).append(site_args)
+    sessions_db["$sites"] = sites_doc
+    serve_metrics(args)
+
+    queue = collections.deque(by_host.values())
+    stop = threading.Event()
+
+    def run():
+        while not stop.is_set():
+            try:
+                host_sites = queue.popleft()
+            except IndexError:
+                return
+            for site_args in host_sites:
+                if stop.is_set():
+                    return
+                try:
+                    scrape_site(site_args, couch_server, stop=stop)
+                except (Exception, SystemExit):
+                    print("Failed to scrape %s" % site_args.site)
+                    traceback.print_exc()
+
+    threads = [
+        threading.Thread(target=run, name="site-%d" % i)
+        for i in range(min(args.max_sites or len(queue), len(queue)))
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        # not join(): KeyboardInterrupt while joining may leave thread
+        # marked as stopped, and then it isn't waited for
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    finally:
+        if any(thread.is_alive() for thread in threads):
+            print("Stopping, waiting for sites to save scraped pages")
+        stop.set()
+        for thread in threads:
+            if thread.ident is not None:
+                thread.join()
+
+
 def main():
     args = parse_args()
 
+    if args.profile:
+        profile_to(args.profile)
+
+    if args.sites:
+        scrape_sites(args)
+    else:
+        scrape_site(args)
+
+
+def scrape_site(args, couch_server=None, stop=None):
+    """Scrape site given by args. If stop event is given, scraping
+    stops when it is set: pages already being scraped are saved,
+    session is left unfinished, to be resumed
+    """
+    if stop is None:
+        stop = threading.Event()
+
+    if args.engine == "async":
+        try:
+            import aiohttp  # noqa: F401
+        except ImportError:
+            print("Async engine requires aiohttp, install it with pip install aiohttp")
+            raise SystemExit(1)
+
+    if args.compress == "zstd" or args.zstd_dict:
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            print(
+                "zstd compression requires zstandard, "
+                "install it with pip install zstandard"
+            )
+            raise SystemExit(1)
+        if args.compress != "zstd":
+            print("--zstd-dict requires --compress zstd")
+            raise SystemExit(1)
+
     socket.setdefaulttimeout(args.timeout)
 
-    couch_server = mkcouch(args.couch)
+    if couch_server is None:
+        couch_server = mkcouch(args.couch)
 
-    sessions_db_name = args.sessions_db_name
-    try:
-        sessions_db = couch_server.create(sessions_db_name)
-    except couchdb.PreconditionFailed:
-        sessions_db = couch_server[sessions_db_name]
+    if args.engine == "async" and isinstance(couch_server, LocalServer):
+        print("Async engine requires CouchDB")
+        raise SystemExit(1)
+
+    sessions_db = get_sessions_db(couch_server, args.sessions_db_name)
 
     if args.resume or args.resume is None:
         session_id = args.resume
@@ -345,28 +1634,37 @@ def main():
             descending = True
         else:
             descending = session_doc.get("descending", False)
+        end_page_name = args.end or session_doc.get("end")
+        follow = args.follow or session_doc.get("follow", False)
+        namespaces = args.namespace or session_doc.get("namespaces", [0])
+        parse_profile = args.parse_profile or session_doc.get("parse_profile", "full")
         sessions_db[session_id] = session_doc
     else:
         site_host = args.site
         db_name = args.db
         start_page_name = args.start
+        end_page_name = args.end
         descending = args.desc
+        follow = args.follow
+        namespaces = args.namespace or [0]
+        parse_profile = args.parse_profile or "full"
         if not site_host:
             print("Site to scrape is not specified")
             raise SystemExit(1)
         scheme, host = scheme_and_host(site_host)
         if not db_name:
             db_name = host.replace(".", "-")
-        session_id = "-".join(
-            (db_name, str(int(time.time())), str(int(1000 * random.random())))
+        session_id, session_doc = new_session(
+            sessions_db,
+            site_host,
+            db_name,
+            descending,
+            end_page_name,
+            follow,
+            namespaces,
+            parse_profile,
         )
         print("Starting session %s" % session_id)
-        sessions_db[session_id] = {
-            "created_at": datetime.utcnow().isoformat(),
-            "site": site_host,
-            "db_name": db_name,
-            "descending": descending,
-        }
         current_doc = sessions_db.get("$current", {})
         current_doc["session_id"] = session_id
         sessions_db["$current"] = current_doc
@@ -374,15 +1672,32 @@ def main():
     headers = {}
     if args.user_agent:
         headers = {"User-Agent": args.user_agent}
-    site = mwclient.Site(
-        host,
+    site_kwargs = dict(
         path=args.site_path,
         ext=args.site_ext,
         scheme=scheme,
         custom_headers=headers,
     )
+    controller = None
+    if args.adaptive or args.max_rps:
+        if args.engine == "async":
+            max_concurrency = args.connections
+        else:
+            max_concurrency = args.max_concurrency
+        controller = RateController(
+            max_rate=args.max_rps,
+            adaptive=args.adaptive,
+            max_concurrency=max_concurrency,
+        )
+        site = ThrottledSite(
+            host, controller=controller, maxlag=args.maxlag, **site_kwargs
+        )
+    else:
+        site = mwclient.Site(host, **site_kwargs)
 
-    update_siteinfo(site, couch_server, db_name)
+    # partition workers leave it to their coordinator
+    if "parent" not in session_doc:
+        update_siteinfo(site, couch_server, db_name)
 
     if args.siteinfo_only:
         return
@@ -392,7 +1707,74 @@ def main():
     except couchdb.PreconditionFailed:
         db = couch_server[db_name]
 
-    set_show_func(db)
+    # show function of older versions can't display compressed
+    # or prerendered articles
+    set_show_func(db, force=bool(args.compress or args.prerender))
+    # older revid view doesn't have parse profiles
+    if set_revid_view(db, force=parse_profile != "full"):
+        print(
+            "Building revid index of %s, "
+            "on big databases this takes a while" % db_name
+        )
+    started = time.time()
+    update_revid_index(db)
+    if time.time() - started > 1:
+        print("Revid index updated in %.0fs" % (time.time() - started))
+
+    compressor = None
+    if args.compress:
+        dictionary = None
+        if args.zstd_dict:
+            dictionary = load_zstd_dict(args.zstd_dict)
+            save_zstd_dict(db, dictionary)
+        compressor = Compressor(
+            args.compress, level=args.compress_level, dictionary=dictionary
+        )
+
+    if args.titles and len(namespaces) > 1:
+        print("Titles can only be given for one namespace")
+        raise SystemExit(1)
+
+    if args.workers or "partitions" in session_doc:
+        if args.titles or args.changes_since or args.recent or descending or follow:
+            print("Only ascending scrape of all pages can be partitioned")
+            raise SystemExit(1)
+        if len(namespaces) > 1:
+            print("Only scrape of one namespace can be partitioned")
+            raise SystemExit(1)
+        lock_path = os.path.join(
+            tempfile.gettempdir(), hashlib.sha1(host.encode("utf-8")).hexdigest()
+        )
+        with flock(lock_path):
+            if "partitions" not in session_doc:
+                print("Splitting pages into %d partitions" % args.workers)
+                prefix = namespace_prefix(site, namespaces[0])
+                bounds = partition_bounds(
+                    site,
+                    args.workers,
+                    namespace=namespaces[0],
+                    start=strip_namespace(start_page_name, prefix),
+                    end=strip_namespace(end_page_name, prefix),
+                    prefix=prefix,
+                )
+                create_partitions(sessions_db, session_id, session_doc, bounds)
+            coordinate(
+                args,
+                sessions_db,
+                session_id,
+                session_doc["partitions"],
+                selected=args.partitions,
+            )
+        return
+
+    writer = BulkWriter(
+        db,
+        max_docs=args.bulk_docs,
+        max_bytes=int(args.bulk_mb * 1024 * 1024),
+        max_delay=args.bulk_delay,
+        on_conflict=lambda doc: merge_into_current(doc, db.get(doc["_id"])),
+        save_docs=db.bulk_docs if isinstance(couch_server, LocalServer) else None,
+    )
 
     def titles_from_args(titles):
         for title in titles:
@@ -403,65 +1785,185 @@ def main():
             else:
                 yield title
 
-    def recently_changed_pages(timestamp):
-        changes = site.recentchanges(
-            start=timestamp,
-            namespace=0,
-            toponly=1,
-            type="edit|new",
-            dir="newer",
-            show="!minor|!redirect|!anon|!bot",
-        )
-        for page in changes:
-            title = page.get("title")
-            if title:
-                doc = db.get(title)
-                doc_revid = doc.get("parse", {}).get("revid") if doc else None
-                revid = page.get("revid")
-                if doc_revid == revid:
+    def recently_changed_pages(changes):
+        changes = (page for page in changes if page.get("title"))
+        for batch in batches(changes, REVID_BATCH_SIZE):
+            index = revid_index(db, {page["title"] for page in batch})
+            for page in batch:
+                title = page["title"]
+                entry = index.get(title)
+                if entry and is_current(entry, page.get("revid"), parse_profile):
                     continue
                 yield title
 
-    page_list = mwclient.listing.PageList(site, namespace=args.namespace)
-
-    if args.titles:
-        pages = (page_list[title] for title in titles_from_args(args.titles))
-    elif args.changes_since or args.recent:
-        if args.recent:
-            recent_days = args.recent_days
-            changes_since = fmt_mw_tms(datetime.utcnow() + timedelta(days=-recent_days))
+    def with_namespace(titles):
+        if namespaces[0] == 0:
+            return titles
+        prefix = site.namespaces[namespaces[0]] + ":"
+        return (prefix + title for title in titles)
+
+    changes_since = None
+    if args.recent:
+        recent_days = args.recent_days
+        changes_since = fmt_mw_tms(datetime.utcnow() + timedelta(days=-recent_days))
+    elif args.changes_since:
+        changes_since = args.changes_since.ljust(14, "0")
+
+    if follow:
+        # pages come from recent changes polled in scrape loop below
+        pages = None
+        if "rc_timestamp" in session_doc:
+            watermark = (session_doc["rc_timestamp"], session_doc["rc_id"])
         else:
-            changes_since = args.changes_since.ljust(14, "0")
+            start = datetime.utcnow()
+            if changes_since:
+                start = datetime.strptime(changes_since, "%Y%m%d%H%M%S")
+            watermark = (start.strftime(TIMESTAMP_FORMAT), 0)
+    elif args.titles:
+        pages = titles_info(site, with_namespace(titles_from_args(args.titles)))
+    elif changes_since:
         print("Getting recent changes (since %s)" % changes_since)
-        pages = (page_list[title] for title in recently_changed_pages(changes_since))
+        pages = titles_info(
+            site,
+            recently_changed_pages(recent_changes(site, changes_since, namespaces)),
+        )
 
-    else:
+    elif len(namespaces) == 1:
         print("Starting at %s" % start_page_name)
-        pages = site.allpages(
+        pages = allpages_info(
+            site,
             start=start_page_name,
-            namespace=args.namespace,
-            dir="descending" if descending else "ascending",
+            namespace=namespaces[0],
+            descending=descending,
+            end=end_page_name,
         )
+    else:
+        # pages of all namespaces are scraped at once,
+        # each namespace is resumed from its own last page
+        last_page_names = session_doc.get("last_page_names", {})
+        sources = []
+        for namespace in namespaces:
+            start = args.start or last_page_names.get(str(namespace))
+            print("Starting namespace %d at %s" % (namespace, start))
+            sources.append(
+                allpages_info(
+                    site,
+                    start=start,
+                    namespace=namespace,
+                    descending=descending,
+                    end=end_page_name,
+                )
+            )
+        pages = interleave(sources)
+
+    parse_cache = None
+    if args.parse_cache:
+        parse_cache = ParseCache(
+            args.parse_cache,
+            max_bytes=int(args.parse_cache_mb * 1024 * 1024),
+            profile=parse_profile,
+        )
+        metrics.gauge("parse_cache_hits", lambda: parse_cache.hits, site=host)
+
+    seen_capacity = args.seen_capacity
+    if not seen_capacity and not follow:
+        seen_capacity = site_page_count(site)
+        if "parent" in session_doc:
+            partitions = sessions_db[session_doc["parent"]]["partitions"]
+            seen_capacity //= len(partitions)
+    seen_capacity = max(seen_capacity or 0, MIN_SEEN_CAPACITY)
+    if args.seen_dir:
+        os.makedirs(args.seen_dir, exist_ok=True)
+        seen = SeenTitles(
+            os.path.join(args.seen_dir, session_id + ".sqlite"),
+            capacity=seen_capacity,
+        )
+    else:
+        seen = SeenTitles(capacity=seen_capacity)
+
+    session = Session(
+        sessions_db,
+        session_id,
+        flush_interval=args.session_flush_interval,
+        on_done=seen.done,
+        by_namespace=len(namespaces) > 1,
+        site=host,
+    )
+    inc_count = session.inc
+
+    metrics.gauge("pages_in_progress", session.in_progress, site=host)
+    metrics.gauge("writer_buffer_docs", lambda: len(writer.buffer), site=host)
+    if controller:
+        metrics.gauge("concurrency_limit", lambda: controller.limit, site=host)
+    serve_metrics(args)
+
+    def process(item):
+        token, page, entry, target, aliases = item
+        # page is done when it's processed,
+        # or when it's saved if it was handed to the writer;
+        # result is True if handed to the writer, False if failed
+        result = False
+        try:
+            result = process_page(page, entry, token, target, aliases)
+        finally:
+            if not result:
+                session.done(token, ok=result is None)
+
+    def scrape_page(page, title, aliases, entry, token):
+        # page may have been just scraped as a redirect target
+        # and still be waiting to be saved
+        if writer.update_pending(title, lambda doc: add_aliases(doc, aliases)):
+            print("%s is up to date (just scraped), skipping" % title)
+            inc_count("up_to_date")
+            return
 
-    # threads are updating the same session document,
-    # we don't want to have conflicts
-    lock = RLock()
-
-    def inc_count(count_name):
-        with lock:
-            session_doc = sessions_db[session_id]
-            count = session_doc.get(count_name, 0)
-            session_doc[count_name] = count + 1
-            sessions_db[session_id] = session_doc
-
-    def update_session(title):
-        with lock:
-            session_doc = sessions_db[session_id]
-            session_doc["last_page_name"] = title
-            session_doc["updated_at"] = datetime.utcnow().isoformat()
-            sessions_db[session_id] = session_doc
-
-    def process(page):
+        saved_entry = writer.saved_entry(title)
+        if saved_entry:
+            entry = saved_entry
+
+        action, entry = scrape_action(page, aliases, entry, parse_profile)
+        if action != PARSE:
+            print("%s is up to date (rev. %s), skipping" % (title, entry["revid"]))
+            inc_count("up_to_date")
+            if action == ADD_ALIASES:
+                with metrics.timer("couch_get"):
+                    doc = db[title]
+                # entry may be older than the document
+                if not add_aliases(doc, aliases):
+                    return
+                writer.save(doc, saved_callback(session, token))
+                return True
+            return
+        if entry:
+            print(revision_change(page, entry, parse_profile))
+        if args.delay:
+            time.sleep(args.delay)
+        doc = None
+        if parse_cache:
+            with metrics.timer("parse_cache"):
+                doc = parse_cache.get_doc(
+                    title, page.revision, compressor, args.prerender
+                )
+        if doc is None:
+            with metrics.timer("parse"):
+                parse_params = PARSE_PROFILES[parse_profile]
+                if compressor or args.prerender:
+                    doc = site.api("parse", page=title, **parse_params)
+                else:
+                    doc = raw_parse(site, title, **parse_params)
+            if parse_cache:
+                with metrics.timer("parse_cache_put"):
+                    parse_cache.put_doc(title, doc)
+            if compressor or args.prerender:
+                with metrics.timer("compress" if compressor else "prerender"):
+                    doc = stored_doc(doc, compressor, args.prerender)
+        doc = article_doc(doc, title, aliases, entry, parse_profile)
+        writer.save(doc, saved_callback(session, token, "updated" if entry else "new"))
+        return True
+
+    title_locks = [threading.Lock() for _ in range(64)]
+
+    def process_page(page, entry, token, target, aliases):
         title = page.name
         if not page.exists:
             print("Not found: %s" % title)
@@ -479,121 +1981,147 @@ def main():
                     print("%s removed from the database" % title)
             return
         try:
-            aliases = set()
-            redirect_count = 0
-            while page.redirect:
-                redirect_count += 1
-                redirect_target = redirects_to(site, page.name)
-                frag = redirect_target.fragment
-                if frag:
-                    alias = (title, frag)
-                else:
-                    alias = title
-                aliases.add(alias)
-
-                page = redirect_target.page
-                print("%s ==> %s" % (title, page.name + (("#" + frag) if frag else "")))
-
-                if redirect_count >= 10:
-                    print("Too many redirect levels: %r" % aliases)
-                    break
-
-                title = page.name
-
-            if page.redirect:
-                print("Failed to resolve redirect %s", title)
+            if target is None:
+                print("Failed to resolve redirect %s" % title)
                 inc_count("failed_redirect")
-                return
-
-            doc = db.get(title)
-            if doc:
-                current_aliases = set()
-                for alias in doc.get("aliases", ()):
-                    if isinstance(alias, list):
-                        alias = tuple(alias)
-                    current_aliases.add(alias)
-                if not aliases.issubset(current_aliases):
-                    merged_aliases = aliases | current_aliases
-                    # remove aliases without fragment if one with fragment is present
-                    # this is mostly to cleanup aliases in old scrapes
-                    to_remove = set()
-                    for alias in merged_aliases:
-                        if isinstance(alias, tuple):
-                            to_remove.add(alias[0])
-                    merged_aliases = merged_aliases - to_remove
-                    doc["aliases"] = list(merged_aliases)
-                    db[title] = doc
-                revid = doc.get("parse", {}).get("revid")
-                if page.revision == revid:
-                    print("%s is up to date (rev. %s), skipping" % (title, revid))
-                    inc_count("up_to_date")
-                    return
-                inc_count("updated")
-                print(
-                    "[%s] rev. %s => %s %s"
-                    % (
-                        time.strftime("%x %X", (page.touched)) if page.touched else "?",
-                        revid,
-                        page.revision,
-                        title,
-                    )
-                )
-            if args.delay:
-                time.sleep(args.delay)
-            parse = site.api("parse", page=title)
+                return False
+            if target is not page:
+                print("%s ==> %s" % (title, target.name))
+                page = target
+                title = target.name
+
+            # redirects and their targets may be processed concurrently,
+            # only one thread at a time may check and scrape a title
+            with title_locks[hash(title) % len(title_locks)]:
+                return scrape_page(page, title, aliases, entry, token)
         except KeyboardInterrupt as kbd:
             print("Caught KeyboardInterrupt", kbd)
             _thread.interrupt_main()
+            return False
         except couchdb.ResourceConflict:
             print("Update conflict, skipping: %s" % title)
-            return
+            return False
         except Exception:
             print("Failed to process %s:" % title)
             traceback.print_exc()
             inc_count("error")
-            return
-        if doc:
-            doc.update(parse)
-        else:
-            inc_count("new")
-            doc = parse
-            if aliases:
-                doc["aliases"] = list(aliases)
-        try:
-            db[title] = doc
-        except couchdb.ResourceConflict:
-            print("Update conflict, skipping: %s" % title)
-            return
-        except Exception:
-            print("Error handling title %r" % title)
-            traceback.print_exc()
-
-    seen = pylru.lrucache(10000)
+            return False
 
     def ipages(pages):
         for index, page in enumerate(pages):
+            if stop.is_set():
+                print("Stopping %s" % host)
+                return
             title = page.name
             print("%7s %s" % (index, title))
-            if title in seen:
+            # followed titles may change again later
+            if not follow and seen.add(title):
                 print("Already saw %s, skipping" % (title,))
                 continue
-            seen[title] = True
-            update_session(title)
             yield page
 
-    with flock(
-        os.path.join(
-            tempfile.gettempdir(), hashlib.sha1(host.encode("utf-8")).hexdigest()
-        )
-    ):
-        if args.speed and not args.delay:
-            pool = ThreadPool(processes=args.speed * 2)
-            for _result in pool.imap(process, ipages(pages)):
+    def with_revids(pages):
+        for batch in batches(pages, REVID_BATCH_SIZE):
+            index = revid_index(
+                db, [target.name for _, target, _ in batch if target and target.exists]
+            )
+            for page, target, aliases in batch:
+                entry = index.get(target.name) if target else None
+                token = session.start(page.name, page.namespace)
+                yield token, page, entry, target, aliases
+
+    redirects = None
+    if args.redirect_map:
+        print("Loading redirects")
+        redirects = {}
+        for namespace in namespaces:
+            redirects.update(all_redirects(site, namespace=namespace))
+        print("Loaded %d redirects" % len(redirects))
+
+    pool = None
+    if args.engine != "async" and (args.adaptive or (args.speed and not args.delay)):
+        if args.adaptive:
+            # controller decides how many of these are
+            # actually making requests at any given time
+            processes = args.max_concurrency
+        else:
+            processes = args.speed * 2
+        pool = ThreadPool(processes=processes)
+
+    def scrape_pages(pages):
+        if args.engine == "async":
+            # async engine resolves redirects itself
+            scrape_async(
+                args,
+                ipages(pages),
+                session,
+                site,
+                couch_server,
+                db_name,
+                controller=controller,
+                compressor=compressor,
+                parse_cache=parse_cache,
+                parse_profile=parse_profile,
+                redirects=redirects,
+            )
+            return
+        targets = with_redirect_targets(site, ipages(pages), redirects)
+        if pool:
+            for _result in pool.imap(process, with_revids(targets)):
                 pass
-
         else:
-            for page in ipages(pages):
-                process(page)
+            for item in with_revids(targets):
+                process(item)
+
+    def follow_changes(watermark):
+        while not stop.is_set():
+            polled_at = time.time()
+            changes, last = changes_after(
+                recent_changes(site, watermark[0], namespaces), watermark
+            )
+            if changes:
+                print("%d page(s) changed since %s" % (len(changes), watermark[0]))
+                scrape_pages(titles_info(site, recently_changed_pages(changes)))
+                # including pages handed to the writer
+                session.wait_idle()
+            if last != watermark:
+                watermark = last
+                session.flush(rc_timestamp=watermark[0], rc_id=watermark[1])
+            stop.wait(max(0, args.follow_interval - (time.time() - polled_at)))
+
+    lock_name = host
+    if "partition" in session_doc:
+        # workers scraping other partitions of the same site may be running
+        lock_name = "|".join((host, session_doc["start"] or "", end_page_name or ""))
+    lock_path = os.path.join(
+        tempfile.gettempdir(), hashlib.sha1(lock_name.encode("utf-8")).hexdigest()
+    )
+    completed = False
+    with flock(lock_path):
+        try:
+            if follow:
+                print("Following recent changes since %s" % watermark[0])
+                follow_changes(watermark)
+            else:
+                scrape_pages(pages)
+            completed = not stop.is_set()
+        finally:
+            if pool:
+                # pages handed to pool are all done, unless scraping
+                # failed, then those not started yet are dropped
+                pool.terminate()
+                pool.join()
+            writer.close()
+            session.close()
+            seen.close()
+            if parse_cache:
+                parse_cache.close()
+
+    print("[metrics] %s: %s" % (host, metrics.summary(site=host)[0]))
+    metrics.remove_gauges(host)
+
+    if completed:
+        mark_completed(sessions_db, session_id)
 
 
 if __name__ == "__main__":
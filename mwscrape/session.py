@@ -0,0 +1,202 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import collections
+import threading
+import traceback
+
+from datetime import datetime
+
+import couchdb
+
+from .metrics import metrics
+
+
+class Frontier:
+    """Keeps track of titles being processed concurrently,
+    in the order they were dispatched, and of the last title
+    such that it and all titles dispatched before it are done.
+
+    >>> frontier = Frontier()
+    >>> a, b, c = frontier.start('A'), frontier.start('B'), frontier.start('C')
+    >>> frontier.done(b), frontier.last
+    (False, None)
+    >>> frontier.done(a), frontier.last
+    (True, 'B')
+    >>> frontier.done(c), frontier.last, frontier.in_flight
+    (True, 'C', 0)
+
+    """
+
+    def __init__(self):
+        self.next_token = 0
+        self.pending = collections.OrderedDict()
+        self.last = None
+
+    def start(self, title):
+        token = self.next_token
+        self.next_token += 1
+        self.pending[token] = [title, False]
+        return token
+
+    def done(self, token):
+        """Mark title as done, return True if frontier moved"""
+        self.pending[token][1] = True
+        moved = False
+        while self.pending:
+            token, (title, is_done) = next(iter(self.pending.items()))
+            if not is_done:
+                break
+            del self.pending[token]
+            self.last = title
+            moved = True
+        return moved
+
+    @property
+    def in_flight(self):
+        return len(self.pending)
+
+
+class Session:
+    """Scrape session stats (page counts and last page name)
+    kept in memory and saved to session document in sessions
+    database every flush_interval seconds and when session is closed.
+    Counts are added to those already in the session document,
+    so resumed sessions keep accumulating them.
+
+    Last page name is the resume point: pages are started in the order
+    of the page source and may finish in any order, last page name
+    is the last one such that all pages started before it are done.
+    If by_namespace is True, pages of each namespace are tracked
+    separately and last page names are saved by namespace,
+    for sessions that scrape several namespaces at once.
+    If on_done is given, it is called with title of each page that is done
+    successfully (saved, up to date or not found), pages that failed
+    are left to be retried. Page counts are also reported to metrics,
+    labeled with site if given.
+    """
+
+    def __init__(
+        self,
+        sessions_db,
+        session_id,
+        flush_interval=10.0,
+        on_done=None,
+        by_namespace=False,
+        site=None,
+    ):
+        self.sessions_db = sessions_db
+        self.session_id = session_id
+        self.flush_interval = flush_interval
+        self.on_done = on_done
+        self.by_namespace = by_namespace
+        self.site = site
+        self.counts = collections.Counter()
+        # by namespace (as string, like JSON object keys), or None
+        self.last_page_names = {}
+        self.frontiers = collections.defaultdict(Frontier)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="session-checkpoint", daemon=True
+        )
+        self.thread.start()
+
+    def inc(self, count_name):
+        with self.lock:
+            self.counts[count_name] += 1
+        metrics.inc(count_name, site=self.site)
+
+    def in_progress(self):
+        """Number of pages started and not done yet"""
+        with self.lock:
+            return sum(
+                1
+                for frontier in self.frontiers.values()
+                for _, done in frontier.pending.values()
+                if not done
+            )
+
+    def start(self, title, namespace=0):
+        """Record that processing of page title started,
+        return token to pass to done()
+        """
+        key = str(namespace) if self.by_namespace else None
+        with self.lock:
+            return key, self.frontiers[key].start(title)
+
+    def done(self, token, ok=True):
+        key, frontier_token = token
+        with self.lock:
+            frontier = self.frontiers[key]
+            title = frontier.pending[frontier_token][0]
+            if frontier.done(frontier_token):
+                self.last_page_names[key] = frontier.last
+            if not self.in_flight():
+                self.idle.notify_all()
+        if self.on_done and ok:
+            self.on_done(title)
+
+    def in_flight(self):
+        return sum(frontier.in_flight for frontier in self.frontiers.values())
+
+    def wait_idle(self):
+        """Wait until all pages started are done"""
+        with self.lock:
+            self.idle.wait_for(lambda: not self.in_flight())
+
+    def run(self):
+        while not self.closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                print("Failed to save session %s" % self.session_id)
+                traceback.print_exc()
+
+    def flush(self, **fields):
+        """Save stats and given fields to session document"""
+        with self.flush_lock:
+            with self.lock:
+                counts, self.counts = self.counts, collections.Counter()
+                last_page_names, self.last_page_names = self.last_page_names, {}
+            if not counts and not last_page_names and not fields:
+                return
+            try:
+                self.save(counts, last_page_names, fields)
+            except Exception:
+                # keep stats to save them with the next checkpoint
+                with self.lock:
+                    self.counts.update(counts)
+                    for key, name in last_page_names.items():
+                        self.last_page_names.setdefault(key, name)
+                raise
+
+    def save(self, counts, last_page_names, fields=None):
+        while True:
+            session_doc = self.sessions_db[self.session_id]
+            session_doc.update(fields or {})
+            for count_name, count in counts.items():
+                session_doc[count_name] = session_doc.get(count_name, 0) + count
+            if last_page_names:
+                for key, name in last_page_names.items():
+                    if key is None:
+                        session_doc["last_page_name"] = name
+                    else:
+                        session_doc.setdefault("last_page_names", {})[key] = name
+                session_doc["updated_at"] = datetime.utcnow().isoformat()
+            try:
+                self.sessions_db[self.session_id] = session_doc
+            except couchdb.ResourceConflict:
+                continue
+            break
+
+    def close(self):
+        """Stop periodic checkpoints and save current stats"""
+        self.closed.set()
+        self.thread.join()
+        self.flush()
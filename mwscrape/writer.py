@@ -0,0 +1,243 @@
+# Copyright (C) 2013-2014 Igor Tkach
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import functools
+import threading
+import time
+import traceback
+
+import couchdb
+import pylru
+
+from .metrics import metrics
+from .rawdoc import encode_doc
+
+
+def bulk_docs_body(encoded_docs):
+    """_bulk_docs request body with JSON encoded documents
+
+    >>> bulk_docs_body([b'{"_id":"A"}', b'{"_id":"B"}'])
+    b'{"docs":[{"_id":"A"},{"_id":"B"}]}'
+
+    """
+    return b'{"docs":[' + b",".join(encoded_docs) + b"]}"
+
+
+def bulk_docs_results(data):
+    """New revisions or exceptions, one per document,
+    from decoded _bulk_docs response
+
+    >>> bulk_docs_results([{'id': 'A', 'rev': '1-a'},
+    ...                    {'id': 'B', 'error': 'conflict', 'reason': 'x'}])
+    ['1-a', ResourceConflict(('conflict', 'x'))]
+
+    """
+    results = []
+    for result in data:
+        if "error" in result:
+            if result["error"] == "conflict":
+                exc_type = couchdb.ResourceConflict
+            else:
+                exc_type = couchdb.ServerError
+            results.append(exc_type((result["error"], result.get("reason"))))
+        else:
+            results.append(result["rev"])
+    return results
+
+
+def index_entry(doc, rev):
+    """Revid index entry of doc saved as revision rev"""
+    return {
+        "rev": rev,
+        "revid": doc.get("parse", {}).get("revid"),
+        "aliases": doc.get("aliases", []),
+        "profile": doc.get("parse_profile"),
+    }
+
+
+def bulk_docs(db, encoded_docs):
+    """Save JSON encoded documents in CouchDB database db
+    with a single _bulk_docs request.
+    Returns list of new revisions or exceptions, one per document
+    """
+    _, _, data = db.resource.post_json(
+        "_bulk_docs",
+        body=bulk_docs_body(encoded_docs),
+        headers={"Content-Type": "application/json"},
+    )
+    return bulk_docs_results(data)
+
+
+class BulkWriter:
+    """Saves documents submitted by scraper threads in batches
+    with _bulk_docs. Batch is flushed when it has max_docs documents,
+    or its encoded size exceeds max_bytes, or its oldest document
+    waited for max_delay seconds. Outcome of each save is reported
+    by calling save's callback with document id and either new revision
+    or an exception (e.g. couchdb.ResourceConflict). Callbacks are called
+    from writer's thread. Writer also remembers revid index entries
+    of recently saved documents, since scraper's own index lookups
+    may have been done before these documents were saved.
+
+    If on_conflict is given, it is called with each document that
+    failed to save because of a conflict, and may return
+    a document to save instead (e.g. with changes merged into
+    current revision), which gets the same callback, called
+    with merged=True keyword argument.
+
+    Documents are saved with save_docs, called with a list
+    of JSON encoded documents and returning the same as bulk_docs.
+    By default they are saved with bulk_docs into CouchDB database db.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_docs=100,
+        max_bytes=16 * 1024 * 1024,
+        max_delay=5.0,
+        saved_cache_size=10000,
+        on_conflict=None,
+        save_docs=None,
+    ):
+        self.db = db
+        if save_docs is None:
+            save_docs = functools.partial(bulk_docs, db)
+        self.save_docs = save_docs
+        self.on_conflict = on_conflict
+        self.saved = pylru.lrucache(saved_cache_size)
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.buffer = []
+        self.pending = {}
+        self.flushing = {}
+        self.buffer_bytes = 0
+        self.buffer_started = None
+        self.closed = False
+        self.lock = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="bulk-writer", daemon=True)
+        self.thread.start()
+
+    def save(self, doc, callback=None):
+        encoded = encode_doc(doc)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Writer is closed")
+            # don't let scraper threads get too far ahead of the writer
+            while self.is_full():
+                self.lock.wait()
+            item = [doc["_id"], doc, encoded, callback]
+            self.buffer.append(item)
+            self.pending[doc["_id"]] = item
+            self.buffer_bytes += len(encoded)
+            if self.buffer_started is None:
+                self.buffer_started = time.time()
+            self.lock.notify_all()
+
+    def update_pending(self, doc_id, func):
+        """Apply func to document with doc_id if it is waiting to be saved.
+        Returns True if such document was found
+        """
+        with self.lock:
+            item = self.pending.get(doc_id)
+            if item is None:
+                return False
+            func(item[1])
+            encoded = encode_doc(item[1])
+            self.buffer_bytes += len(encoded) - len(item[2])
+            item[2] = encoded
+            return True
+
+    def saved_entry(self, doc_id):
+        """Return revid index entry for document with doc_id
+        if it was recently saved by this writer
+        """
+        with self.lock:
+            while doc_id in self.flushing:
+                self.lock.wait()
+            return self.saved.get(doc_id)
+
+    def is_full(self):
+        return len(self.buffer) >= self.max_docs or self.buffer_bytes >= self.max_bytes
+
+    def is_due(self):
+        if not self.buffer:
+            return False
+        if self.closed or self.is_full():
+            return True
+        return time.time() - self.buffer_started >= self.max_delay
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.is_due():
+                    if self.closed:
+                        return
+                    if self.buffer:
+                        timeout = self.buffer_started + self.max_delay - time.time()
+                    else:
+                        timeout = None
+                    self.lock.wait(timeout)
+                batch = self.buffer
+                self.buffer = []
+                self.flushing = self.pending
+                self.pending = {}
+                self.buffer_bytes = 0
+                self.buffer_started = None
+                self.lock.notify_all()
+            self.flush(batch)
+
+    def flush(self, batch):
+        try:
+            with metrics.timer("couch_put"):
+                results = self.save_docs([encoded for _, _, encoded, _ in batch])
+        except Exception as ex:
+            print("Failed to save %d document(s)" % len(batch))
+            traceback.print_exc()
+            results = [ex] * len(batch)
+        retries = {}
+        if self.on_conflict:
+            for i, ((_, doc, _, _), result) in enumerate(zip(batch, results)):
+                if isinstance(result, couchdb.ResourceConflict):
+                    try:
+                        retry_doc = self.on_conflict(doc)
+                    except Exception:
+                        traceback.print_exc()
+                        continue
+                    if retry_doc is not None:
+                        retries[i] = retry_doc
+        with self.lock:
+            for i, retry_doc in retries.items():
+                # bypass save() since writer thread must not wait for itself
+                encoded = encode_doc(retry_doc)
+                callback = batch[i][3]
+                if callback:
+                    callback = functools.partial(callback, merged=True)
+                item = [retry_doc["_id"], retry_doc, encoded, callback]
+                self.buffer.append(item)
+                self.pending[retry_doc["_id"]] = item
+                self.buffer_bytes += len(encoded)
+                if self.buffer_started is None:
+                    self.buffer_started = time.time()
+            for (doc_id, doc, _, _), result in zip(batch, results):
+                if not isinstance(result, Exception):
+                    self.saved[doc_id] = index_entry(doc, result)
+            self.flushing = {}
+            self.lock.notify_all()
+        for i, ((doc_id, doc, _, callback), result) in enumerate(zip(batch, results)):
+            if callback and i not in retries:
+                try:
+                    callback(doc_id, result)
+                except Exception:
+                    traceback.print_exc()
+
+    def close(self):
+        """Save all pending documents and stop writer thread"""
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.thread.join()
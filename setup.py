@@ -10,7 +10,9 @@ setup(name='mwscrape',
       packages=['mwscrape'],
       #mwclient appears to need six, but doesn't declare it as dependency
       install_requires=['CouchDB >= 0.10', 'mwclient >= 0.10.0', 'pylru'],
+      extras_require={'async': ['aiohttp >= 3.6'], 'zstd': ['zstandard']},
       entry_points={'console_scripts': [
           'mwscrape=mwscrape.scrape:main',
           'mwresolvec=mwscrape.resolveconflicts:main',
+          'mwprerender=mwscrape.prerender:main',
       ]})